@@ -1,25 +1,49 @@
 from bson import ObjectId
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, g, request, jsonify
 import json
 from search_service import *
+from ranking import SCORING_FORMULAS
+from instrumentation import begin_request, end_request, trace_header, stage
+from json_stream import iter_json, iter_ndjson
 import datetime
 import pytz
 
-app = Flask(__name__)
+routes = Blueprint('api', __name__)
 
-@app.route('/search', methods=['POST'])
-def search():
-    """
-    Search tweets based on query parameters.
-    Expected JSON payload: {
-        "query_string": "some text",
-        "hashtag": "example",
-        "user": "username",
-        "start_time": "YYYY-MM-DD HH:MM:SS",
-        "end_time": "YYYY-MM-DD HH:MM:SS"
-    }
-    """
-    data = request.json
+
+# Connections, caches and background threads are created on the first request of each worker process
+@routes.before_app_request
+def start_service():
+    start()
+
+
+# Per-request round trips and, for sampled requests or X-Trace: 1, a Server-Timing header with stage durations
+@routes.before_app_request
+def start_request_stats():
+    g.request_stats, g.request_token = begin_request(request.headers.get('X-Trace') == '1')
+
+
+@routes.after_app_request
+def finish_request_stats(response):
+    header = trace_header(g.request_stats)
+    if header:
+        response.headers['Server-Timing'] = header
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    end_request(g.request_stats, g.request_token, endpoint, response.status_code)
+    return response
+
+# Tweet document fields a client may ask for with "fields"
+TWEET_FIELDS = {'tweet_id', 'user_id', 'name', 'screen_name', 'text', 'created_at', 'is_retweet', 'quote_count',
+                'reply_count', 'retweet_count', 'favorite_count', 'entities', 'hashtags', 'url', 'user_mentions',
+                'original_tweet_id'}
+MAX_PAGE_SIZE = 200
+MAX_STREAM_PAGE_SIZE = 10000  # Streamed pages are never held in memory as a whole
+# "stream" values of a /search payload -> (chunk generator, mimetype)
+STREAM_FORMATS = {'json': (iter_json, 'application/json'), 'ndjson': (iter_ndjson, 'application/x-ndjson')}
+
+
+# Validate a /search payload into search parameters, or return the message of a 400 response
+def parse_search_request(data, max_page_size=MAX_PAGE_SIZE):
     time_range = None
 
     if 'start_time' in data and 'end_time' in data:
@@ -27,18 +51,72 @@ def search():
         end_time = datetime.datetime.fromisoformat(data['end_time'].replace(' ', 'T')).astimezone(pytz.utc)
         time_range = (start_time, end_time)
 
+    rank_by = data.get('rank_by')
+    if rank_by is not None and rank_by not in SCORING_FORMULAS and rank_by != 'relevance':
+        return None, f"Unknown rank_by '{rank_by}'"
+
+    fields = data.get('fields')
+    if fields is not None and (not isinstance(fields, list) or not set(fields) <= TWEET_FIELDS):
+        return None, f"fields must be a list drawn from {sorted(TWEET_FIELDS)}"
+
+    page_size = data.get('page_size', 50)
+    if not isinstance(page_size, int) or not 0 < page_size <= max_page_size:
+        return None, f"page_size must be between 1 and {max_page_size}"
+
     query_params = {
         'query_string': data.get('query_string'),
         'hashtag': data.get('hashtag'),
         'user': data.get('user'),
-        'time_range': time_range
+        'time_range': time_range,
+        'rank_by': rank_by,
+        'fields': tuple(sorted(fields)) if fields else None,
+        'page_size': page_size,
+        'cursor': data.get('cursor')
+    }
+    return query_params, None
+
+
+@routes.route('/search', methods=['POST'])
+def search():
+    """
+    Search tweets based on query parameters.
+    Expected JSON payload: {
+        "query_string": "some text",
+        "hashtag": "example" or ["example", "another"],
+        "user": "username",
+        "start_time": "YYYY-MM-DD HH:MM:SS",
+        "end_time": "YYYY-MM-DD HH:MM:SS",
+        "rank_by": "retweets" | "favorites" | "replies" | "quotes" | "engagement" | "relevance",
+        "fields": ["text", "retweet_count"],
+        "page_size": 50,
+        "cursor": "next_cursor of the previous page",
+        "stream": "json" | "ndjson"
     }
+    Categories list tweet ids; tweets they reference outside "results" are in "category_tweets".
+    With "stream" the response is sent while results are read from MongoDB, as one JSON object or as
+    one {"result": tweet} line per result followed by next_cursor and category lines, and page_size
+    may go up to MAX_STREAM_PAGE_SIZE.
+    """
+    data = request.json
+    stream = data.get('stream')
+    if stream is not None and stream not in STREAM_FORMATS:
+        return jsonify({'error': f"stream must be one of {sorted(STREAM_FORMATS)}"}), 400
+    query_params, error = parse_search_request(data, MAX_STREAM_PAGE_SIZE if stream else MAX_PAGE_SIZE)
+    if error:
+        return jsonify({'error': error}), 400
 
-    results = search_and_rank_tweets(query_params)
-    return jsonify(results)
+    try:
+        if stream:
+            encode, mimetype = STREAM_FORMATS[stream]
+            return Response(encode(stream_search(query_params)), mimetype=mimetype)
+        results = search_and_rank_tweets(query_params)
+    except ValueError as e:  # Malformed or mismatched cursor
+        return jsonify({'error': str(e)}), 400
+    with stage('serialize'):
+        return jsonify(results)
 
 
-@app.route('/top-metrics', methods=['GET'])
+@routes.route('/top-metrics', methods=['GET'])
 def top_metrics():
     """
     Retrieve top-level metrics.
@@ -48,7 +126,7 @@ def top_metrics():
     return jsonify(metrics)
 
 
-@app.route('/tweet/<tweet_id>', methods=['GET'])
+@routes.route('/tweet/<tweet_id>', methods=['GET'])
 def tweet_details(tweet_id):
     """
     Fetch details of a tweet by its ID.
@@ -57,6 +135,23 @@ def tweet_details(tweet_id):
     return jsonify(details)
 
 
+@routes.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Stage latencies, cache and database counters and ingest rates in the Prometheus text format.
+    """
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+
+def create_app():
+    app = Flask(__name__)
+    app.register_blueprint(routes)
+    return app
+
+
+# For `flask --app api run` and gunicorn api:app, creating it connects to nothing
+app = create_app()
+
 if __name__ == '__main__':
 
     app.run(debug=True, port=5000)
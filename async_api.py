@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import search_service as service
+from api import parse_search_request
+from ranking import ranking_plans, merge_plan_results, rank_key
+from instrumentation import begin_request, end_request, trace_header, stage
+from json_stream import dumps
+
+# asyncio serving mode for the same routes as api.py. The event loop holds the client connections,
+# the blocking pymongo and pymysql calls run on a thread pool, and lookups that don't depend on each
+# other run concurrently instead of one after the other.
+
+logger = logging.getLogger(__name__)
+
+REQUEST_DEADLINE = 5.0  # Seconds before a request is answered with 504
+BLOCKING_THREADS = 32  # Threads for database calls, more than the MySQL pool so Mongo calls aren't starved
+
+# Cache misses being computed, every request missing on the same key awaits the same task
+in_flight = {}
+
+
+async def blocking(fn, *args):
+    # In the request's context, so stages and round trips on the thread are counted for the request
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, fn, *args)
+
+
+async def nothing():
+    return None
+
+
+def log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Background refresh failed: %s", task.exception())
+
+
+def coalesce(key, compute):
+    """Run compute() once per key at a time; shielded so a caller's deadline doesn't cancel it for the rest."""
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(compute())
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    return asyncio.shield(task)
+
+
+async def compute_and_cache(cache, key, compute):
+    value = await compute()
+    if value:
+        cache.put(key, value)
+    return value
+
+
+async def cached(namespace, key, compute):
+    """Async counterpart of search_service.cached_call, sharing its caches.
+
+    Cache calls stay on the loop: they are in-memory, or one round trip to the local cache server.
+    """
+    cache = service.caches[namespace]
+    value, fresh = cache.get_entry(key)
+    if value:
+        if not fresh and (namespace, key) not in in_flight:
+            coalesce((namespace, key), lambda: compute_and_cache(cache, key, compute)).add_done_callback(log_failure)
+        return value
+    return await coalesce((namespace, key), lambda: compute_and_cache(cache, key, compute))
+
+
+# One stage per aggregation here, they run concurrently instead of inside one rank_tweets call;
+# the hot store answers all of them at once when it can
+def run_pipeline(pipeline):
+    with stage('rank'):
+        return list(service.tweets_collection.aggregate(pipeline))
+
+
+def rank_from_store(*args):
+    with stage('rank'):
+        return service.rank_from_store(*args)
+
+
+async def search_async(params):
+    options = service.search_options(params)
+
+    # The screen_name lookup and the text index don't depend on each other
+    user_id, text_filter = await asyncio.gather(
+        blocking(service.lookup_user_id, options['user']) if options['user'] else nothing(),
+        blocking(service.text_query_filter, options['query_string']) if options['query_string'] else nothing())
+    query_filter = service.build_query_filter(None, options['hashtag'], user_id, options['time_range'])
+    query_filter.update(text_filter or {})
+
+    key = rank_key(options['formula'], '$text' in query_filter)
+    ranked = None
+    if service.hot_store is not None and service.use_hot_store and not service.hot_store_behind:
+        ranked = await blocking(rank_from_store, query_filter, options['formula'], options['limit'],
+                                options['category_limit'], options['after'], options['fields'])
+    if ranked is not None:
+        top_by_category, results = ranked
+        return await blocking(service.package_results, params, top_by_category, results, key)
+
+    # Results and category rankings are separate aggregations over the same filter, one set per chunk of a
+    # long tweet_id list; all of them run concurrently and are merged afterwards
+    plans = ranking_plans(query_filter, options['formula'], options['limit'], options['category_limit'],
+                          options['after'], options['fields'])
+    pipelines = [pipeline for plan_pipeline, categories in plans
+                 for pipeline in [plan_pipeline, *categories.values()] if pipeline is not None]
+    ranked_lists = await asyncio.gather(*(blocking(run_pipeline, pipeline) for pipeline in pipelines))
+    by_pipeline = {id(pipeline): tweets for pipeline, tweets in zip(pipelines, ranked_lists)}
+    top_by_category, results = merge_plan_results(
+        plans, lambda pipeline: by_pipeline[id(pipeline)], options['formula'], options['limit'],
+        options['category_limit'], '$text' in query_filter)
+    return await blocking(service.package_results, params, top_by_category, results, key)
+
+
+async def top_metrics_async():
+    try:
+        top_users, top_tweets = await asyncio.gather(
+            blocking(service.fetch_top_users), blocking(service.fetch_top_tweets))
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return {'top_users': [], 'top_tweets': []}
+    return {'top_users': top_users, 'top_tweets': top_tweets}
+
+
+# Same encoding as Flask's jsonify, so both serving modes return the same bodies
+def json_response(data, status=200):
+    with stage('serialize'):
+        body = dumps(data)
+    return web.Response(text=body, status=status, content_type='application/json')
+
+
+async def search(request):
+    """Same payload and response as POST /search in api.py."""
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return json_response({'error': "Request body must be JSON"}, 400)
+    query_params, error = parse_search_request(data)
+    if error:
+        return json_response({'error': error}, 400)
+
+    params = service.normalize_query(query_params)
+    service.query_key_stats.record(query_params, params)
+    try:
+        results = await cached('search', service.query_key(params), lambda: search_async(params))
+    except ValueError as e:  # Malformed or mismatched cursor
+        return json_response({'error': str(e)}, 400)
+    return json_response(results)
+
+
+async def top_metrics(request):
+    if service.top_metrics is not None:
+        return json_response(service.top_metrics.snapshot())  # Maintained by the loader
+    return json_response(await cached('metrics', 'top_metrics', top_metrics_async))
+
+
+async def tweet_details(request):
+    # The user lookup needs the tweet's user_id, so this one stays sequential
+    tweet_id = request.match_info['tweet_id']
+    details = await cached('metadata', tweet_id, lambda: blocking(service.fetch_tweet_metadata, tweet_id))
+    return json_response(details)
+
+
+async def prometheus_metrics(request):
+    return web.Response(body=service.metrics_text().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@web.middleware
+async def record_request(request, handler):
+    stats, token = begin_request(request.headers.get('X-Trace') == '1')
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        header = trace_header(stats)
+        if header:
+            response.headers['Server-Timing'] = header
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        end_request(stats, token, resource.canonical if resource is not None else 'unmatched', status)
+
+
+@web.middleware
+async def enforce_deadline(request, handler):
+    # Database calls already running finish on their threads, but the client gets its answer on time
+    deadline = request.app['deadline']
+    try:
+        return await asyncio.wait_for(handler(request), deadline)
+    except asyncio.TimeoutError:
+        return json_response({'error': f"Request did not complete within {deadline}s"}, 504)
+
+
+def create_app(deadline=REQUEST_DEADLINE, threads=BLOCKING_THREADS):
+    app = web.Application(middlewares=[record_request, enforce_deadline])
+    app['deadline'] = deadline
+
+    async def start_executor(app):
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='blocking')
+        asyncio.get_running_loop().set_default_executor(executor)
+        service.start()  # Once per process, in the worker serving the requests
+
+    app.on_startup.append(start_executor)
+    app.router.add_post('/search', search)
+    app.router.add_get('/top-metrics', top_metrics)
+    app.router.add_get('/tweet/{tweet_id}', tweet_details)
+    app.router.add_get('/metrics', prometheus_metrics)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="asyncio serving mode of the search API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--deadline', type=float, default=REQUEST_DEADLINE, help="Seconds per request")
+    parser.add_argument('--threads', type=int, default=BLOCKING_THREADS, help="Threads for database calls")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.deadline, args.threads), host=args.host, port=args.port)
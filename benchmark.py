@@ -0,0 +1,327 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from cache import LRUCacheWithTTL
+from cache_harness import zipf_weights
+from stand_ins import FakeCollection, FakeMySQLConnection, RoundTrips, install, install_config
+
+# Reproducible benchmarks of the ingestion, search and cache hot paths against the in-process
+# stand-ins for MongoDB and MySQL. Results go to JSON so runs can be compared over time.
+
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+START = datetime(2020, 4, 1, tzinfo=timezone.utc)
+VOCABULARY = [f"word{i}" for i in range(2000)]
+
+
+def twitter_date(moment):
+    return moment.strftime(TWITTER_DATE_FORMAT)
+
+
+def make_user(user_id, rng):
+    return {
+        'id': user_id, 'id_str': str(user_id), 'name': f"User {user_id}", 'screen_name': f"user{user_id}",
+        'location': None, 'url': None, 'description': '', 'followers_count': int(rng.paretovariate(0.8)),
+        'favourites_count': rng.randint(0, 5000), 'statuses_count': rng.randint(0, 50000),
+        'created_at': twitter_date(START - timedelta(days=rng.randint(1, 3000))),
+    }
+
+
+def generate_tweets(path, tweets=10000, users=1000, hashtags=500, user_skew=1.0, hashtag_skew=1.1,
+                    retweet_ratio=0.3, seed=0):
+    """Write a JSONL file of tweets shaped like the Twitter API objects the loaders read.
+
+    Authors and hashtags follow Zipf distributions; a retweet embeds its original with the
+    original's retweet_count raised, like the API does.
+    """
+    rng = random.Random(seed)
+    user_ids = list(range(1, users + 1))
+    user_weights = zipf_weights(users, user_skew)
+    tags = [f"tag{i}" for i in range(hashtags)]
+    tag_weights = zipf_weights(hashtags, hashtag_skew)
+    user_objects = {}
+    originals = []  # Recent original tweets that can be retweeted
+    next_id = 10 ** 15
+    with open(path, 'w') as f:
+        for position in range(tweets):
+            next_id += 1
+            user_id = rng.choices(user_ids, user_weights)[0]
+            user = user_objects.setdefault(user_id, make_user(user_id, rng))
+            created_at = twitter_date(START + timedelta(seconds=position * 5))
+            if originals and rng.random() < retweet_ratio:
+                original = rng.choice(originals)
+                original['retweet_count'] += 1
+                tweet = {
+                    'created_at': created_at, 'id': next_id, 'id_str': str(next_id),
+                    'text': f"RT @{original['user']['screen_name']}: {original['text']}",
+                    'user': user, 'quote_count': 0, 'reply_count': 0, 'retweet_count': 0, 'favorite_count': 0,
+                    'entities': original['entities'], 'retweeted_status': original,
+                }
+            else:
+                tweet_tags = set(rng.choices(tags, tag_weights, k=rng.choice([0, 0, 1, 1, 2, 3])))
+                tweet = {
+                    'created_at': created_at, 'id': next_id, 'id_str': str(next_id),
+                    'text': ' '.join(rng.choices(VOCABULARY, k=rng.randint(5, 20))
+                                     + [f"#{tag}" for tag in sorted(tweet_tags)]),
+                    'user': user, 'quote_count': rng.randint(0, 20), 'reply_count': rng.randint(0, 20),
+                    'retweet_count': 0, 'favorite_count': int(rng.paretovariate(1.2)) - 1,
+                    'entities': {'hashtags': [{'text': tag, 'indices': [0, 0]} for tag in sorted(tweet_tags)],
+                                 'user_mentions': [], 'urls': []},
+                }
+                originals.append(tweet)
+                if len(originals) > 1000:
+                    originals.pop(0)
+            f.write(json.dumps(tweet) + '\n')
+    return path
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def latency_summary(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0}
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {'count': len(ordered), 'mean_ms': sum(ordered) / len(ordered) * 1000, 'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99)}
+
+
+def bench_ingest(path, batch_size, latency, sample):
+    install_config()  # The loaders import config, which a clean checkout doesn't have
+    import mongo_database
+    import mysql_database
+    with open(path) as f:
+        lines = sum(1 for _ in f)
+    results = {}
+
+    # Batched loader, the default full load
+    round_trips = RoundTrips()
+    tweets = FakeCollection(latency=latency, round_trips=round_trips)
+    mongo_database.tweets_collection = tweets
+    mongo_database.hashtags_collection = FakeCollection(latency=latency, round_trips=round_trips, key='text')
+    started = time.perf_counter()
+    inserted = mongo_database.bulk_load_tweets(path, batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+    results['bulk_load_tweets'] = {'lines': lines, 'documents': inserted, 'seconds': elapsed,
+                                   'tweets_per_second': lines / elapsed, 'round_trips': dict(round_trips.counts)}
+    documents = tweets.documents
+
+    # One tweet per round trip through insert_tweet, on the first lines only
+    round_trips = RoundTrips()
+    mongo_database.tweets_collection = FakeCollection(latency=latency, round_trips=round_trips)
+    mongo_database.hashtags_collection = FakeCollection(latency=latency, round_trips=round_trips, key='text')
+    started = time.perf_counter()
+    count = 0
+    with open(path) as f:
+        for line in f:
+            if count >= sample:
+                break
+            mongo_database.insert_tweet(json.loads(line))
+            count += 1
+    elapsed = time.perf_counter() - started
+    results['insert_tweet'] = {'lines': count, 'seconds': elapsed, 'tweets_per_second': count / elapsed,
+                               'round_trips': dict(round_trips.counts)}
+
+    # Users into the MySQL stand-in through the batched executemany loader
+    round_trips = RoundTrips()
+    connection = FakeMySQLConnection({}, latency, round_trips)
+    started = time.perf_counter()
+    written, _ = mysql_database.process_dataset_batched(path, connection, batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+    results['process_dataset_batched'] = {'lines': lines, 'users': written, 'seconds': elapsed,
+                                          'tweets_per_second': lines / elapsed,
+                                          'round_trips': dict(round_trips.counts)}
+    return results, documents, connection.users
+
+
+def search_workload(rng, documents, users, tags, tag_weights):
+    """Parameters per query type, drawn like real traffic: popular hashtags and users more often."""
+    screen_names = [user['screen_name'] for user in users.values()]
+    newest = max(document['created_at'] for document in documents)
+    oldest = min(document['created_at'] for document in documents)
+    span = max(int((newest - oldest).total_seconds()), 1)
+
+    def time_range():
+        start = oldest + timedelta(seconds=rng.randrange(span))
+        return start, start + timedelta(hours=1)
+
+    return {
+        'keyword': lambda: {'query_string': rng.choice(VOCABULARY[:500])},
+        'phrase': lambda: {'query_string': ' '.join(rng.choice(documents)['text'].split()[:2])},
+        'prefix': lambda: {'query_string': rng.choice(VOCABULARY[:500])[:-1] + '*'},
+        'hashtag': lambda: {'hashtag': rng.choices(tags, tag_weights)[0]},
+        'user': lambda: {'user': rng.choice(screen_names)},
+        'time_range': lambda: {'time_range': time_range()},
+        'combined': lambda: {'query_string': rng.choice(VOCABULARY[:200]), 'rank_by': 'engagement',
+                             'hashtag': rng.choices(tags, tag_weights)[0]},
+        'paged': lambda: {'time_range': time_range(), 'rank_by': 'retweets', 'page_size': 20},
+    }
+
+
+def bench_search(documents, users, queries, latency, hashtags, hashtag_skew, seed):
+    install_config()
+    import search_service
+    from text_index import InvertedIndex
+    round_trips = install(search_service, documents, users, latency)
+    search_service.text_index = InvertedIndex()
+    for document in documents:
+        search_service.text_index.add(document['tweet_id'], document['text'])
+    search_service.search_backend = 'index'
+
+    rng = random.Random(seed)
+    tags = [f"tag{i}" for i in range(hashtags)]
+    workload = search_workload(rng, documents, users, tags, zipf_weights(hashtags, hashtag_skew))
+
+    # Uncached latency of search_and_rank_tweets, ranking and enrichment included
+    latencies = {}
+    for query_type, make_params in workload.items():
+        values = latencies.setdefault(query_type, [])
+        for _ in range(queries):
+            params = make_params()
+            started = time.perf_counter()
+            first_page = search_service.search_and_rank_tweets(params, cache=False)
+            values.append(time.perf_counter() - started)
+            if query_type == 'paged' and first_page['next_cursor']:
+                # The second page of the same query, through the keyset cursor
+                started = time.perf_counter()
+                search_service.search_and_rank_tweets(dict(params, cursor=first_page['next_cursor']),
+                                                      cache=False)
+                latencies.setdefault('next_page', []).append(time.perf_counter() - started)
+    results = {'latency': {query_type: latency_summary(values) for query_type, values in latencies.items()},
+               'round_trips': dict(round_trips.counts)}
+
+    # Hit rate of the search and metadata caches on a skewed mix of repeated queries
+    pool = [(query_type, make_params()) for query_type, make_params in workload.items() for _ in range(queries)]
+    pool_weights = zipf_weights(len(pool), 1.0)
+    started = time.perf_counter()
+    mixed = [search_service.search_and_rank_tweets(params) for _, params in rng.choices(pool, pool_weights,
+                                                                                       k=queries * 10)]
+    results['cached_mix'] = {'requests': len(mixed), 'seconds': time.perf_counter() - started,
+                             'caches': {name: search_service.caches[name].stats().get('totals', {})
+                                        for name in ('search', 'metadata')}}
+    return results
+
+
+def bench_cache(operations, distinct_keys, capacity, threads, skew, seed):
+    rng = random.Random(seed)
+    keys = [f"query-{i}" for i in range(distinct_keys)]
+    results = {}
+    for thread_count in sorted({1, threads}):
+        cache = LRUCacheWithTTL(capacity=capacity, checkpoint_file=None)
+        plans = [rng.choices(keys, zipf_weights(distinct_keys, skew), k=operations // thread_count)
+                 for _ in range(thread_count)]
+
+        def run(plan):
+            for key in plan:
+                if cache.get(key) is None:
+                    cache.put(key, {'query': key})
+
+        workers = [threading.Thread(target=run, args=(plan,)) for plan in plans]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        totals = cache.stats()['totals']
+        results[f'threads_{thread_count}'] = {'operations': operations, 'seconds': elapsed,
+                                              'operations_per_second': operations / elapsed,
+                                              'hit_rate': totals['hit_rate']}
+    return results
+
+
+# Headline numbers of a report, used to compare two runs
+def headline(report):
+    numbers = {}
+    for stage, values in report.get('ingest', {}).items():
+        numbers[f'ingest.{stage}.tweets_per_second'] = values['tweets_per_second']
+    for query_type, values in report.get('search', {}).get('latency', {}).items():
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            numbers[f'search.{query_type}.{key}'] = values.get(key)
+    for name, values in report.get('cache', {}).items():
+        numbers[f'cache.{name}.operations_per_second'] = values['operations_per_second']
+    numbers['peak_rss_mb'] = report.get('peak_rss_mb')
+    return numbers
+
+
+def compare(report, baseline):
+    current, previous = headline(report), headline(baseline)
+    for name, value in current.items():
+        old = previous.get(name)
+        change = f"{(value - old) / old * 100:+7.1f}%" if old and value is not None else '    n/a'
+        print(f"{name:<50} {value:12.2f} {change}")
+
+
+def run(args):
+    report = {'options': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+              'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                              'started_at': datetime.now(timezone.utc).isoformat()}}
+    dataset = args.dataset or generate_tweets(
+        os.path.join(tempfile.gettempdir(), f"benchmark-{args.tweets}-{args.seed}.jsonl"), args.tweets,
+        args.users, args.hashtags, args.user_skew, args.hashtag_skew, args.retweet_ratio, args.seed)
+
+    # The loaders and the service print progress; keep the report readable unless asked for it
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        report['ingest'], documents, users = bench_ingest(dataset, args.batch_size, args.latency,
+                                                          args.insert_sample)
+        report['peak_rss_mb_after_ingest'] = peak_rss_mb()
+        report['search'] = bench_search(documents, users, args.queries, args.latency, args.hashtags,
+                                        args.hashtag_skew, args.seed)
+        report['cache'] = bench_cache(args.cache_operations, args.distinct_keys, args.cache_capacity,
+                                      args.threads, args.hashtag_skew, args.seed)
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, search and cache hot paths")
+    parser.add_argument('--dataset', help="Existing tweet JSONL file instead of a generated one")
+    parser.add_argument('--tweets', type=int, default=20000, help="Tweets to generate")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--hashtags', type=int, default=500)
+    parser.add_argument('--user-skew', type=float, default=1.0, help="Zipf exponent of tweets per user")
+    parser.add_argument('--hashtag-skew', type=float, default=1.1, help="Zipf exponent of hashtag popularity")
+    parser.add_argument('--retweet-ratio', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--insert-sample', type=int, default=2000, help="Tweets loaded one by one with insert_tweet")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds per stand-in database round trip")
+    parser.add_argument('--queries', type=int, default=100, help="Searches per query type")
+    parser.add_argument('--cache-operations', type=int, default=200000)
+    parser.add_argument('--distinct-keys', type=int, default=20000)
+    parser.add_argument('--cache-capacity', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=4, help="Threads in the concurrent cache run")
+    parser.add_argument('--output', help="Write the report as JSON to this file")
+    parser.add_argument('--baseline', help="Report of an earlier run to compare against")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of the loaders and the service")
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    # search_service restores and checkpoints its caches in the working directory, start from a clean one
+    os.chdir(tempfile.mkdtemp(prefix='benchmark-'))
+    report = run(args)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            compare(report, json.load(f))
+    else:
+        for name, value in headline(report).items():
+            print(f"{name:<50} {value:12.2f}")
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,60 +1,418 @@
+from abc import ABC, abstractmethod
+import fcntl
 import time
 from collections import OrderedDict
+import heapq
+import logging
 import pickle
 import os
+import sys
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FORMAT = 2
+
+
+def estimate_size(value, seen=None):
+    """Approximate deep size in bytes of a cached value made of containers, strings, numbers and dates."""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in value)
+    return size
+
+
+def split_budget(total, parts, index):
+    if total is None:
+        return None
+    return total // parts + (1 if index < total % parts else 0)
+
+
+def write_records(path, records):
+    """Atomically replace path with a stream of pickled records."""
+    # A temp file of its own per write, so concurrent writers never share one
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory or '.', prefix=name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for record in records:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_records(f):
+    """Yield pickled records until the end of the file or a torn record left by a crash."""
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+        except (pickle.UnpicklingError, ValueError, AttributeError, IndexError) as e:
+            logger.warning("Stopped reading %s at a damaged record: %s", getattr(f, 'name', f), e)
+            return
+
+
+class CacheBackend(ABC):
+    """Storage behind LRUCacheWithTTL.get/put when the cache lives outside the process."""
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def put(self, key, value):
+        pass
+
+    def get_entry(self, key):
+        value = self.get(key)
+        return value, value is not None
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def put_many(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def stats(self):
+        return {}
+
+
+class CacheShard:
+    """One lock-protected slice of the cache: LRU order, expiry heap and counters."""
+
+    def __init__(self, capacity, max_bytes=None):
+        self.entries = OrderedDict()  # key -> (value, timestamp), least recently used first
+        self.expiry = []  # heap of (timestamp, key), may hold outdated timestamps
+        self.sizes = {}  # key -> estimated bytes, only in byte-budget mode
+        self.dirty = set()  # keys put since the last checkpoint
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.stale_hits = self.misses = self.evictions = self.expirations = 0
+
+    def remove(self, key):
+        # Caller holds self.lock
+        entry = self.entries.pop(key)
+        self.bytes -= self.sizes.pop(key, 0)
+        return entry
+
+    def is_full(self, incoming_bytes):
+        return ((self.capacity is not None and len(self.entries) >= self.capacity) or
+                (self.max_bytes is not None and self.bytes + incoming_bytes > self.max_bytes))
+
 
 class LRUCacheWithTTL:
-    def __init__(self, capacity, ttl=3600, checkpoint_file='cache_checkpoint.pkl'):
-        self.cache = OrderedDict()
+    def __init__(self, capacity=None, ttl=3600, checkpoint_file='cache_checkpoint.pkl', shards=16, max_bytes=None,
+                 lazy_load=False, backend=None, stale_ttl=0):
+        if capacity is None and max_bytes is None:
+            raise ValueError("LRUCacheWithTTL needs a capacity, a max_bytes budget or both")
         self.capacity = capacity
+        self.max_bytes = max_bytes
         self.ttl = ttl
-        self.checkpoint_file = checkpoint_file
-        self.load_checkpoint()
+        # Expired entries stay servable through get_entry for stale_ttl more seconds while they are refreshed
+        self.stale_ttl = stale_ttl
+        # With a backend, entries live (and are checkpointed) wherever the backend keeps them
+        self.backend = backend
+        self.checkpoint_file = checkpoint_file if backend is None else None
+        # Split the entry and byte budgets over the shards, never more shards than entries
+        shard_count = max(1, min(shards, capacity if capacity is not None else shards))
+        self.shards = [CacheShard(split_budget(capacity, shard_count, i), split_budget(max_bytes, shard_count, i))
+                       for i in range(shard_count)]
+        self.checkpoint_lock = threading.Lock()
+        self.owner_file = None  # Locked file of the process writing the checkpoint, see owns_checkpoint
+        self.owner_pid = None
+        self.generation = None  # generation of the snapshot the delta log belongs to
+        self.log_records = 0
+        self.loaded = threading.Event()
+        if checkpoint_file and lazy_load:
+            # Serve traffic while the warm cache is restored in the background
+            threading.Thread(target=self.load_checkpoint, daemon=True).start()
+        elif checkpoint_file:
+            self.load_checkpoint()
+        else:
+            self.loaded.set()
+
+    def shard_for(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+    @property
+    def cache(self):
+        """Snapshot of all live entries as key -> (value, timestamp)."""
+        snapshot = OrderedDict()
+        for shard in self.shards:
+            with shard.lock:
+                snapshot.update(shard.entries)
+        return snapshot
 
     def get(self, key):
-        if key in self.cache and not self.is_entry_stale(key):
-            self.cache.move_to_end(key)
-            return self.cache[key][0]
-        else:
-            return None
+        if self.backend is not None:
+            return self.backend.get(key)
+        value, fresh = self.get_entry(key)
+        return value if fresh else None
 
-    def put(self, key, value):
-        if key in self.cache:
-            del self.cache[key]
-        elif len(self.cache) >= self.capacity:
-            self.evict_lru()
-        self.cache[key] = (value, time.time())
+    def get_many(self, keys):
+        """Fresh values of the keys that have one, as a dict; one round trip with a backend."""
+        if self.backend is not None:
+            return self.backend.get_many(keys)
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
 
-    def evict_lru(self):
-        key, _ = self.cache.popitem(last=False)
-        print(f"Evicted: {key}")
+    def get_entry(self, key):
+        """Return (value, fresh): fresh within the ttl, stale within the stale_ttl after it, else (None, False)."""
+        if self.backend is not None:
+            return self.backend.get_entry(key)
+        shard = self.shard_for(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                shard.misses += 1
+                return None, False
+            age = time.time() - entry[1]
+            if age > self.ttl + self.stale_ttl:
+                # Lazy expiry, the heap entry is dropped on the next purge
+                shard.remove(key)
+                shard.expirations += 1
+                shard.misses += 1
+                return None, False
+            shard.entries.move_to_end(key)
+            if age > self.ttl:
+                shard.stale_hits += 1
+                return entry[0], False
+            shard.hits += 1
+            return entry[0], True
+
+    def put(self, key, value, timestamp=None):
+        if self.backend is not None:
+            return self.backend.put(key, value)
+        self.insert(key, value, time.time() if timestamp is None else timestamp)
+
+    def restore(self, key, value, timestamp):
+        """Insert a checkpointed entry unless a newer value for the key is already cached."""
+        if (time.time() - timestamp) <= self.ttl + self.stale_ttl:
+            self.insert(key, value, timestamp, restoring=True)
+
+    def insert(self, key, value, timestamp, restoring=False):
+        shard = self.shard_for(key)
+        size = estimate_size(value) if self.max_bytes is not None else 0  # Sized outside the lock
+        with shard.lock:
+            if key in shard.entries:
+                if restoring and shard.entries[key][1] >= timestamp:
+                    return
+                shard.remove(key)
+            if shard.max_bytes is not None and size > shard.max_bytes:
+                logger.debug("Not caching %s: %d bytes exceeds the shard budget", key, size)
+                return
+            while shard.entries and shard.is_full(size):
+                self.evict_lru(shard)
+            shard.entries[key] = (value, timestamp)
+            if not restoring:
+                shard.dirty.add(key)
+            if size:
+                shard.sizes[key] = size
+                shard.bytes += size
+            heapq.heappush(shard.expiry, (timestamp, key))
+            if len(shard.expiry) > 2 * len(shard.entries) + 64:
+                # Too many outdated heap entries from overwritten keys, rebuild it
+                shard.expiry = [(entry_time, k) for k, (_, entry_time) in shard.entries.items()]
+                heapq.heapify(shard.expiry)
+
+    def put_many(self, items):
+        if self.backend is not None:
+            return self.backend.put_many(items)
+        for key, value in items:
+            self.put(key, value)
+
+    def evict_lru(self, shard):
+        # Caller holds shard.lock
+        key = next(iter(shard.entries))
+        shard.remove(key)
+        shard.evictions += 1
+        logger.debug("Evicted: %s", key)
 
     def is_entry_stale(self, key):
-        if key in self.cache:
-            entry_time = self.cache[key][1]
-            return (time.time() - entry_time) > self.ttl
+        shard = self.shard_for(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+        if entry is not None:
+            return (time.time() - entry[1]) > self.ttl
         return True  # Treat missing keys as stale
 
     def purge_stale_entries(self):
-        keys_to_delete = [key for key, (_, timestamp) in self.cache.items() if (time.time() - timestamp) > self.ttl]
-        for key in keys_to_delete:
-            del self.cache[key]
-            print(f"Purged: {key}")
+        cutoff = time.time() - self.ttl - self.stale_ttl
+        purged = 0
+        for shard in self.shards:
+            with shard.lock:
+                # Only entries at the front of the heap can be stale
+                while shard.expiry and shard.expiry[0][0] < cutoff:
+                    timestamp, key = heapq.heappop(shard.expiry)
+                    entry = shard.entries.get(key)
+                    if entry is not None and entry[1] == timestamp:
+                        shard.remove(key)
+                        shard.expirations += 1
+                        purged += 1
+                        logger.debug("Purged: %s", key)
+        return purged
 
-    def checkpoint(self):
-        with open(self.checkpoint_file, 'wb') as f:
-            pickle.dump(self.cache, f)
-        print("Checkpoint created.")
+    def stats(self):
+        """Hit/miss/eviction counters, totals and per shard."""
+        if self.backend is not None:
+            return self.backend.stats()
+        per_shard = []
+        for shard in self.shards:
+            with shard.lock:
+                per_shard.append({'entries': len(shard.entries), 'bytes': shard.bytes, 'hits': shard.hits,
+                                  'stale_hits': shard.stale_hits, 'misses': shard.misses, 'evictions': shard.evictions,
+                                  'expirations': shard.expirations})
+        totals = {name: sum(s[name] for s in per_shard) for name in per_shard[0]}
+        lookups = totals['hits'] + totals['stale_hits'] + totals['misses']
+        totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+        return {'totals': totals, 'shards': per_shard}
 
-    def load_checkpoint(self):
-        if os.path.exists(self.checkpoint_file):
+    @property
+    def log_file(self):
+        return self.checkpoint_file + '.log'
+
+    def owns_checkpoint(self):
+        """Whether this process writes the checkpoint files.
+
+        Every worker of a service restores from the same files, but only the one holding an exclusive lock
+        on checkpoint_file + '.lock' writes them. The lock goes with the process, so another worker takes
+        over on its next checkpoint once the owner exits.
+        """
+        if self.owner_file is not None and self.owner_pid == os.getpid():
+            return True
+        owner_file = open(self.checkpoint_file + '.lock', 'a')
+        try:
+            fcntl.flock(owner_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            owner_file.close()
+            return False
+        self.owner_file, self.owner_pid = owner_file, os.getpid()
+        self.generation = None  # The previous owner may have moved on, start over with a full snapshot
+        return True
+
+    def snapshot_generation(self):
+        try:
             with open(self.checkpoint_file, 'rb') as f:
-                loaded_cache = pickle.load(f)
-                self.cache = OrderedDict()
-                for k, v in loaded_cache.items():
-                    if not self.is_entry_stale(k):
-                        self.cache[k] = v
-            print("Checkpoint loaded.")
+                header = next(read_records(f), None)
+        except OSError:
+            return 0
+        return header.get('generation', 0) if isinstance(header, dict) else 0
+
+    def checkpoint(self, full=None):
+        """Append entries put since the last checkpoint to the delta log, or write a full snapshot.
+
+        A full snapshot is written when there is none yet or the log has grown past the cache size.
+        Shards are only locked while their entries are copied, never while writing.
+        """
+        if not self.checkpoint_file:
+            return
+        self.loaded.wait()  # A snapshot taken mid-restore would drop the entries not loaded yet
+        with self.checkpoint_lock:
+            if not self.owns_checkpoint():
+                for shard in self.shards:
+                    with shard.lock:
+                        shard.dirty.clear()  # The owner's next snapshot has its own entries, not these
+                return
+            if full is None:
+                full = (self.generation is None or not os.path.exists(self.log_file) or
+                        self.log_records >= max(len(self), 1))
+            if full:
+                self.write_snapshot()
+            else:
+                self.append_log()
+
+    def write_snapshot(self):
+        records = []
+        for shard in self.shards:
+            with shard.lock:
+                records.extend((key, value, timestamp) for key, (value, timestamp) in shard.entries.items())
+                shard.dirty.clear()
+        generation = max(self.generation or 0, self.snapshot_generation()) + 1
+        # Write then rename, a crash leaves either the old or the new snapshot, never a partial one
+        write_records(self.checkpoint_file, [{'format': CHECKPOINT_FORMAT, 'generation': generation}] + records)
+        # A log from an older generation is ignored on load, so a crash before this line is safe
+        write_records(self.log_file, [{'format': CHECKPOINT_FORMAT, 'generation': generation}])
+        self.generation, self.log_records = generation, 0
+        print(f"Checkpoint created with {len(records)} entries.")
+
+    def append_log(self):
+        records = []
+        for shard in self.shards:
+            with shard.lock:
+                records.extend((key,) + shard.entries[key] for key in shard.dirty if key in shard.entries)
+                shard.dirty.clear()
+        if records:
+            with open(self.log_file, 'ab') as f:
+                for record in records:
+                    pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            self.log_records += len(records)
+        print(f"Checkpoint appended {len(records)} entries.")
+
+    def load_checkpoint(self):
+        try:
+            if os.path.exists(self.checkpoint_file):
+                with open(self.checkpoint_file, 'rb') as f:
+                    records = read_records(f)
+                    header = next(records, None)
+                    if isinstance(header, dict) and header.get('format') == CHECKPOINT_FORMAT:
+                        for key, value, timestamp in records:
+                            self.restore(key, value, timestamp)
+                        generation = header['generation']
+                    else:
+                        # Single pickled OrderedDict written by earlier versions
+                        for key, (value, timestamp) in (header or {}).items():
+                            self.restore(key, value, timestamp)
+                        generation = None
+                if generation is not None and os.path.exists(self.log_file):
+                    with open(self.log_file, 'rb') as f:
+                        records = read_records(f)
+                        log_header = next(records, None)
+                        if isinstance(log_header, dict) and log_header.get('generation') == generation:
+                            good_end = f.tell()
+                            for key, value, timestamp in records:
+                                self.restore(key, value, timestamp)
+                                self.log_records += 1
+                                good_end = f.tell()
+                            if good_end < os.path.getsize(self.log_file) and self.owns_checkpoint():
+                                # Cut a torn tail so later appends stay readable; only the writer may, the
+                                # tail may be an append in progress in another process
+                                with open(self.log_file, 'r+b') as log:
+                                    log.truncate(good_end)
+                            self.generation = generation
+                print("Checkpoint loaded.")
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            print(f"Failed to load checkpoint {self.checkpoint_file}: {e}")
+        finally:
+            self.loaded.set()
 
     def periodic_checkpoint(self, interval):
         while True:
@@ -63,6 +421,60 @@ class LRUCacheWithTTL:
             time.sleep(interval)  # Interval in seconds
 
 
+class NamespacedCache:
+    """Separate LRUCacheWithTTL budgets per class of entry, so one namespace can't push out another."""
+
+    def __init__(self, budgets, ttl=3600, checkpoint_file='cache_checkpoint.pkl', shards=16, lazy_load=False,
+                 backend_factory=None):
+        # budgets: namespace -> {'capacity': ..., 'max_bytes': ..., 'stale_ttl': ...},
+        # each namespace checkpoints to its own file
+        self.ttl = ttl
+        self.checkpoint_file = checkpoint_file
+        self.shards = shards
+        self.lazy_load = lazy_load
+        # backend_factory(name, budget) -> CacheBackend, to keep the namespaces out of process
+        self.backend_factory = backend_factory
+        self.namespaces = {}
+        self.lock = threading.Lock()
+        for name, budget in budgets.items():
+            self.namespace(name, budget)
+
+    def namespace(self, name, budget):
+        """The cache for a namespace, created with the given budget on first use."""
+        with self.lock:
+            cache = self.namespaces.get(name)
+            if cache is None:
+                if self.checkpoint_file:
+                    root, extension = os.path.splitext(self.checkpoint_file)
+                    checkpoint_file = f"{root}.{name}{extension}"
+                else:
+                    checkpoint_file = None
+                backend = self.backend_factory(name, budget) if self.backend_factory else None
+                cache = self.namespaces[name] = LRUCacheWithTTL(
+                    ttl=self.ttl, shards=self.shards, lazy_load=self.lazy_load, checkpoint_file=checkpoint_file,
+                    backend=backend, **budget)
+            return cache
+
+    def __getitem__(self, name):
+        return self.namespaces[name]
+
+    def purge_stale_entries(self):
+        return sum(cache.purge_stale_entries() for cache in list(self.namespaces.values()))
+
+    def checkpoint(self):
+        for cache in list(self.namespaces.values()):
+            cache.checkpoint()
+
+    def periodic_checkpoint(self, interval):
+        while True:
+            self.purge_stale_entries()
+            self.checkpoint()
+            time.sleep(interval)
+
+    def stats(self):
+        return {name: cache.stats().get('totals', {}) for name, cache in list(self.namespaces.items())}
+
+
 if __name__ == '__main__':
 
     # Example usage:
@@ -72,5 +484,3 @@ if __name__ == '__main__':
     value = cache.get("some_key")  # Should return 'some_value' if within TTL
     print(value)
     cache.periodic_checkpoint(600)  # Set the checkpoint interval as needed
-
-
@@ -0,0 +1,105 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import secrets
+import tempfile
+import time
+from cache import LRUCacheWithTTL
+from cache_server import CacheServer, SocketBackend
+
+# Measures the cache hit rate of N worker processes with private caches versus one shared CacheServer.
+# The "database" is a stand-in that builds a result of a fixed size after a short delay.
+
+
+def stand_in_lookup(key, payload_bytes, latency):
+    time.sleep(latency)
+    return {'query': key, 'results': 'x' * payload_bytes}
+
+
+def zipf_weights(distinct_keys, skew):
+    return [1 / (rank ** skew) for rank in range(1, distinct_keys + 1)]
+
+
+def run_worker(mode, address, authkey, requests, options, seed, result_queue):
+    if mode == 'shared':
+        backend = SocketBackend('harness', {'capacity': options['capacity']}, address=address,
+                                authkey=authkey)
+        cache = LRUCacheWithTTL(capacity=options['capacity'], checkpoint_file=None, backend=backend)
+    else:
+        cache = LRUCacheWithTTL(capacity=options['capacity'], checkpoint_file=None)
+    rng = random.Random(seed)
+    keys = [f"query-{i}" for i in range(options['distinct_keys'])]
+    weights = zipf_weights(options['distinct_keys'], options['skew'])
+    hits = 0
+    started = time.perf_counter()
+    for key in rng.choices(keys, weights=weights, k=requests):
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache.put(key, stand_in_lookup(key, options['payload_bytes'], options['latency']))
+    result_queue.put((hits, requests, time.perf_counter() - started))
+
+
+def run_trial(mode, workers, address, options, authkey=None):
+    result_queue = multiprocessing.Queue()
+    per_worker = options['requests'] // workers
+    processes = [multiprocessing.Process(target=run_worker,
+                                         args=(mode, address, authkey, per_worker, options, seed, result_queue))
+                 for seed in range(workers)]
+    for process in processes:
+        process.start()
+    results = [result_queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    hits = sum(r[0] for r in results)
+    total = sum(r[1] for r in results)
+    return {'mode': mode, 'workers': workers, 'requests': total, 'hit_rate': hits / total if total else 0.0,
+            'seconds': max(r[2] for r in results)}
+
+
+def start_server(address, authkey):
+    server = CacheServer(address, authkey, checkpoint_file=None)
+    process = multiprocessing.Process(target=server.serve_forever, daemon=True)
+    process.start()
+    deadline = time.time() + 10
+    while not os.path.exists(address) and time.time() < deadline:
+        time.sleep(0.05)
+    return process
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare cache hit rates of private and shared caches")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--requests', type=int, default=20000, help="Total requests split over the workers")
+    parser.add_argument('--distinct-keys', type=int, default=5000)
+    parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the query popularity")
+    parser.add_argument('--capacity', type=int, default=500, help="Cache entries per worker cache")
+    parser.add_argument('--payload-bytes', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds per stand-in database lookup")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    options = {'requests': args.requests, 'distinct_keys': args.distinct_keys, 'skew': args.skew,
+               'capacity': args.capacity, 'payload_bytes': args.payload_bytes, 'latency': args.latency}
+    authkey = secrets.token_bytes(32)  # Handed to the server and the workers of this run
+    trials = []
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in args.workers:
+            trials.append(run_trial('private', workers, None, options))
+            # Fresh server per trial so every run starts cold
+            address = os.path.join(directory, f"cache-{workers}.sock")
+            server_process = start_server(address, authkey)
+            try:
+                trials.append(run_trial('shared', workers, address, options, authkey))
+            finally:
+                server_process.terminate()
+                server_process.join()
+
+    for trial in trials:
+        print(f"{trial['mode']:>8} workers={trial['workers']:<3} hit_rate={trial['hit_rate']:.3f} "
+              f"time={trial['seconds']:.2f}s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': options, 'trials': trials}, f, indent=2)
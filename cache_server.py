@@ -0,0 +1,204 @@
+import argparse
+import logging
+import os
+import secrets
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from multiprocessing import AuthenticationError
+from cache import CacheBackend, NamespacedCache
+
+logger = logging.getLogger(__name__)
+
+# Messages are pickles, so only processes holding the key may connect, and only this user can reach the
+# socket and read the key: both live in a directory private to the user
+DEFAULT_DIRECTORY = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                                 f'tweeter-cache-{os.getuid()}')
+DEFAULT_ADDRESS = os.path.join(DEFAULT_DIRECTORY, 'cache.sock')
+DEFAULT_KEY_FILE = os.path.join(DEFAULT_DIRECTORY, 'authkey')
+
+
+def private_directory(path):
+    """Create path for this user only, refusing one that another user owns or can enter."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must belong to this user and be closed to others (mode 0700)")
+    return path
+
+
+def check_private_file(path):
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must belong to this user and be closed to others (mode 0600)")
+
+
+def load_authkey(key_file=None, create=False):
+    """Shared secret from TWEETER_CACHE_AUTHKEY or a key file only this user can read; there is no default.
+
+    With create=True (the server) a random key is written to the key file when it doesn't exist yet, the
+    workers then read the same file.
+    """
+    key = os.environ.get('TWEETER_CACHE_AUTHKEY')
+    if key:
+        return key.encode()
+    key_file = key_file or os.environ.get('TWEETER_CACHE_KEY_FILE') or DEFAULT_KEY_FILE
+    if create and not os.path.exists(key_file):
+        if key_file == DEFAULT_KEY_FILE:
+            private_directory(DEFAULT_DIRECTORY)
+        descriptor = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, 'w') as f:
+            f.write(secrets.token_hex(32))
+    check_private_file(key_file)
+    with open(key_file) as f:
+        key = f.read().strip()
+    if not key:
+        raise ValueError(f"{key_file} is empty")
+    return key.encode()
+
+
+class CacheServer:
+    """One NamespacedCache shared by every worker process on the host, served over a local socket."""
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, ttl=3600, checkpoint_file='cache_checkpoint.pkl'):
+        self.address = address
+        self.authkey = authkey or load_authkey(create=True)
+        # Only the server checkpoints, so workers no longer overwrite each other's files
+        self.caches = NamespacedCache({}, ttl=ttl, checkpoint_file=checkpoint_file, lazy_load=True)
+        self.listener = None
+
+    def handle(self, connection):
+        try:
+            while True:
+                request = connection.recv()
+                operation, name = request[0], request[1]
+                if operation == 'open':
+                    self.caches.namespace(name, request[2])
+                    connection.send(True)
+                elif operation == 'get':
+                    connection.send(self.caches[name].get(request[2]))
+                elif operation == 'get_many':
+                    connection.send(self.caches[name].get_many(request[2]))
+                elif operation == 'get_entry':
+                    connection.send(self.caches[name].get_entry(request[2]))
+                elif operation == 'put':
+                    self.caches[name].put(request[2], request[3])  # No reply, puts are fire-and-forget
+                elif operation == 'put_many':
+                    self.caches[name].put_many(request[2])
+                elif operation == 'stats':
+                    connection.send(self.caches[name].stats())
+        except (EOFError, OSError):
+            pass  # Worker went away
+        except Exception as e:
+            logger.warning("Dropping cache client after a bad request: %s", e)
+        finally:
+            connection.close()
+
+    def serve_forever(self):
+        if self.address == DEFAULT_ADDRESS:
+            private_directory(DEFAULT_DIRECTORY)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)  # Stale socket from an earlier run
+        # Created 0600 rather than chmod after binding, so the socket is never open to other users
+        umask = os.umask(0o177)
+        try:
+            self.listener = Listener(self.address, authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)
+        print(f"Cache server listening on {self.address}")
+        while True:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError as e:
+                logger.warning("Rejected cache client: %s", e)
+                continue
+            except OSError:
+                break  # Listener closed
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+
+
+class SocketBackend(CacheBackend):
+    """Client side of CacheServer, one connection per thread and process."""
+
+    def __init__(self, namespace, budget, address=DEFAULT_ADDRESS, authkey=None, retry_interval=5):
+        self.namespace = namespace
+        self.budget = budget
+        self.address = address
+        self.authkey = authkey
+        self.retry_interval = retry_interval
+        self.local = threading.local()
+        self.down_until = 0
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        # A connection inherited through fork belongs to the parent process
+        if connection is None or self.local.pid != os.getpid():
+            if self.authkey is None:
+                self.authkey = load_authkey()  # Written by the server, so read on first use
+            connection = Client(self.address, authkey=self.authkey)
+            connection.send(('open', self.namespace, self.budget))
+            connection.recv()
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return connection
+
+    def call(self, request, reply=True):
+        if time.time() < self.down_until:
+            return None  # Server recently unreachable, behave like an empty cache
+        try:
+            connection = self.connection()
+            connection.send(request)
+            return connection.recv() if reply else None
+        except (OSError, EOFError, AuthenticationError, ValueError) as e:
+            logger.warning("Cache server %s unavailable: %s", self.address, e)
+            self.local.connection = None
+            self.down_until = time.time() + self.retry_interval
+            return None
+
+    def get(self, key):
+        return self.call(('get', self.namespace, key))
+
+    def get_entry(self, key):
+        return self.call(('get_entry', self.namespace, key)) or (None, False)
+
+    def get_many(self, keys):
+        return self.call(('get_many', self.namespace, list(keys))) or {}
+
+    def put(self, key, value):
+        self.call(('put', self.namespace, key, value), reply=False)
+
+    def put_many(self, items):
+        self.call(('put_many', self.namespace, list(items)), reply=False)
+
+    def stats(self):
+        return self.call(('stats', self.namespace)) or {}
+
+
+def socket_backend_factory(address=DEFAULT_ADDRESS, authkey=None):
+    """backend_factory for NamespacedCache connecting every namespace to a CacheServer."""
+    return lambda name, budget: SocketBackend(name, budget, address=address, authkey=authkey)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Shared cache server for the search service workers")
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help="Unix socket path")
+    parser.add_argument('--key-file', help="Key file shared with the workers, created when missing "
+                                           "(default TWEETER_CACHE_KEY_FILE, or authkey next to the default socket)")
+    parser.add_argument('--ttl', type=int, default=3600)
+    parser.add_argument('--checkpoint', default='cache_checkpoint.pkl')
+    parser.add_argument('--checkpoint-interval', type=int, default=600)
+    args = parser.parse_args()
+
+    server = CacheServer(args.address, load_authkey(args.key_file, create=True), ttl=args.ttl,
+                         checkpoint_file=args.checkpoint)
+    checkpoint_thread = threading.Thread(
+        target=server.caches.periodic_checkpoint, args=(args.checkpoint_interval,))
+    checkpoint_thread.daemon = True
+    checkpoint_thread.start()
+    server.serve_forever()
@@ -0,0 +1,356 @@
+import bisect
+import heapq
+import itertools
+import operator
+import os
+import pickle
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from ranking import SCORING_FORMULAS, formula_weights, rank_key, decode_cursor
+
+# Fields ranking needs, everything else stays in MongoDB
+COUNT_FIELDS = ('retweet_count', 'favorite_count', 'reply_count', 'quote_count')
+HOT_FIELDS = ('tweet_id', 'user_id', 'created_at', 'hashtags.text') + COUNT_FIELDS
+
+ID_DIGITS = 19  # Twitter ids fit in 19 digits, and so in an unsigned 64-bit column
+EPOCH = datetime(1970, 1, 1)
+NO_TIME = -2 ** 63  # created_at of tweets without one, outside every time range
+BITMAP_CACHE_SIZE = 64  # Hashtag bitmaps kept between queries
+
+# The store only ranks filters with a posting list, and only up to MAX_CANDIDATES matching rows; MongoDB's
+# (field, tweet_id) indexes answer unfiltered and time range top-K faster than scoring every row here
+SELECTIVE_FIELDS = ('hashtags.text', 'user_id', 'tweet_id')
+MAX_CANDIDATES = 50000
+
+# Seconds of tweets read again by add_new_from_collection, ObjectIds from different writers are only ordered
+# by their timestamp
+OBJECT_ID_OVERLAP = 60
+
+
+def id_key(tweet_id):
+    """(digits right-padded with zeros, length): ordered like the tweet_id strings MongoDB sorts."""
+    tweet_id = str(tweet_id)
+    if not tweet_id.isdigit() or len(tweet_id) > ID_DIGITS:
+        raise ValueError(f"Unsupported tweet_id {tweet_id!r}")
+    return int(tweet_id.ljust(ID_DIGITS, '0')), len(tweet_id)
+
+
+def id_string(padded, length):
+    return f"{padded:0{ID_DIGITS}d}"[:length]
+
+
+# Milliseconds since the epoch, truncated like BSON dates; naive datetimes are UTC as MongoDB returns them
+def epoch_millis(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
+
+def bitmap(rows, size):
+    bits = bytearray((size >> 3) + 1)
+    for row in rows:
+        bits[row >> 3] |= 1 << (row & 7)
+    return bits
+
+
+class HotTweetStore:
+    """Ranking columns of every tweet, so selective top-K queries are answered without MongoDB.
+
+    A tweet is one row of fixed-width columns: its id as a number, created_at in milliseconds and the
+    four engagement counts, plus the composite formula scores. Hashtags and users are interned into
+    posting lists of rows. rank() mirrors ranking_pipeline for the filters it understands and returns
+    (tweet_id, score) pairs; the documents of the page are then fetched by id.
+
+    Like TopMetrics, the loader maintains it and saves it next to the data, and search_service swaps in
+    each saved version. The service also adds new tweets to the store it reads: add holds the lock,
+    rank only while it collects the candidate rows, so scoring runs concurrently.
+    """
+
+    def __init__(self):
+        self.ids = array('Q')  # Padded tweet_id digits
+        self.id_lengths = array('B')
+        self.created = array('q')
+        self.counts = {field: array('I') for field in COUNT_FIELDS}
+        # Weighted sums kept per composite formula, so ranking on them is a column lookup too
+        self.scores = {name: array('q') for name, weights in SCORING_FORMULAS.items() if len(weights) > 1}
+        self.hashtags = {}  # tag -> array of rows
+        self.users = {}  # user_id -> array of rows
+        # tweet_id lookup: ids and rows sorted by id, plus the rows added since they were last sorted
+        self.sorted_ids = array('Q')
+        self.sorted_rows = array('I')
+        self.recent = {}  # tweet_id -> row
+        # Rows by created_at, re-sorted on the next time range query when a tweet arrives out of order
+        self.time_rows = array('I')
+        self.time_values = array('q')
+        self.time_sorted = True
+        self.bitmaps = OrderedDict()  # tag -> (rows covered, bitmap)
+        self.newest_object_id = None  # Highest _id added, where add_new_from_collection continues
+        self.lock = threading.Lock()
+        self.saved_at = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['bitmaps'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('newest_object_id', None)  # Saved before it was tracked
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def lookup(self, tweet_id):
+        """Row of a tweet_id, None when it isn't stored."""
+        tweet_id = str(tweet_id)
+        row = self.recent.get(tweet_id)
+        if row is not None:
+            return row
+        try:
+            padded, length = id_key(tweet_id)
+        except ValueError:
+            return None
+        position = bisect.bisect_left(self.sorted_ids, padded)
+        while position < len(self.sorted_ids) and self.sorted_ids[position] == padded:
+            row = self.sorted_rows[position]
+            if self.id_lengths[row] == length:
+                return row
+            position += 1
+        return None
+
+    # Insert a tweet document, or refresh the counts of one already stored
+    def add(self, document):
+        tweet_id = str(document['tweet_id'])
+        object_id = document.get('_id')
+        if object_id is not None and (self.newest_object_id is None or object_id > self.newest_object_id):
+            self.newest_object_id = object_id
+        counts = [document.get(field) or 0 for field in COUNT_FIELDS]
+        row = self.lookup(tweet_id)
+        if row is not None:
+            for field, count in zip(COUNT_FIELDS, counts):
+                self.counts[field][row] = count
+            self.update_scores(row, counts)
+            return row
+
+        row = len(self.ids)
+        padded, length = id_key(tweet_id)
+        self.ids.append(padded)
+        self.id_lengths.append(length)
+        created_at = document.get('created_at')
+        created = NO_TIME if created_at is None else epoch_millis(created_at)
+        self.created.append(created)
+        for field, count in zip(COUNT_FIELDS, counts):
+            self.counts[field].append(count)
+        for scores in self.scores.values():
+            scores.append(0)
+        self.update_scores(row, counts)
+        for tag in {hashtag['text'] for hashtag in document.get('hashtags') or []}:
+            self.hashtags.setdefault(tag, array('I')).append(row)
+        if document.get('user_id') is not None:
+            self.users.setdefault(str(document['user_id']), array('I')).append(row)
+
+        if self.time_values and created < self.time_values[-1]:
+            self.time_sorted = False
+        self.time_rows.append(row)
+        self.time_values.append(created)
+
+        self.recent[tweet_id] = row
+        if len(self.recent) > max(4096, len(self.sorted_ids) // 8):
+            self.sort_ids()
+        return row
+
+    def add_many(self, documents):
+        with self.lock:
+            for document in documents:
+                self.add(document)
+
+    def add_from_collection(self, collection, batch_size=10000):
+        projection = dict.fromkeys(HOT_FIELDS, 1)  # With _id, for add_new_from_collection
+        with self.lock:
+            for document in collection.find({}, projection).batch_size(batch_size):
+                self.add(document)
+        return self
+
+    def add_new_from_collection(self, collection, batch_size=10000):
+        """Add the tweets inserted since the newest _id in the store, None when it has no _id to go on.
+
+        Tweets replaced in place keep their _id, so their new counts are not picked up here.
+        """
+        if self.newest_object_id is None:
+            return None
+        since = ObjectId.from_datetime(self.newest_object_id.generation_time - timedelta(seconds=OBJECT_ID_OVERLAP))
+        projection = dict.fromkeys(HOT_FIELDS, 1)
+        added = 0
+        for document in collection.find({'_id': {'$gte': since}}, projection).batch_size(batch_size):
+            with self.lock:  # Per tweet, so searches don't wait for the whole read
+                self.add(document)
+            added += 1
+        return added
+
+    def update_scores(self, row, counts):
+        values = dict(zip(COUNT_FIELDS, counts))
+        for name, scores in self.scores.items():
+            scores[row] = sum(values[field] * weight for field, weight in SCORING_FORMULAS[name].items())
+
+    def sort_ids(self):
+        order = sorted(range(len(self.ids)), key=lambda row: (self.ids[row], self.id_lengths[row]))
+        self.sorted_ids = array('Q', (self.ids[row] for row in order))
+        self.sorted_rows = array('I', order)
+        self.recent = {}
+
+    def sort_times(self):
+        order = sorted(range(len(self.created)), key=self.created.__getitem__)
+        self.time_rows = array('I', order)
+        self.time_values = array('q', (self.created[row] for row in order))
+        self.time_sorted = True
+
+    def hashtag_bitmap(self, tag):
+        rows = self.hashtags[tag]
+        entry = self.bitmaps.get(tag)
+        if entry is None or entry[0] != len(rows):  # Rebuilt once the tag gained rows
+            entry = (len(rows), bitmap(rows, len(self.ids)))
+            self.bitmaps[tag] = entry
+            if len(self.bitmaps) > BITMAP_CACHE_SIZE:
+                self.bitmaps.popitem(last=False)
+        self.bitmaps.move_to_end(tag)
+        return entry[1]
+
+    def filter_rows(self, query_filter):
+        """Rows matching a build_query_filter filter, None when it has a condition the store can't evaluate.
+
+        The shortest posting list drives, hashtags are checked against bitmaps, the other posting
+        lists against sets; a time range alone is a slice of the rows sorted by created_at.
+        """
+        postings, start, end = [], None, None
+        for field, condition in query_filter.items():
+            if field == 'hashtags.text':
+                if isinstance(condition, str):
+                    condition = {'$all': [condition]}
+                if not isinstance(condition, dict) or set(condition) != {'$all'}:
+                    return None
+                for tag in condition['$all']:
+                    if tag not in self.hashtags:
+                        return []
+                    postings.append(('hashtag', tag, self.hashtags[tag]))
+            elif field == 'user_id' and isinstance(condition, str):
+                postings.append(('rows', None, self.users.get(condition, ())))
+            elif field == 'tweet_id' and isinstance(condition, dict) and set(condition) == {'$in'}:
+                rows = {self.lookup(tweet_id) for tweet_id in condition['$in']} - {None}
+                postings.append(('rows', None, sorted(rows)))
+            elif field == 'created_at' and isinstance(condition, dict) and set(condition) <= {'$gte', '$lte'}:
+                if '$gte' in condition:
+                    start = epoch_millis(condition['$gte'])
+                if '$lte' in condition:
+                    end = epoch_millis(condition['$lte'])
+            else:
+                return None
+
+        if not postings:
+            if start is None and end is None:
+                return range(len(self.ids))
+            if not self.time_sorted:
+                self.sort_times()
+            low = 0 if start is None else bisect.bisect_left(self.time_values, start)
+            high = len(self.time_values) if end is None else bisect.bisect_right(self.time_values, end)
+            return self.time_rows[low:high]
+
+        driver = min(range(len(postings)), key=lambda index: len(postings[index][2]))
+        rows = postings[driver][2]
+        for index, (kind, tag, other_rows) in enumerate(postings):
+            if index == driver:
+                continue
+            if kind == 'hashtag':
+                bits = self.hashtag_bitmap(tag)
+                rows = [row for row in rows if bits[row >> 3] >> (row & 7) & 1]
+            else:
+                members = set(other_rows)
+                rows = [row for row in rows if row in members]
+        if start is not None or end is not None:
+            created = self.created
+            start = NO_TIME + 1 if start is None else start
+            end = 2 ** 63 - 1 if end is None else end
+            rows = [row for row in rows if start <= created[row] <= end]
+        return rows
+
+    def score_function(self, weights, key):
+        """Score of a row for a ranking: a count column, a composite column, or computed for custom weights."""
+        if key != 'rank_score':
+            return self.counts[key].__getitem__ if key in self.counts else None
+        for name, scores in self.scores.items():
+            if SCORING_FORMULAS[name] == weights:
+                return scores.__getitem__
+        if not set(weights) <= set(self.counts):
+            return None
+        columns = [(self.counts[field], weight) for field, weight in weights.items()]
+        return lambda row: sum(column[row] * weight for column, weight in columns)
+
+    def rank(self, query_filter, formula='retweets', limit=50, after=None):
+        """[(tweet_id, score)] in ranking_pipeline's order, None when the store can't answer the query.
+
+        The score is the value of rank_key: the count itself for a single field, the weighted sum
+        for a composite formula.
+        """
+        if '$text' in query_filter:
+            return None  # Relevance comes from MongoDB's text index
+        if not any(field in query_filter for field in SELECTIVE_FIELDS):
+            return None
+        weights = formula_weights(formula)
+        key = rank_key(formula)
+        score = self.score_function(weights, key)
+        if score is None:
+            return None
+        with self.lock:
+            rows = self.filter_rows(query_filter)
+            if rows is None or len(rows) > MAX_CANDIDATES:
+                return None
+            rows = list(rows)  # Posting lists keep growing while the rows are scored
+            ids, lengths = self.ids, self.id_lengths
+        # Rows are only appended and counts overwritten in place, so these rows stay valid without the lock
+        if after:
+            cursor_key, value, tweet_id = decode_cursor(after)
+            if cursor_key != key:
+                raise ValueError("Cursor does not match the ranking")
+            position = id_key(tweet_id)
+            rows = [row for row in rows if (score(row), ids[row], lengths[row]) < (value, *position)]
+        # The limit-th best score over a plain list of values, then the tweet_id tie-break only among
+        # the rows reaching it
+        values = list(map(score, rows))
+        top = heapq.nlargest(limit, values)
+        if top:
+            rows = itertools.compress(rows, map(operator.le, itertools.repeat(top[-1]), values))
+        top = heapq.nlargest(limit, rows, key=lambda row: (score(row), ids[row], lengths[row]))
+        return [(id_string(ids[row], lengths[row]), score(row)) for row in top]
+
+    def stats(self):
+        """Rows, distinct hashtags and users, and the bytes held by columns and posting lists."""
+        columns = [self.ids, self.id_lengths, self.created, self.sorted_ids, self.sorted_rows, self.time_rows,
+                   self.time_values, *self.counts.values(), *self.scores.values()]
+        postings = [*self.hashtags.values(), *self.users.values()]
+        column_bytes = sum(column.itemsize * len(column) for column in columns)
+        posting_bytes = sum(rows.itemsize * len(rows) for rows in postings)
+        return {'tweets': len(self.ids), 'hashtags': len(self.hashtags), 'users': len(self.users),
+                'column_bytes': column_bytes, 'posting_bytes': posting_bytes,
+                'bytes_per_tweet': (column_bytes + posting_bytes) / max(len(self.ids), 1)}
+
+    def save(self, path):
+        temp_path = path + '.tmp'
+        with self.lock, open(temp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.saved_at = time.time()
+
+    # Save during long loads so the service sees progress, at most once per interval
+    def save_every(self, path, interval=10):
+        if path and time.time() - self.saved_at >= interval:
+            self.save(path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
@@ -0,0 +1,118 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from mongo_database import collect_tweet_documents, write_tweet_batch, report_ingest_rate, reset_database, save_metrics
+from top_metrics import TopMetrics
+import instrumentation
+from mysql_database import create_users_database, user_row, write_user_batch
+from config import *
+
+
+# Sink thread: drain batches from a bounded queue into one database until the stop signal. After a failed
+# batch it records the error and only drains, so the reader sees it and stops instead of blocking
+def run_sink(name, batch_queue, write_batch, totals, failures):
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            break
+        if failures:
+            continue
+        try:
+            totals[name] += write_batch(batch)
+        except Exception as e:
+            print(f"{name} sink failed to write a batch: {e}")
+            failures.append(e)
+
+
+# Read and parse the dataset once, feeding tweet documents to MongoDB and user rows to MySQL concurrently
+def load_dataset(file_path, db_connection, batch_size=1000, queue_size=4, metrics=None, metrics_file=None):
+    start_time = time.time()
+    mongo_queue = queue.Queue(maxsize=queue_size)
+    mysql_queue = queue.Queue(maxsize=queue_size)
+    totals = {'mongo': 0, 'mysql': 0}
+    failures = []
+
+    def write_users(rows):
+        written = write_user_batch(db_connection, rows)
+        if rows and not written:
+            raise RuntimeError(f"Failed to write a batch of {len(rows)} users")
+        db_connection.commit()
+        return written
+
+    sinks = [
+        threading.Thread(target=run_sink,
+                         args=('mongo', mongo_queue, lambda batch: write_tweet_batch(*batch), totals, failures)),
+        threading.Thread(target=run_sink, args=('mysql', mysql_queue, write_users, totals, failures)),
+    ]
+    for sink in sinks:
+        sink.start()
+
+    lines = 0
+    documents, hashtag_ids, seen_ids, users = [], {}, set(), {}
+    try:
+        with open(file_path, 'r') as file:
+            for line_number, line in enumerate(file, 1):
+                if failures:
+                    break
+                if not line.strip():  # Skip empty lines
+                    continue
+                try:
+                    tweet = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"Error decoding JSON on line {line_number}: {e}")
+                    continue
+                lines += 1
+                try:
+                    collect_tweet_documents(tweet, documents, hashtag_ids, seen_ids, metrics)
+                    users[tweet['user']['id_str']] = tweet['user']
+                except KeyError:
+                    continue  # Skip lines missing expected keys
+                if len(documents) >= batch_size:
+                    mongo_queue.put((documents, hashtag_ids))
+                    save_metrics(metrics, metrics_file)
+                    documents, hashtag_ids, seen_ids = [], {}, set()
+                if len(users) >= batch_size:
+                    mysql_queue.put([row for row in map(user_row, users.values()) if row])
+                    users = {}
+        if not failures:
+            mongo_queue.put((documents, hashtag_ids))
+            mysql_queue.put([row for row in map(user_row, users.values()) if row])
+    finally:
+        mongo_queue.put(None)
+        mysql_queue.put(None)
+        for sink in sinks:
+            sink.join()
+    if failures:
+        raise failures[0]
+
+    report_ingest_rate(totals['mongo'], lines, start_time)
+    print(f"Upserted {totals['mysql']} users")
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load the dataset into MongoDB and MySQL in a single pass")
+    parser.add_argument('--file', default=data_path, help="JSONL file with one tweet per line")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Tweets or users per bulk write")
+    parser.add_argument('--queue-size', type=int, default=4, help="Batches buffered per sink")
+    parser.add_argument('--top-metrics', help="Also maintain the top metrics and save them to this file")
+    parser.add_argument('--ingest-metrics', help="Write ingest rates in the Prometheus text format to this file")
+    args = parser.parse_args()
+
+    if args.ingest_metrics:
+        instrumentation.metrics.write_textfile_every(args.ingest_metrics)
+
+    db_connection = create_users_database()
+    reset_database()
+    metrics = TopMetrics() if args.top_metrics else None
+    try:
+        load_dataset(args.file, db_connection, batch_size=args.batch_size, queue_size=args.queue_size,
+                     metrics=metrics, metrics_file=args.top_metrics)
+    finally:
+        db_connection.close()
+    if metrics is not None:
+        metrics.save(args.top_metrics)
+    if args.ingest_metrics:
+        instrumentation.metrics.write_textfile(args.ingest_metrics)
@@ -0,0 +1,218 @@
+import bisect
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# Seconds, from a cached lookup to a slow aggregation
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts values above every bucket
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Counters, gauges and histograms of one process, rendered in the Prometheus text format.
+
+    Values other components already count, like cache hits, are read from collectors at scrape time
+    instead of being counted twice.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.collectors = []  # callables returning (name, type, labels, value) samples
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self):
+        families = {}  # name -> (type, lines), in order of first appearance
+        with self.lock:
+            counters, gauges, histograms = list(self.counters.items()), list(self.gauges.items()), \
+                list(self.histograms.items())
+        samples = [(name, 'counter', labels, value) for (name, labels), value in counters]
+        samples += [(name, 'gauge', labels, value) for (name, labels), value in gauges]
+        for collect in self.collectors:
+            try:
+                samples += [(name, kind, tuple(sorted(labels.items())), value)
+                            for name, kind, labels, value in collect()]
+            except Exception as e:
+                print(f"An error occurred collecting metrics: {e}")
+        for name, kind, labels, value in samples:
+            families.setdefault(name, (kind, []))[1].append(f"{name}{format_labels(labels)} {format_value(value)}")
+        for (name, labels), histogram in histograms:
+            counts, total, count = histogram.snapshot()
+            lines = families.setdefault(name, ('histogram', []))[1]
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', format_value(bound))])} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        output = []
+        for name, (kind, lines) in families.items():
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+    # For loaders: a file node_exporter's textfile collector or the service's /metrics can pick up
+    def write_textfile(self, path):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+    def write_textfile_every(self, path, interval=10):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_textfile(path)
+                except OSError as e:
+                    print(f"An error occurred writing {path}: {e}")
+
+        thread = threading.Thread(target=run, daemon=True)  # Not inherited by forked loader processes
+        thread.start()
+        return thread
+
+
+metrics = Metrics()
+
+
+class RequestStats:
+    """Round trips of one request and, when it is sampled, the duration of each stage."""
+
+    __slots__ = ('started', 'round_trips', 'trace')
+
+    def __init__(self, sampled=False):
+        self.started = time.perf_counter()
+        self.round_trips = Counter()  # database -> round trips
+        self.trace = [] if sampled else None  # (stage, seconds)
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+# Fraction of requests answered with a Server-Timing header, clients can ask for one with X-Trace: 1
+trace_sample_rate = float(os.environ.get('TWEETER_TRACE_SAMPLE_RATE', '0'))
+
+
+def begin_request(trace_requested=False):
+    sampled = trace_requested or (trace_sample_rate > 0 and random.random() < trace_sample_rate)
+    stats = RequestStats(sampled)
+    return stats, current_request.set(stats)
+
+
+def end_request(stats, token, endpoint, status):
+    current_request.reset(token)
+    metrics.observe('tweeter_request_seconds', time.perf_counter() - stats.started, endpoint=endpoint)
+    metrics.inc('tweeter_requests_total', endpoint=endpoint, status=status)
+    for database in ('mongo', 'mysql'):
+        metrics.histogram('tweeter_request_round_trips', ROUND_TRIP_BUCKETS, database=database).observe(
+            stats.round_trips[database])
+
+
+def trace_header(stats):
+    """Server-Timing value of a sampled request, None otherwise."""
+    if stats.trace is None:
+        return None
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in stats.trace]
+    entries += [f"{database};desc=\"{count} round trips\"" for database, count in sorted(stats.round_trips.items())]
+    entries.append(f"total;dur={(time.perf_counter() - stats.started) * 1000:.2f}")
+    return ', '.join(entries)
+
+
+def record_stage(name, seconds):
+    metrics.observe('tweeter_stage_seconds', seconds, stage=name)
+    stats = current_request.get()
+    if stats is not None and stats.trace is not None:
+        stats.trace.append((name, seconds))
+
+
+@contextmanager
+def stage(name):
+    """Time a block into the per-stage histogram, and into the request's trace when it is sampled."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def record_round_trip(database, seconds=None, operation=None):
+    metrics.inc('tweeter_db_round_trips_total', database=database)
+    if seconds is not None:
+        metrics.observe('tweeter_db_seconds', seconds, database=database, operation=operation)
+    stats = current_request.get()
+    if stats is not None:
+        stats.round_trips[database] += 1
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Counts and times every command the MongoDB driver sends, in the thread that sent it."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record_round_trip('mongo', event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        record_round_trip('mongo', event.duration_micros / 1e6, event.command_name)
+        metrics.inc('tweeter_db_errors_total', database='mongo')
@@ -0,0 +1,75 @@
+import datetime
+import json
+from bson import ObjectId
+
+# JSON encoding of search responses, either in one piece or streamed a chunk at a time so a large
+# page of results never has to be serialized in memory as a whole.
+
+DAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+CHUNK_SIZE = 64 * 1024  # Characters buffered before a chunk is sent
+
+
+def http_date(value):
+    """RFC 1123 date as Flask's jsonify writes it, naive datetimes being UTC like MongoDB returns them."""
+    if type(value) is datetime.date:
+        value = datetime.datetime.combine(value, datetime.time())
+    elif value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return (f"{DAY_NAMES[value.weekday()]}, {value.day:02d} {MONTH_NAMES[value.month - 1]} {value.year:04d} "
+            f"{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT")
+
+
+# Encoders by exact type, looked up before falling back to isinstance for subclasses
+ENCODERS = {datetime.datetime: http_date, datetime.date: http_date, ObjectId: str}
+
+
+def encode_value(value):
+    encode = ENCODERS.get(type(value))
+    if encode is not None:
+        return encode(value)
+    for value_type, encode in ENCODERS.items():
+        if isinstance(value, value_type):
+            return encode(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Same separators and key order as Flask's jsonify, on the C encoder
+dumps = json.JSONEncoder(default=encode_value, sort_keys=True, separators=(',', ':')).encode
+
+
+def iter_json(parts, chunk_size=CHUNK_SIZE):
+    """The /search response object for (key, value) parts, 'result' parts written one by one into "results".
+
+    The opening is sent before the first part is computed, then a chunk every chunk_size characters.
+    """
+    yield '{"results":['
+    buffer, size, in_results, first = [], 0, True, True
+    for key, value in parts:
+        if key == 'result':
+            text = dumps(value) if first else ',' + dumps(value)
+            first = False
+        else:
+            text = f'{"]" if in_results else ""},"{key}":{dumps(value)}'
+            in_results = False
+        buffer.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    buffer.append(']}' if in_results else '}')
+    yield ''.join(buffer)
+
+
+def iter_ndjson(parts, chunk_size=CHUNK_SIZE):
+    """One {key: value} object per line: a line per result, then next_cursor and the categories."""
+    buffer, size, first = [], 0, True
+    for key, value in parts:
+        line = dumps({key: value}) + '\n'
+        buffer.append(line)
+        size += len(line)
+        if first or size >= chunk_size:  # The first line goes out as soon as it is ready
+            yield ''.join(buffer)
+            buffer, size, first = [], 0, False
+    if buffer:
+        yield ''.join(buffer)
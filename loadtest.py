@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import json
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+# Compares the threaded Flask app (api.py) with the asyncio serving mode (async_api.py) under the same
+# concurrent load. Each server runs in its own process against in-process stand-ins for MongoDB and
+# MySQL that add a fixed latency per round trip, see stand_ins.py.
+
+
+def serve(app_name, port, tweets, users, latency, deadline):
+    import stand_ins
+    stand_ins.install_config()  # search_service imports config, which a clean checkout doesn't have
+    import search_service
+    documents, user_rows = stand_ins.make_dataset(tweets, users)
+    stand_ins.install(search_service, documents, user_rows, latency)
+    # Warm like a service whose metrics refresh already ran
+    search_service.metrics_cache.put('top_metrics', search_service.calculate_top_metrics())
+    if app_name == 'flask':
+        from api import app
+        app.run(port=port, threaded=True)
+    else:
+        from aiohttp import web
+        from async_api import create_app
+        web.run_app(create_app(deadline), host='127.0.0.1', port=port, print=None)
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def random_request(rng, options):
+    """A request of the mix: mostly searches over a wide key space, some tweet lookups and metrics."""
+    kind = rng.random()
+    if kind < 0.7:
+        start = options['start'] + timedelta(minutes=rng.randrange(options['tweets']))
+        payload = {'query_string': f"word{rng.randrange(500)}",
+                   'start_time': start.isoformat(), 'end_time': (start + timedelta(days=2)).isoformat(),
+                   'rank_by': rng.choice(['retweets', 'favorites', 'engagement'])}
+        if rng.random() < 0.3:
+            payload['user'] = f"user{rng.randint(1, options['users'])}"
+        return 'search', 'POST', '/search', payload
+    if kind < 0.9:
+        return 'tweet', 'GET', f"/tweet/{rng.randint(1, options['tweets'])}", None
+    return 'top-metrics', 'GET', '/top-metrics', None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def drive(port, concurrency, requests, options, seed):
+    import aiohttp
+    rng = random.Random(seed)
+    plan = [random_request(rng, options) for _ in range(requests)]
+    latencies = {}
+    statuses = {}
+    timeout = aiohttp.ClientTimeout(total=60)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(f"http://127.0.0.1:{port}", timeout=timeout, connector=connector) as session:
+        async def client():
+            while plan:
+                kind, method, path, payload = plan.pop()
+                started = time.perf_counter()
+                try:
+                    async with session.request(method, path, json=payload) as response:
+                        await response.read()
+                        status = response.status
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    status = 'error'
+                latencies.setdefault(kind, []).append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    every = [latency for values in latencies.values() for latency in values]
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed,
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'latency': {kind: {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+                           'p99': percentile(values, 0.99)}
+                    for kind, values in sorted(latencies.items()) + [('all', every)]},
+    }
+
+
+def run_comparison(args):
+    from stand_ins import make_dataset
+    documents, _ = make_dataset(1, 1)
+    options = {'tweets': args.tweets, 'users': args.users, 'start': documents[0]['created_at']}
+    report = {'options': {key: value for key, value in vars(args).items() if key not in ('command', 'output')},
+              'runs': []}
+    directory = tempfile.mkdtemp()  # Servers run here so they don't restore or write cache checkpoints
+    for app_name in args.apps:
+        for concurrency in args.concurrency:
+            # Fresh server per run so every run starts with cold caches
+            port = args.port
+            server = subprocess.Popen([sys.executable, __file__, 'serve', '--app', app_name, '--port', str(port),
+                                       '--tweets', str(args.tweets), '--users', str(args.users),
+                                       '--latency', str(args.latency), '--deadline', str(args.deadline)],
+                                      cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not wait_for_port(port):
+                    print(f"{app_name} server did not start")
+                    continue
+                run = asyncio.run(drive(port, concurrency, args.requests, options, seed=concurrency))
+            finally:
+                server.terminate()
+                server.wait()
+            run['app'] = app_name
+            report['runs'].append(run)
+            latency = run['latency']['all']
+            print(f"{app_name:>6} concurrency={concurrency:<4} {run['requests_per_second']:8.1f} req/s "
+                  f"p50={latency['p50'] * 1000:7.1f}ms p95={latency['p95'] * 1000:7.1f}ms "
+                  f"p99={latency['p99'] * 1000:7.1f}ms statuses={run['statuses']}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load-test the Flask and asyncio serving modes")
+    parser.add_argument('command', nargs='?', default='compare', choices=['compare', 'serve'])
+    parser.add_argument('--app', default='async', choices=['flask', 'async'], help="App to serve")
+    parser.add_argument('--apps', nargs='+', default=['flask', 'async'], help="Apps to compare")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per run")
+    # Stand-in queries run on the server's own CPU, keep the collection small so latency dominates
+    parser.add_argument('--tweets', type=int, default=500, help="Tweets in the stand-in collection")
+    parser.add_argument('--users', type=int, default=200, help="Users in the stand-in table")
+    parser.add_argument('--latency', type=float, default=0.01, help="Seconds per stand-in database round trip")
+    parser.add_argument('--deadline', type=float, default=5.0, help="Per-request deadline of the asyncio app")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.app, args.port, args.tweets, args.users, args.latency, args.deadline)
+    else:
+        report = run_comparison(args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
@@ -1,6 +1,17 @@
-import pymongo
-from pymongo import MongoClient, TEXT
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+from pymongo import MongoClient, TEXT, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from mysql_database import *
+from twitter_dates import parse_twitter_datetime
+from text_index import InvertedIndex
+from top_metrics import TopMetrics
+from hot_store import HotTweetStore
+from ranking import ensure_ranking_indexes
+import instrumentation
 
 # Function to create a connection to MongoDB
 def create_mongo_connection(uri):
@@ -8,28 +19,33 @@ def create_mongo_connection(uri):
     return client
 
 
-# Connect to MongoDB
-mongo_client = MongoClient(mongo_config['uri'])
-
-# Check if the "TwitterData" database exists and drop it if it does
-if "TwitterData" in mongo_client.list_database_names():
-    mongo_client.drop_database(mongo_config['db'])
+# Connect to MongoDB on the first operation, importing the module opens no connection
+mongo_client = MongoClient(mongo_config['uri'], connect=False)
 
 twitter_db = mongo_client[mongo_config['db']]
 tweets_collection = twitter_db[mongo_config['tweets_collection']]
 hashtags_collection = twitter_db[mongo_config['hashtags_collection']]
 
-# Ensure indexes
-tweets_collection.create_index([("tweet_id", 1)], unique=True)
-tweets_collection.create_index([("hashtags.text", 1)])
-tweets_collection.create_index([("text", TEXT)])  # Text index for full-text search
-tweets_collection.create_index([("created_at", 1)])
+
+def ensure_indexes():
+    tweets_collection.create_index([("tweet_id", 1)], unique=True)
+    tweets_collection.create_index([("hashtags.text", 1)])
+    tweets_collection.create_index([("text", TEXT)])  # Text index for full-text search
+    tweets_collection.create_index([("created_at", 1)])
+    ensure_ranking_indexes(tweets_collection)  # Compound indexes for ranked search
+
+
+# Drop the "TwitterData" database for a full reload and recreate its indexes
+def reset_database():
+    if mongo_config['db'] in mongo_client.list_database_names():
+        mongo_client.drop_database(mongo_config['db'])
+    ensure_indexes()
 
 
 def parse_twitter_date(twitter_date):
     """Parse the Twitter date format to datetime object directly."""
     try:
-        return datetime.strptime(twitter_date, '%a %b %d %H:%M:%S %z %Y')
+        return parse_twitter_datetime(twitter_date)
     except ValueError as e:
         print(f"Date conversion error: {e}")
         return None
@@ -61,35 +77,445 @@ def create_tweet_document(tweet_data):
 
 def insert_tweet(tweet_data):
     tweet_document = create_tweet_document(tweet_data)
+    # Upsert keyed on tweet_id so reloading a tweet refreshes it instead of failing
+    tweets_collection.replace_one({"tweet_id": tweet_document["tweet_id"]}, tweet_document, upsert=True)
+    # Handle hashtag indexing
+    for hashtag in tweet_document["hashtags"]:
+        hashtags_collection.update_one(
+            {"text": hashtag["text"]},
+            {"$addToSet": {"tweet_ids": tweet_data['id']}},
+            upsert=True
+        )
+    # If it's a retweet, consider inserting the original tweet
+    if tweet_document['is_retweet'] and 'retweeted_status' in tweet_data:
+        original_tweet_data = tweet_data['retweeted_status']
+        insert_tweet(original_tweet_data)
+
+# Flatten a tweet and its retweeted original into the batch, skipping tweets already seen in it
+def collect_tweet_documents(tweet_data, documents, hashtag_ids, seen_ids, metrics=None):
+    if tweet_data['id_str'] in seen_ids:
+        return
+    seen_ids.add(tweet_data['id_str'])
+    tweet_document = create_tweet_document(tweet_data)
+    documents.append(tweet_document)
+    if metrics is not None:
+        metrics.add(tweet_document, tweet_data['user'])
+    for hashtag in tweet_document["hashtags"]:
+        hashtag_ids.setdefault(hashtag["text"], []).append(tweet_data['id'])
+    # Retweet originals go into the same batch instead of a recursive insert
+    if tweet_document['is_retweet'] and 'retweeted_status' in tweet_data:
+        collect_tweet_documents(tweet_data['retweeted_status'], documents, hashtag_ids, seen_ids, metrics)
+
+
+# Write one batch of tweet documents and their hashtag updates, returns the number of inserted tweets
+def write_tweet_batch(documents, hashtag_ids, tweets=None, hashtags=None, upsert=False):
+    tweets = tweets if tweets is not None else tweets_collection
+    hashtags = hashtags if hashtags is not None else hashtags_collection
+    started = time.perf_counter()
+    inserted = 0
+    if documents and upsert:
+        # Replace existing tweets keyed on tweet_id, counts both new and refreshed tweets
+        result = tweets.bulk_write([ReplaceOne({"tweet_id": document["tweet_id"]}, document, upsert=True)
+                                    for document in documents], ordered=False)
+        inserted = result.upserted_count + result.matched_count
+    elif documents:
+        try:
+            inserted = len(tweets.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            duplicates = sum(1 for error in write_errors if error.get('code') == 11000)
+            if duplicates != len(write_errors):
+                raise
+            inserted = e.details.get('nInserted', 0)
+            print(f"{duplicates} tweets already exist.")
+    if hashtag_ids:
+        # One upsert per distinct hashtag in the batch
+        hashtags.bulk_write([
+            UpdateOne({"text": tag}, {"$addToSet": {"tweet_ids": {"$each": ids}}}, upsert=True)
+            for tag, ids in hashtag_ids.items()
+        ], ordered=False)
+    instrumentation.metrics.observe('tweeter_ingest_batch_seconds', time.perf_counter() - started,
+                                    database='mongo')
+    instrumentation.metrics.inc('tweeter_ingest_tweets_total', inserted)
+    return inserted
+
+
+# Add the text of written tweets to the local inverted index
+def index_documents(text_index, documents):
+    if text_index is not None:
+        for document in documents:
+            text_index.add(document['tweet_id'], document['text'])
+
+
+# Keep the hot store in sync with what was written, saved now and then so the search service picks it up
+def store_documents(hot_store, documents, hot_store_file=None):
+    if hot_store is not None:
+        hot_store.add_many(documents)
+        hot_store.save_every(hot_store_file)
+
+
+def report_ingest_rate(inserted, lines, start_time):
+    elapsed = max(time.time() - start_time, 1e-9)
+    instrumentation.metrics.set('tweeter_ingest_lines', lines)
+    instrumentation.metrics.set('tweeter_ingest_tweets_per_second', inserted / elapsed)
+    print(f"Inserted {inserted} tweets from {lines} lines in {elapsed:.1f}s ({inserted / elapsed:.0f} tweets/sec)")
+
+
+# Save the top metrics during a long load so the search service sees progress
+def save_metrics(metrics, metrics_file):
+    if metrics is not None and metrics_file:
+        metrics.save_every(metrics_file)
+
+
+# Stream a JSONL file into MongoDB in batches of unordered bulk writes
+def bulk_load_tweets(file_path, batch_size=1000, text_index=None, metrics=None, metrics_file=None, hot_store=None,
+                     hot_store_file=None):
+    start_time = time.time()
+    lines = inserted = 0
+    documents, hashtag_ids, seen_ids = [], {}, set()
+    with open(file_path, 'r') as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():  # Skip empty lines
+                continue
+            try:
+                tweet = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON on line {line_number}: {e}")
+                continue
+            lines += 1
+            collect_tweet_documents(tweet, documents, hashtag_ids, seen_ids, metrics)
+            if len(documents) >= batch_size:
+                inserted += write_tweet_batch(documents, hashtag_ids)
+                index_documents(text_index, documents)
+                store_documents(hot_store, documents, hot_store_file)
+                save_metrics(metrics, metrics_file)
+                documents, hashtag_ids, seen_ids = [], {}, set()
+                report_ingest_rate(inserted, lines, start_time)
+    inserted += write_tweet_batch(documents, hashtag_ids)
+    index_documents(text_index, documents)
+    store_documents(hot_store, documents)
+    report_ingest_rate(inserted, lines, start_time)
+    return inserted
+
+
+# Split a file into byte ranges of roughly equal size that start and end on line boundaries
+def split_file_ranges(file_path, parts):
+    size = os.path.getsize(file_path)
+    step = max(size // max(parts, 1), 1)
+    offsets = [0]
+    with open(file_path, 'rb') as file:
+        for i in range(1, parts):
+            file.seek(max(i * step, offsets[-1]))
+            file.readline()  # Move to the start of the next line
+            position = file.tell()
+            if position >= size:
+                break
+            if position > offsets[-1]:
+                offsets.append(position)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+# Parse worker: build tweet documents for one byte range and hand the batches to the writers
+def parse_range(file_path, start, end, batch_size, batch_queue, metrics_queue=None):
+    metrics = TopMetrics() if metrics_queue is not None else None
+    lines = 0
+    documents, hashtag_ids, seen_ids = [], {}, set()
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        position = start
+        while position < end:
+            line = file.readline()
+            if not line:
+                break
+            position += len(line)
+            if not line.strip():
+                continue
+            try:
+                tweet = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON at byte {position - len(line)}: {e}")
+                continue
+            lines += 1
+            collect_tweet_documents(tweet, documents, hashtag_ids, seen_ids, metrics)
+            if len(documents) >= batch_size:
+                batch_queue.put((documents, hashtag_ids, lines))
+                documents, hashtag_ids, seen_ids, lines = [], {}, set(), 0
+    batch_queue.put((documents, hashtag_ids, lines))
+    if metrics_queue is not None:
+        metrics_queue.put((metrics, metrics.seen_tweets()))  # seen isn't pickled with the metrics
+
+
+# Writer worker: drain document batches into MongoDB over its own connection
+def write_batches(batch_queue, result_queue):
+    client = create_mongo_connection(mongo_config['uri'])
+    db = client[mongo_config['db']]
+    tweets, hashtags = db[mongo_config['tweets_collection']], db[mongo_config['hashtags_collection']]
+    start_time = time.time()
+    lines = inserted = 0
     try:
-        tweets_collection.insert_one(tweet_document)
-        # Handle hashtag indexing
-        for hashtag in tweet_document["hashtags"]:
-            hashtags_collection.update_one(
-                {"text": hashtag["text"]},
-                {"$addToSet": {"tweet_ids": tweet_data['id']}},
-                upsert=True
-            )
-        # If it's a retweet, consider inserting the original tweet
-        if tweet_document['is_retweet'] and 'retweeted_status' in tweet_data:
-            original_tweet_data = tweet_data['retweeted_status']
-            insert_tweet(original_tweet_data)
-
-    except pymongo.errors.DuplicateKeyError:
-        print(f"Tweet with id {tweet_document['tweet_id']} already exists.")
+        while True:
+            batch = batch_queue.get()
+            if batch is None:
+                break
+            documents, hashtag_ids, batch_lines = batch
+            inserted += write_tweet_batch(documents, hashtag_ids, tweets, hashtags)
+            lines += batch_lines
+            report_ingest_rate(inserted, lines, start_time)
+    finally:
+        client.close()
+        result_queue.put((lines, inserted))
 
-if __name__ == '__main__':
-    # Read the tweets and insert the tweet into the MongoDB database
-    with open(data_path, 'r') as file:
-        line_number = 0
+
+PROCESS_POLL_INTERVAL = 1.0  # Seconds between checks that the loader processes are still alive
+
+
+def check_processes(processes):
+    for process in processes:
+        if process.exitcode not in (None, 0):
+            raise RuntimeError(f"Loader process {process.name} exited with code {process.exitcode}")
+
+
+# Queue and join operations of the parent that fail the load when a child died, instead of waiting forever
+def get_checked(source, processes):
+    while True:
+        try:
+            return source.get(timeout=PROCESS_POLL_INTERVAL)
+        except queue.Empty:
+            check_processes(processes)
+            if all(process.exitcode is not None for process in processes):
+                raise RuntimeError("Loader processes exited without sending their results")
+
+
+def put_checked(target, item, processes):
+    while True:
+        try:
+            return target.put(item, timeout=PROCESS_POLL_INTERVAL)
+        except queue.Full:
+            check_processes(processes)
+
+
+def join_checked(waited, processes):
+    for process in waited:
+        while process.exitcode is None:
+            process.join(PROCESS_POLL_INTERVAL)
+            check_processes(processes)
+
+
+# Parse the file in a process pool and write the documents through one or more writer processes
+def parallel_load_tweets(file_path, workers=None, writers=1, batch_size=1000, metrics=None):
+    workers = workers or os.cpu_count() or 1
+    start_time = time.time()
+    batch_queue = multiprocessing.Queue(maxsize=writers * 4)
+    result_queue = multiprocessing.Queue()
+    # Each parser keeps its own top metrics and sends them back once its range is done
+    metrics_queue = multiprocessing.Queue() if metrics is not None else None
+
+    parsers = [multiprocessing.Process(target=parse_range,
+                                       args=(file_path, start, end, batch_size, batch_queue, metrics_queue))
+               for start, end in split_file_ranges(file_path, workers)]
+    writer_processes = [multiprocessing.Process(target=write_batches, args=(batch_queue, result_queue))
+                        for _ in range(writers)]
+    processes = parsers + writer_processes
+    for process in processes:
+        process.start()
+
+    # A parser or writer that dies fails the load; the others are stopped rather than left blocked on the queues
+    try:
+        if metrics_queue is not None:
+            for _ in parsers:
+                metrics.merge(*get_checked(metrics_queue, processes))
+        join_checked(parsers, processes)
+        for _ in writer_processes:
+            put_checked(batch_queue, None, processes)  # One stop signal per writer
+
+        lines = inserted = 0
+        for _ in writer_processes:
+            writer_lines, writer_inserted = get_checked(result_queue, processes)
+            lines += writer_lines
+            inserted += writer_inserted
+        join_checked(writer_processes, processes)
+    except BaseException:
+        for process in processes:
+            if process.exitcode is None:
+                process.terminate()
+        raise
+
+    report_ingest_rate(inserted, lines, start_time)
+    return inserted
+
+
+def load_ingest_checkpoint(checkpoint_file):
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+# Write the checkpoint to a temporary file and rename it so a crash never leaves a partial file
+def save_ingest_checkpoint(checkpoint_file, checkpoints):
+    temp_file = checkpoint_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(checkpoints, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, checkpoint_file)
+
+
+# Index the lines the ingest checkpoint covers but the saved index doesn't, left by a run that stopped
+# between checkpointing a batch and saving the index at its end
+def catch_up_index(text_index, file_path, key, offset):
+    start = text_index.offsets.get(key, 0)
+    if start > offset:
+        start = 0  # The file was replaced by a shorter one
+    documents = []
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        position = start
         for line in file:
-            line_number += 1
-            if line.strip():  # Skip empty lines
-                try:
-                    tweet = json.loads(line)
-                    insert_tweet(tweet)
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON on line {line_number}: {e}")
-                    print(line)
+            if position >= offset:
+                break
+            position += len(line)
+            if not line.strip():
+                continue
+            try:
+                collect_tweet_documents(json.loads(line), documents, {}, set())
+            except (json.JSONDecodeError, KeyError):
+                continue
+            if len(documents) >= 1000:
+                index_documents(text_index, documents)
+                documents = []
+    index_documents(text_index, documents)
+    text_index.offsets[key] = offset
+    if position > start:
+        print(f"Indexed {file_path} from byte {start} to {offset}, which the saved index was missing")
+
+
+# Apply only the lines appended since the last run, resuming from the checkpointed byte offset
+def incremental_load_tweets(file_path, checkpoint_file='ingest_checkpoint.json', batch_size=1000, text_index=None,
+                            metrics=None, metrics_file=None, hot_store=None, hot_store_file=None):
+    checkpoints = load_ingest_checkpoint(checkpoint_file)
+    key = os.path.abspath(file_path)
+    checkpoint = checkpoints.get(key, {'offset': 0, 'last_tweet_id': None})
+    if checkpoint['offset'] > os.path.getsize(file_path):
+        print(f"{file_path} is shorter than its checkpoint, reloading it from the start")
+        checkpoint = {'offset': 0, 'last_tweet_id': None}
+    if text_index is not None:
+        catch_up_index(text_index, file_path, key, checkpoint['offset'])
+
+    start_time = time.time()
+    lines = inserted = 0
+    documents, hashtag_ids, seen_ids = [], {}, set()
+
+    def flush(offset, last_tweet_id):
+        nonlocal inserted
+        inserted += write_tweet_batch(documents, hashtag_ids, upsert=True)
+        index_documents(text_index, documents)
+        if text_index is not None:
+            text_index.offsets[key] = offset  # Saved with the index at the end of the run
+        store_documents(hot_store, documents, hot_store_file)
+        save_metrics(metrics, metrics_file)
+        checkpoint.update(offset=offset, last_tweet_id=last_tweet_id)
+        checkpoints[key] = checkpoint
+        save_ingest_checkpoint(checkpoint_file, checkpoints)
+
+    with open(file_path, 'rb') as file:
+        file.seek(checkpoint['offset'])
+        position, last_tweet_id = checkpoint['offset'], checkpoint['last_tweet_id']
+        for line in file:
+            if not line.endswith(b'\n'):
+                break  # Partially written last line, pick it up on the next run
+            position += len(line)
+            if not line.strip():
+                continue
+            try:
+                tweet = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON at byte {position - len(line)}: {e}")
+                continue
+            lines += 1
+            collect_tweet_documents(tweet, documents, hashtag_ids, seen_ids, metrics)
+            last_tweet_id = tweet['id_str']
+            if len(documents) >= batch_size:
+                flush(position, last_tweet_id)
+                documents, hashtag_ids, seen_ids = [], {}, set()
+                report_ingest_rate(inserted, lines, start_time)
+        flush(position, last_tweet_id)
+    report_ingest_rate(inserted, lines, start_time)
+    return inserted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load tweets into MongoDB")
+    parser.add_argument('--file', default=data_path, help="JSONL file with one tweet per line")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Tweets per bulk write")
+    parser.add_argument('--workers', type=int, default=1, help="Parse processes (0 for one per CPU)")
+    parser.add_argument('--writers', type=int, default=1, help="Writer processes used in parallel mode")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Upsert only lines added since the last run instead of dropping and reloading")
+    parser.add_argument('--checkpoint', default='ingest_checkpoint.json', help="Checkpoint file for incremental mode")
+    parser.add_argument('--text-index', help="Also build the local inverted index and save it to this file")
+    parser.add_argument('--top-metrics', help="Also maintain the top metrics and save them to this file")
+    parser.add_argument('--hot-store', help="Also maintain the ranking columns and save them to this file")
+    parser.add_argument('--ingest-metrics', help="Write ingest rates in the Prometheus text format to this file")
+    args = parser.parse_args()
+
+    if args.ingest_metrics:
+        instrumentation.metrics.write_textfile_every(args.ingest_metrics)
+
+    text_index = None
+    if args.text_index:
+        if args.incremental and os.path.exists(args.text_index):
+            text_index = InvertedIndex.load(args.text_index)
+        else:
+            text_index = InvertedIndex()
+
+    metrics = None
+    if args.top_metrics:
+        if args.incremental and os.path.exists(args.top_metrics):
+            metrics = TopMetrics.load(args.top_metrics)
+        else:
+            metrics = TopMetrics()
+
+    hot_store = None
+    if args.hot_store:
+        if args.incremental and os.path.exists(args.hot_store):
+            hot_store = HotTweetStore.load(args.hot_store)
+        else:
+            hot_store = HotTweetStore()
+
+    # Read the tweets and insert them into the MongoDB database in batches
+    if args.incremental:
+        ensure_indexes()  # A full load recreates them in reset_database
+        incremental_load_tweets(args.file, checkpoint_file=args.checkpoint, batch_size=args.batch_size,
+                                text_index=text_index, metrics=metrics, metrics_file=args.top_metrics,
+                                hot_store=hot_store, hot_store_file=args.hot_store)
+    elif args.workers == 1:
+        reset_database()
+        bulk_load_tweets(args.file, batch_size=args.batch_size, text_index=text_index, metrics=metrics,
+                         metrics_file=args.top_metrics, hot_store=hot_store, hot_store_file=args.hot_store)
+    else:
+        reset_database()
+        parallel_load_tweets(args.file, workers=args.workers, writers=args.writers, batch_size=args.batch_size,
+                             metrics=metrics)
+        if text_index is not None:
+            # Writers run in other processes, index what they stored
+            text_index.add_from_collection(tweets_collection)
+        if hot_store is not None:
+            hot_store.add_from_collection(tweets_collection)
+
+    if text_index is not None:
+        text_index.save(args.text_index)
+        print(f"Saved text index with {len(text_index)} tweets to {args.text_index}")
+
+    if hot_store is not None:
+        hot_store.save(args.hot_store)
+        print(f"Saved hot store with {len(hot_store)} tweets ({hot_store.stats()['bytes_per_tweet']:.0f} bytes each) "
+              f"to {args.hot_store}")
 
+    if metrics is not None:
+        metrics.save(args.top_metrics)
+        print(f"Saved top metrics over {metrics.tweets} tweets to {args.top_metrics}")
 
+    if args.ingest_metrics:
+        instrumentation.metrics.write_textfile(args.ingest_metrics)
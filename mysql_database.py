@@ -1,8 +1,11 @@
+import argparse
+import time
 import pymysql
 from pymysql import Error
 import json
-from datetime import datetime
 from config import *
+from twitter_dates import twitter_date_to_sql
+import instrumentation
 
 # Function to create a connection to the MySQL database
 def create_server_connection(host_name, user_name, user_password, db_name=None):
@@ -44,48 +47,82 @@ def create_table(connection, query):
 def convert_twitter_date_to_sql_date(twitter_date):
     try:
         # Parse the Twitter date format
-        return datetime.strptime(twitter_date, '%a %b %d %H:%M:%S %z %Y').strftime('%Y-%m-%d %H:%M:%S')
+        return twitter_date_to_sql(twitter_date)
     except ValueError as e:
         print(f"Date conversion error: {e}")
         return None
 
-# Function to create or update a user in the database
-def insert_or_update_user(connection, user_data):
-    cursor = connection.cursor()
-    sql = """
-    INSERT INTO users
-    (user_id, name, screen_name, location, url, geo, place, followers_count, description, favourites_count, statuses_count, created_at) 
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ON DUPLICATE KEY UPDATE
-    name=VALUES(name), screen_name=VALUES(screen_name), location=VALUES(location), url=VALUES(url),
-    geo=VALUES(geo), place=VALUES(place), followers_count=VALUES(followers_count), description=VALUES(description),
-    favourites_count=VALUES(favourites_count), statuses_count=VALUES(statuses_count), created_at=VALUES(created_at);
-    """
+UPSERT_USER_SQL = """
+INSERT INTO users
+(user_id, name, screen_name, location, url, geo, place, followers_count, description, favourites_count, statuses_count, created_at) 
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+name=VALUES(name), screen_name=VALUES(screen_name), location=VALUES(location), url=VALUES(url),
+geo=VALUES(geo), place=VALUES(place), followers_count=VALUES(followers_count), description=VALUES(description),
+favourites_count=VALUES(favourites_count), statuses_count=VALUES(statuses_count), created_at=VALUES(created_at);
+"""
+
+# Build the row for the users table, returns None when the user can't be stored
+def user_row(user_data):
+    try:
+        return build_user_row(user_data)
+    except KeyError:
+        return None  # Skip users missing expected keys, like the per-row loader
+
+
+def build_user_row(user_data):
     # Convert the Twitter datetime to SQL datetime
     created_at = convert_twitter_date_to_sql_date(user_data['created_at'])
+    if created_at is None:
+        print(f"Skipping user {user_data['id_str']} due to invalid date format")
+        return None
+    return (
+        user_data['id_str'],  # Use 'id_str' to ensure the ID is captured accurately
+        user_data['name'],
+        user_data['screen_name'],
+        user_data['location'],
+        user_data['url'],
+        user_data.get('geo', None),  # Assuming geo is optional
+        user_data.get('place', None),  # Assuming place is optional
+        user_data['followers_count'],
+        user_data['description'],
+        user_data.get('favourites_count', 0),  # Defaulting to 0 if not present
+        user_data.get('statuses_count', 0),  # Defaulting to 0 if not present
+        created_at  # Use the converted datetime
+    )
 
-    if created_at is not None:
-        user_values = (
-            user_data['id_str'],  # Use 'id_str' to ensure the ID is captured accurately
-            user_data['name'],
-            user_data['screen_name'],
-            user_data['location'],
-            user_data['url'],
-            user_data.get('geo', None),  # Assuming geo is optional
-            user_data.get('place', None),  # Assuming place is optional
-            user_data['followers_count'],
-            user_data['description'],
-            user_data.get('favourites_count', 0),  # Defaulting to 0 if not present
-            user_data.get('statuses_count', 0),  # Defaulting to 0 if not present
-            created_at  # Use the converted datetime
-        )
+# Function to create or update a user in the database
+def insert_or_update_user(connection, user_data):
+    cursor = connection.cursor()
+    user_values = user_row(user_data)
+    if user_values is not None:
         try:
-            cursor.execute(sql, user_values)
+            cursor.execute(UPSERT_USER_SQL, user_values)
             connection.commit()
         except Error as e:
             print(f"Failed to insert/update user {user_data['id_str']}: {e}")
-    else:
-        print(f"Skipping user {user_data['id_str']} due to invalid date format")
+
+# Write a chunk of user rows as one multi-row upsert, returns the number of rows sent.
+# A failed batch is rolled back to a savepoint, so earlier batches not yet committed are kept.
+def write_user_batch(connection, rows):
+    if not rows:
+        return 0
+    started = time.perf_counter()
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT user_batch")
+        cursor.executemany(UPSERT_USER_SQL, rows)
+        instrumentation.metrics.observe('tweeter_ingest_batch_seconds', time.perf_counter() - started,
+                                        database='mysql')
+        instrumentation.metrics.inc('tweeter_ingest_users_total', len(rows))
+        return len(rows)
+    except Error as e:
+        print(f"Failed to insert/update batch of {len(rows)} users: {e}")
+        # Raises when the transaction itself is gone, rather than counting its batches as written
+        cursor.execute("ROLLBACK TO SAVEPOINT user_batch")
+        return 0
+    finally:
+        cursor.close()
 
 def execute_sql(connection, sql):
     cursor = connection.cursor()
@@ -110,7 +147,35 @@ def process_dataset(file_path, db_connection):
             except KeyError:
                 continue  # Skip lines missing expected keys
 
-if __name__ == '__main__':
+# Processing the dataset in chunks, keeping the last version of each user per chunk
+def process_dataset_batched(file_path, db_connection, batch_size=1000, commit_interval=1):
+    start_time = time.time()
+    users, written, deduplicated, batches = {}, 0, 0, 0
+    with open(file_path, "r") as file:
+        for line in file:
+            try:
+                user_data = json.loads(line)['user']
+                user_id = user_data['id_str']
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue  # Skip lines that can't be decoded or miss expected keys
+            if user_id in users:
+                deduplicated += 1
+            users[user_id] = user_data
+            if len(users) >= batch_size:
+                written += write_user_batch(db_connection, [row for row in map(user_row, users.values()) if row])
+                users, batches = {}, batches + 1
+                if batches % commit_interval == 0:
+                    db_connection.commit()
+    written += write_user_batch(db_connection, [row for row in map(user_row, users.values()) if row])
+    db_connection.commit()
+    elapsed = max(time.time() - start_time, 1e-9)
+    instrumentation.metrics.set('tweeter_ingest_users_per_second', written / elapsed)
+    print(f"Upserted {written} users in {elapsed:.1f}s ({written / elapsed:.0f} rows/sec), "
+          f"{deduplicated} duplicate rows dropped within batches")
+    return written, deduplicated
+
+# Create the database, the users table with its updated_at column and indexes; returns a connection to it
+def create_users_database():
     # Establish the server connection
     server_connection = create_server_connection(mysql_config['host'], mysql_config['user'], mysql_config['password'])
 
@@ -138,11 +203,17 @@ if __name__ == '__main__':
         description TEXT,
         favourites_count INT,
         statuses_count INT,
-        created_at DATETIME
+        created_at DATETIME,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
     );
     """
     execute_sql(db_connection, create_table_sql)
 
+    # Tables created before updated_at existed; the user directory refreshes from rows it moved on
+    add_updated_at = ("ALTER TABLE users ADD COLUMN updated_at TIMESTAMP "
+                      "DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;")
+    execute_sql(db_connection, add_updated_at)
+
     # Create an index on `screen_name`
     create_index_screen_name = "CREATE INDEX idx_screen_name ON users (screen_name);"
     execute_sql(db_connection, create_index_screen_name)
@@ -155,8 +226,27 @@ if __name__ == '__main__':
     create_index_created_at = "CREATE INDEX idx_created_at ON users (created_at);"
     execute_sql(db_connection, create_index_created_at)
 
-    process_dataset(data_path, db_connection)
+    # Create an index on `updated_at` for the incremental user directory refresh
+    create_index_updated_at = "CREATE INDEX idx_updated_at ON users (updated_at);"
+    execute_sql(db_connection, create_index_updated_at)
+    return db_connection
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load users into MySQL")
+    parser.add_argument('--file', default=data_path, help="JSONL file with one tweet per line")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Distinct users per executemany")
+    parser.add_argument('--commit-interval', type=int, default=1, help="Batches written per commit")
+    parser.add_argument('--ingest-metrics', help="Write ingest rates in the Prometheus text format to this file")
+    args = parser.parse_args()
+
+    db_connection = create_users_database()
+
+    process_dataset_batched(args.file, db_connection, batch_size=args.batch_size,
+                            commit_interval=args.commit_interval)
     if db_connection:
         db_connection.close()
+    if args.ingest_metrics:
+        instrumentation.metrics.write_textfile(args.ingest_metrics)
 
 
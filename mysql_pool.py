@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import pymysql
+
+
+class PoolTimeout(TimeoutError):
+    pass
+
+
+class ConnectionPool:
+    """Bounded pool of MySQL connections shared by the request threads.
+
+    Connections are created on demand up to max_size, pinged before reuse when they have been idle
+    longer than health_check_interval, and dropped instead of returned when a query failed on them.
+    They run in autocommit mode: otherwise the first SELECT opens a transaction nobody ends, and under
+    REPEATABLE READ the connection keeps reading that snapshot for as long as it is reused.
+    """
+
+    def __init__(self, connect, max_size=10, checkout_timeout=5.0, health_check_interval=30.0):
+        self.connect = connect  # returns a new connection, or None on failure like create_server_connection
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.idle = deque()  # (connection, returned_at)
+        self.created = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+        self.checkouts = self.timeouts = self.failures = self.reconnects = 0
+        self.wait_time = self.max_wait_time = 0.0
+
+    def open_connection(self):
+        try:
+            connection = self.connect()
+        except pymysql.Error as e:
+            print(f"The error '{e}' occurred")
+            connection = None
+        if connection is None:
+            with self.condition:
+                self.created -= 1
+                self.failures += 1
+                self.condition.notify()
+            raise ConnectionError("Could not connect to MySQL")
+        try:
+            connection.autocommit(True)
+        except pymysql.Error as e:
+            self.discard(connection, checked_out=False)
+            raise ConnectionError(f"Could not enable autocommit: {e}") from e
+        return connection
+
+    def is_healthy(self, connection):
+        try:
+            connection.ping(reconnect=True)
+            return True
+        except pymysql.Error:
+            return False
+
+    def checkout(self, timeout=None):
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        with self.condition:
+            self.waiting += 1
+            try:
+                while not self.idle and self.created >= self.max_size:
+                    remaining = timeout - (time.monotonic() - started)
+                    if remaining <= 0 or not self.condition.wait(remaining):
+                        if not self.idle and self.created >= self.max_size:
+                            self.timeouts += 1
+                            raise PoolTimeout(f"No MySQL connection available within {timeout}s")
+            finally:
+                self.waiting -= 1
+            waited = time.monotonic() - started
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self.checkouts += 1
+            self.in_use += 1
+            if self.idle:
+                connection, returned_at = self.idle.pop()  # Most recently used, most likely alive
+            else:
+                connection, returned_at = None, None
+                self.created += 1
+        try:
+            if connection is None:
+                return self.open_connection()
+            if time.monotonic() - returned_at > self.health_check_interval and not self.is_healthy(connection):
+                self.discard(connection, checked_out=False)
+                with self.condition:
+                    self.created += 1
+                    self.reconnects += 1
+                return self.open_connection()
+            return connection
+        except Exception:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, connection):
+        with self.condition:
+            self.in_use -= 1
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection, checked_out=True):
+        try:
+            connection.close()
+        except pymysql.Error:
+            pass
+        with self.condition:
+            self.created -= 1
+            if checked_out:
+                self.in_use -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for one unit of work; a connection that failed is closed, not reused."""
+        connection = self.checkout(timeout)
+        try:
+            yield connection
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            self.discard(connection)
+            raise
+        except BaseException:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    @contextmanager
+    def cursor(self, timeout=None):
+        with self.connection(timeout) as connection:
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'size': self.created, 'in_use': self.in_use, 'idle': len(self.idle), 'waiting': self.waiting,
+                'checkouts': self.checkouts, 'timeouts': self.timeouts, 'failures': self.failures,
+                'reconnects': self.reconnects, 'wait_time_total': self.wait_time,
+                'wait_time_max': self.max_wait_time,
+                'wait_time_avg': self.wait_time / self.checkouts if self.checkouts else 0.0,
+            }
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = list(self.idle), deque()
+            self.created -= len(idle)
+        for connection, _ in idle:
+            try:
+                connection.close()
+            except pymysql.Error:
+                pass
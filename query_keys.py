@@ -0,0 +1,120 @@
+import hashlib
+import json
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+# Time ranges are widened to whole buckets of this many seconds so near-identical ranges share a cache entry
+TIME_BUCKET_SECONDS = 60
+
+UTC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+NAIVE_EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_time(moment, granularity, round_up=False):
+    epoch = UTC_EPOCH if moment.tzinfo is not None else NAIVE_EPOCH
+    step = timedelta(seconds=granularity)
+    buckets, remainder = divmod(moment - epoch, step)
+    if round_up and remainder:
+        buckets += 1
+    return epoch + buckets * step
+
+
+def normalize_hashtags(hashtag):
+    tags = [hashtag] if isinstance(hashtag, str) else list(hashtag or [])
+    # Hashtag matching in MongoDB is case-sensitive, so only '#' and whitespace are dropped
+    tags = sorted({tag.strip().lstrip('#') for tag in tags if tag and tag.strip().lstrip('#')})
+    if not tags:
+        return None
+    return tags[0] if len(tags) == 1 else tuple(tags)
+
+
+def normalize_query(query_params, granularity=TIME_BUCKET_SECONDS):
+    """Canonical form of search parameters, used both to run the search and to key its cache entry."""
+    params = {key: value for key, value in query_params.items() if value is not None and value != ''}
+    if 'query_string' in params:
+        # Case-insensitive text search; collapse whitespace but keep the token order for phrases. lower() like
+        # text_index.tokenize, casefold() would turn 'straße' into 'strasse' and change what matches
+        params['query_string'] = ' '.join(params['query_string'].lower().split()) or None
+    if 'hashtag' in params:
+        params['hashtag'] = normalize_hashtags(params['hashtag'])
+    if 'user' in params:
+        # Screen names are case-insensitive
+        params['user'] = params['user'].strip().lstrip('@').lower() or None
+    if 'time_range' in params:
+        start, end = params['time_range']
+        params['time_range'] = (bucket_time(start, granularity), bucket_time(end, granularity, round_up=True))
+    if 'fields' in params:
+        params['fields'] = tuple(sorted(set(params['fields'])))
+    return {key: value for key, value in params.items() if value is not None}
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot encode {type(value).__name__} in a query key")
+
+
+def query_key(params):
+    """Stable, compact key for canonical parameters, the same across processes and restarts."""
+    canonical = json.dumps(params, sort_keys=True, separators=(',', ':'), default=encode_value)
+    return 'q:' + hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+class QueryKeyStats:
+    """Counts how often normalization mapped a request onto a different (shared) key."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = self.normalized = 0
+
+    def record(self, raw_params, params):
+        changed = params != {key: value for key, value in raw_params.items() if value is not None}
+        with self.lock:
+            self.requests += 1
+            self.normalized += changed
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'normalized': self.normalized}
+
+
+def parse_logged_query(entry):
+    params = dict(entry)
+    if params.get('time_range'):
+        params['time_range'] = tuple(datetime.fromisoformat(value) for value in params['time_range'])
+    for key in ('fields', 'hashtag'):
+        if isinstance(params.get(key), list):
+            params[key] = tuple(params[key])
+    return params
+
+
+def replay_query_log(path, granularity=TIME_BUCKET_SECONDS):
+    """Hit rate an unbounded cache would reach on a JSONL log of query params, with raw and canonical keys."""
+    raw_seen, canonical_seen = set(), set()
+    requests = raw_hits = canonical_hits = 0
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            params = parse_logged_query(json.loads(line))
+            raw_key = frozenset(params.items())
+            key = query_key(normalize_query(params, granularity))
+            requests += 1
+            raw_hits += raw_key in raw_seen
+            canonical_hits += key in canonical_seen
+            raw_seen.add(raw_key)
+            canonical_seen.add(key)
+    return {
+        'requests': requests,
+        'distinct_raw_keys': len(raw_seen),
+        'distinct_canonical_keys': len(canonical_seen),
+        'raw_hit_rate': raw_hits / requests if requests else 0.0,
+        'canonical_hit_rate': canonical_hits / requests if requests else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    # Usage: python query_keys.py query_log.jsonl [granularity_seconds]
+    granularity = int(sys.argv[2]) if len(sys.argv) > 2 else TIME_BUCKET_SECONDS
+    print(json.dumps(replay_query_log(sys.argv[1], granularity), indent=2))
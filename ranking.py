@@ -0,0 +1,162 @@
+import base64
+import heapq
+import itertools
+import json
+from pymongo import DESCENDING
+
+# Scoring formulas as weights over the engagement counts, a single field sorts directly on its index
+SCORING_FORMULAS = {
+    'retweets': {'retweet_count': 1},
+    'favorites': {'favorite_count': 1},
+    'replies': {'reply_count': 1},
+    'quotes': {'quote_count': 1},
+    'engagement': {'retweet_count': 2, 'quote_count': 2, 'reply_count': 1, 'favorite_count': 1},
+}
+
+# Categories returned next to the ranked results
+CATEGORIES = {
+    'top_retweeted': 'retweets',
+    'top_favorited': 'favorites',
+}
+
+# Tweet ids per $in sent to MongoDB, longer candidate lists are ranked chunk by chunk and merged
+IN_CHUNK_SIZE = 5000
+
+# Compound indexes backing the $match + $sort + $limit pipelines for the common filters
+RANKING_INDEXES = [
+    [(field, DESCENDING), ('tweet_id', DESCENDING)] for field in ('retweet_count', 'favorite_count')
+] + [
+    [(prefix, 1), (field, DESCENDING), ('tweet_id', DESCENDING)]
+    for prefix in ('hashtags.text', 'user_id') for field in ('retweet_count', 'favorite_count')
+]
+
+
+def ensure_ranking_indexes(collection):
+    for keys in RANKING_INDEXES:
+        collection.create_index(keys)
+
+
+def score_expression(weights):
+    return {'$add': [{'$multiply': [{'$ifNull': ['$' + field, 0]}, weight]} for field, weight in weights.items()]}
+
+
+def formula_weights(formula, text_search=False):
+    """Weights for a formula name or dict of weights, None for 'relevance' on $text queries."""
+    if formula == 'relevance':
+        if text_search:
+            return None
+        formula = 'retweets'
+    return SCORING_FORMULAS[formula] if isinstance(formula, str) else formula
+
+
+def rank_key(formula, text_search=False):
+    """Field the results are ordered by (descending, ties broken by tweet_id)."""
+    weights = formula_weights(formula, text_search)
+    if weights is None:
+        return 'score'
+    if len(weights) == 1 and list(weights.values())[0] > 0:
+        # Plain field sort, served by the compound indexes
+        return next(iter(weights))
+    return 'rank_score'
+
+
+def encode_cursor(tweet, key):
+    """Opaque token for the position right after this tweet."""
+    payload = json.dumps([key, tweet.get(key), tweet['tweet_id']])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        key, value, tweet_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError("Invalid cursor") from e
+    return key, value, tweet_id
+
+
+def ranking_pipeline(query_filter, formula='retweets', limit=50, after=None, fields=None):
+    """Pipeline for one page of ranked tweets; after is a cursor token, fields an optional projection."""
+    text_search = '$text' in query_filter
+    weights = formula_weights(formula, text_search)
+    key = rank_key(formula, text_search)
+
+    pipeline = [{'$match': query_filter}]
+    if text_search:
+        pipeline.append({'$addFields': {'score': {'$meta': 'textScore'}}})
+    if key == 'rank_score':
+        pipeline.append({'$addFields': {'rank_score': score_expression(weights)}})
+    if after:
+        cursor_key, value, tweet_id = decode_cursor(after)
+        if cursor_key != key:
+            raise ValueError("Cursor does not match the ranking")
+        # Keyset pagination: strictly after (value, tweet_id) in descending order
+        pipeline.append({'$match': {'$or': [{key: {'$lt': value}}, {key: value, 'tweet_id': {'$lt': tweet_id}}]}})
+    pipeline += [{'$sort': {key: -1, 'tweet_id': -1}}, {'$limit': limit}]
+
+    projection = {'_id': 0}
+    if fields:
+        projection.update(dict.fromkeys(list(fields) + [key, 'tweet_id'], 1))
+    pipeline.append({'$project': projection})
+    return pipeline
+
+
+def ranking_plan(query_filter, formula='retweets', limit=50, category_limit=10, after=None, fields=None):
+    """Pipeline for the results and one per category, None where a category is a slice of the results."""
+    categories = {}
+    for category, category_formula in CATEGORIES.items():
+        if not category_limit:
+            break
+        if category_formula == formula and category_limit <= limit and not after:
+            categories[category] = None
+        else:
+            categories[category] = ranking_pipeline(query_filter, category_formula, category_limit, fields=fields)
+    return ranking_pipeline(query_filter, formula, limit, after, fields), categories
+
+
+def chunked_filters(query_filter, chunk_size=None):
+    """The filter split on its tweet_id $in list, so each query stays small; one filter when it is short."""
+    chunk_size = chunk_size or IN_CHUNK_SIZE
+    condition = query_filter.get('tweet_id')
+    if not isinstance(condition, dict) or len(condition.get('$in', ())) <= chunk_size:
+        return [query_filter]
+    tweet_ids = condition['$in']
+    return [dict(query_filter, tweet_id={'$in': tweet_ids[start:start + chunk_size]})
+            for start in range(0, len(tweet_ids), chunk_size)]
+
+
+def merge_ranked(rankings, key, limit):
+    """Global top limit of rankings over disjoint chunks, in the pipelines' (key, tweet_id) descending order."""
+    if len(rankings) == 1:
+        return rankings[0]
+    return heapq.nlargest(limit, itertools.chain(*rankings),
+                          key=lambda tweet: (tweet.get(key) is not None, tweet.get(key) or 0, tweet['tweet_id']))
+
+
+def ranking_plans(query_filter, formula='retweets', limit=50, category_limit=10, after=None, fields=None):
+    """ranking_plan of each chunk of the filter, results are combined by merge_plan_results."""
+    return [ranking_plan(chunk, formula, limit, category_limit, after, fields)
+            for chunk in chunked_filters(query_filter)]
+
+
+def merge_plan_results(plans, run, formula='retweets', limit=50, category_limit=10, text_search=False):
+    """(top_by_category, results) from the plans, run(pipeline) returning each pipeline's tweets."""
+    results = merge_ranked([run(pipeline) for pipeline, _ in plans], rank_key(formula, text_search), limit)
+    category_results = {}
+    for category, category_pipeline in plans[0][1].items():
+        category_results[category] = None if category_pipeline is None else merge_ranked(
+            [run(categories[category]) for _, categories in plans], rank_key(CATEGORIES[category]), category_limit)
+    return assemble_categories(results, category_results, category_limit), results
+
+
+def assemble_categories(results, category_results, category_limit=10):
+    return {category: results[:category_limit] if tweets is None else tweets
+            for category, tweets in category_results.items()}
+
+
+# Global top-N for the query plus the top tweets of each category, all ranked inside MongoDB
+def rank_tweets(collection, query_filter, formula='retweets', limit=50, category_limit=10, after=None,
+                fields=None):
+    plans = ranking_plans(query_filter, formula, limit, category_limit, after, fields)
+    top_by_category, results = merge_plan_results(plans, lambda pipeline: list(collection.aggregate(pipeline)),
+                                                  formula, limit, category_limit, '$text' in query_filter)
+    return top_by_category, results
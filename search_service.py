@@ -1,110 +1,263 @@
+import itertools
+import os
 import time
 from pymongo import MongoClient
-from cache import LRUCacheWithTTL
+from cache import NamespacedCache
+from cache_server import socket_backend_factory
+from singleflight import SingleFlight
+from query_keys import normalize_query, query_key, QueryKeyStats
+from text_index import InvertedIndex
+from ranking import rank_tweets, rank_key, encode_cursor, ranking_plan, assemble_categories, chunked_filters, \
+    CATEGORIES, IN_CHUNK_SIZE
 from mysql_database import create_server_connection
+from mysql_pool import ConnectionPool
+from user_directory import UserDirectory
+from top_metrics import TopMetrics
+from hot_store import HotTweetStore
+from instrumentation import metrics, stage, record_round_trip, MongoCommandTimer
 from datetime import datetime
 from collections import Counter
 import threading
-import pandas as pd
 
-# MongoDB connection setup
-mongo_client = MongoClient('...')
-mongo_db = mongo_client['TwitterData']
-tweets_collection = mongo_db['tweets']
-
-# MySQL connection setup
-db_connection = create_server_connection(
-    "localhost", "root", "...", "TwitterData")
-mysql_cursor = db_connection.cursor()
-
-lru_cache = LRUCacheWithTTL(capacity=100, ttl=3600)
-
-
-def search_tweets(query_string=None, hashtag=None, user=None, time_range=None):
+# Connections, caches, the text index and the background threads are created by start(), once per
+# process: importing this module does no I/O, and every forked worker gets its own.
+service_pid = None
+start_lock = threading.Lock()
+
+# MongoDB connection, set up by start()
+mongo_client = None
+mongo_db = None
+tweets_collection = None
+
+# MySQL connection pool, each lookup checks out its own connection
+mysql_pool = None
+
+# Users by screen_name and user_id, loaded in the background and refreshed every minute
+user_directory = None
+
+# Separate budgets so a few large search results can't push out tweet metadata and metrics,
+# expired searches and metrics are still served for stale_ttl seconds while one refresh runs
+cache_budgets = {
+    'search': {'max_bytes': 64 * 1024 * 1024, 'stale_ttl': 600},
+    'metadata': {'max_bytes': 16 * 1024 * 1024},
+    'metrics': {'capacity': 16, 'stale_ttl': 3600},
+}
+# Point TWEETER_CACHE_ADDRESS at a running cache_server.py to share one cache between worker processes,
+# the workers read the server's key from TWEETER_CACHE_AUTHKEY or its key file (see cache_server.load_authkey)
+shared_cache_address = os.environ.get('TWEETER_CACHE_ADDRESS')
+caches = search_cache = metadata_cache = metrics_cache = None
+
+# One computation per cache key at a time, concurrent misses wait for its result
+flights = None
+
+# How many searches were mapped onto a shared canonical key, next to the search cache hit rate
+query_key_stats = QueryKeyStats()
+
+
+def compute_and_cache(cache, key, compute):
+    value = compute()
+    if value:
+        cache.put(key, value)
+    return value
+
+
+def cached_call(namespace, key, compute):
+    """Serve key from a cache namespace, computing it at most once at a time across threads.
+
+    Stale entries are returned immediately while a single background refresh replaces them.
+    """
+    cache = caches[namespace]
+    with stage('cache'):
+        value, fresh = cache.get_entry(key)
+    if value:
+        if not fresh:
+            flights.refresh((namespace, key), lambda: compute_and_cache(cache, key, compute))
+        return value
+    return flights.do((namespace, key), lambda: compute_and_cache(cache, key, compute))
+
+# Fields every result needs for paging and metadata, whatever projection the client asks for
+REQUIRED_FIELDS = ('tweet_id', 'user_id', 'created_at', 'retweet_count', 'favorite_count')
+
+# Optional local inverted index written by the loader with --text-index, loaded by start() and reloaded by the
+# update thread when the file changes. Keywords matching more tweets than index_match_limit are searched with
+# $text instead, one aggregation rather than a $in query per IN_CHUNK_SIZE ids
+text_index_file = 'text_index.pkl'
+text_index = None
+text_index_mtime = None
+index_match_limit = IN_CHUNK_SIZE
+
+# Top metrics maintained by the loader with --top-metrics, (re)loaded by the update thread when the file changes
+top_metrics_file = 'top_metrics.pkl'
+top_metrics = None
+top_metrics_mtime = None
+
+# Ranking columns maintained by the loader with --hot-store, (re)loaded by the update thread when the file
+# changes. Without the file they are read from MongoDB in the background. Either way, the update thread adds
+# the tweets inserted since, and reads the whole collection again every full update for counts changed in
+# place. Searches rank in MongoDB while the store holds a different number of tweets than the collection
+hot_store_file = 'hot_store.pkl'
+hot_store = None
+hot_store_mtime = None
+hot_store_behind = False
+use_hot_store = True
+
+# Keyword search backend: 'index' (local inverted index), 'text' (MongoDB $text) or 'regex' (collection scan)
+search_backend = 'text'
+
+
+def text_query_filter(query_string):
+    with stage('text_filter'):
+        if search_backend == 'index' and text_index is not None:
+            # Every match, so ranking stays global
+            matches = text_index.search(query_string, limit=index_match_limit + 1)
+            if len(matches) <= index_match_limit:
+                return {'tweet_id': {'$in': matches}}
+        if search_backend in ('index', 'text'):
+            return {'$text': {'$search': query_string}}
+        return {'text': {'$regex': query_string, '$options': 'i'}}  # Case-insensitive search
+
+
+# Retrieve user_id using screen_name, from the directory or MySQL for users it doesn't know yet
+def lookup_user_id(user):
+    with stage('user_lookup'):
+        return user_directory.user_id(user)
+
+
+def build_query_filter(query_string=None, hashtag=None, user_id=None, time_range=None):
     query_filter = {}
 
     # Add string search in text to query filter
     if query_string:
-        query_filter['text'] = {'$regex': query_string,
-                                '$options': 'i'}  # Case-insensitive search
+        query_filter.update(text_query_filter(query_string))
 
-    # Add hashtag search to query filter
-    if hashtag:
-        query_filter['entities.hashtags.text'] = hashtag
+    # Add hashtag search to query filter, several hashtags must all be present
+    if isinstance(hashtag, (list, tuple)):
+        query_filter['hashtags.text'] = {'$all': list(hashtag)}
+    elif hashtag:
+        query_filter['hashtags.text'] = hashtag  # Same values as entities.hashtags, but indexed
 
     # Add user search to query filter
-    if user:
-        # Retrieve user_id from MySQL using screen_name
-        mysql_cursor.execute(
-            "SELECT user_id FROM users WHERE screen_name = %s", (user,))
-        result = mysql_cursor.fetchone()
-        if result:
-            query_filter['user_id'] = result['user_id']
+    if user_id is not None:
+        query_filter['user_id'] = user_id
 
     # Add time range to query filter
     if time_range:
         start_date, end_date = time_range
         query_filter['created_at'] = {'$gte': start_date, '$lte': end_date}
+    return query_filter
+
+
+def search_tweets(query_string=None, hashtag=None, user=None, time_range=None, formula='retweets', limit=50,
+                  after=None, fields=None, category_limit=10):
+    query_filter = build_query_filter(query_string, hashtag, lookup_user_id(user) if user else None, time_range)
+
+    # Rank from the hot store, or inside MongoDB when it can't answer, so the results are the global top-N
+    with stage('rank'):
+        ranked = rank_from_store(query_filter, formula, limit, category_limit, after, fields)
+        if ranked is None:
+            ranked = rank_tweets(tweets_collection, query_filter, formula=formula, limit=limit,
+                                 category_limit=category_limit, after=after, fields=fields)
+    top_by_category, results = ranked
+    return top_by_category, results, rank_key(formula, '$text' in query_filter)
+
+
+def rank_from_store(query_filter, formula='retweets', limit=50, category_limit=10, after=None, fields=None):
+    """rank_tweets from the hot store plus one find for the documents, None when the store can't answer."""
+    store = hot_store if use_hot_store and not hot_store_behind else None
+    if store is None:
+        return None
+    results = store.rank(query_filter, formula, limit, after)
+    if results is None:
+        return None
+    categories = {}
+    for category, category_formula in CATEGORIES.items():
+        if not category_limit:
+            break
+        categories[category] = store.rank(query_filter, category_formula, category_limit)
+
+    key = rank_key(formula)
+    projection = {'_id': 0}
+    if fields:
+        projection.update(dict.fromkeys(list(fields) + [key, 'tweet_id'], 1))
+        projection.pop('rank_score', None)
+    tweet_ids = {tweet_id for ranking in [results, *categories.values()] for tweet_id, _ in ranking}
+    documents = {tweet['tweet_id']: tweet
+                 for tweet in tweets_collection.find({'tweet_id': {'$in': list(tweet_ids)}}, projection)}
+
+    def materialize(ranking, ranking_key):
+        tweets = []
+        for tweet_id, score in ranking:
+            tweet = documents.get(tweet_id)
+            if tweet is None:
+                continue  # Removed from MongoDB since the store was saved
+            tweets.append(dict(tweet, **{ranking_key: score}))  # Cursors continue from the store's value
+        return tweets
+
+    top_by_category = {category: materialize(ranking, rank_key(CATEGORIES[category]))
+                       for category, ranking in categories.items()}
+    return top_by_category, materialize(results, key)
+
+
+# Prepare metadata to show
+def build_metadata(tweet, user_data):
+    return {
+        'author': user_data['name'],
+        'tweeted_at': tweet['created_at'],
+        'retweet_count': tweet.get('retweet_count', 0),
+        # Example additional field
+        'favorite_count': tweet.get('favorite_count', 0),
+        # Potentially add more fields as needed
+    }
 
-    # Execute search query
-    search_results = tweets_collection.find(query_filter).limit(50)
-
-    # Rank and return search results
-    return rank_search_results(search_results)
 
+def tweet_metadata(tweet_id, cache=True):
+    if cache:
+        # check the cache, or wait for a lookup of the same tweet already running
+        return cached_call('metadata', tweet_id, lambda: fetch_tweet_metadata(tweet_id))
+    return fetch_tweet_metadata(tweet_id)
 
-def rank_search_results(search_results):
-    # ranking based on retweet_count
-    ranked_results = sorted(search_results, key=lambda x: -x['retweet_count'])
 
-    for tweet in ranked_results:
-        del tweet['_id']
+def fetch_tweet_metadata(tweet_id):
+    # Fetch tweet information from MongoDB
+    with stage('tweet_lookup'):
+        tweet = tweets_collection.find_one({'tweet_id': tweet_id})
+    if tweet:
+        # Retrieve additional user data from the directory, MySQL on a miss
+        user_data = user_directory.get(tweet['user_id'])
+        if user_data:
+            return build_metadata(tweet, user_data)
 
-    # Group by categories and select top 10 for each category
-    top_by_category = {
-        'top_retweeted': ranked_results[:10],
-        'top_favorited': sorted(ranked_results, key=lambda x: -x['favorite_count'])[:10],
-    }
+    return None
 
-    # Convert MongoDB results to list of dicts
-    ranked_results_list = list(map(dict, ranked_results))
 
-    # Return ranked results grouped by category
-    return top_by_category, ranked_results_list
+# Fetch many users keyed by user_id as a string like the tweet documents, misses in one round trip
+def fetch_users(user_ids):
+    return user_directory.users(user_ids)
 
 
-def tweet_metadata(tweet_id, cache=True):
-    if cache:
-        # check if the metadata is available in the cache
-        cached_data = lru_cache.get(tweet_id)
+# Attach metadata to already fetched tweets, resolving all uncached authors with a single MySQL query
+def enrich_with_metadata(tweets, cache=True):
+    # One lookup for the whole page, a single round trip when the cache is shared
+    cached = metadata_cache.get_many([tweet['tweet_id'] for tweet in tweets]) if cache else {}
+    pending = []
+    for tweet in tweets:
+        cached_data = cached.get(tweet['tweet_id'])
         if cached_data:
-            return cached_data
+            tweet['metadata'] = cached_data
+        else:
+            pending.append(tweet)
 
-    # Fetch tweet information from MongoDB
-    tweet = tweets_collection.find_one({'tweet_id': tweet_id})
-    if tweet:
-        # Retrieve additional user data from MySQL
-        mysql_cursor.execute(
-            "SELECT * FROM users WHERE user_id = %s", (tweet['user_id'],))
-        user_data = mysql_cursor.fetchone()
-        if user_data:
-            # Prepare metadata to show
-            metadata = {
-                'author': user_data['name'],
-                'tweeted_at': tweet['created_at'],
-                'retweet_count': tweet.get('retweet_count', 0),
-                # Example additional field
-                'favorite_count': tweet.get('favorite_count', 0),
-                # Potentially add more fields as needed
-            }
-
-            if cache:
-                # Cache the retrieved metadata
-                # Using put if you are using a custom LRUCacheWithTTL
-                lru_cache.put(tweet_id, metadata)
-                return metadata
+    users = fetch_users({tweet['user_id'] for tweet in pending})
+    fetched = {}
+    for tweet in pending:
+        user_data = users.get(str(tweet['user_id']))
+        tweet['metadata'] = build_metadata(tweet, user_data) if user_data else None
+        if tweet['metadata']:
+            fetched[tweet['tweet_id']] = tweet['metadata']
 
-    return None
+    if cache and fetched:
+        metadata_cache.put_many(fetched.items())
+    return tweets
 
 
 def user_tweets(user_id):
@@ -112,33 +265,40 @@ def user_tweets(user_id):
     return list(tweets_collection.find({'user_id': user_id}))
 
 
-def calculate_top_metrics(cursor):
+# Fetch top 10 users by followers count, on a pooled connection unless given a cursor
+def fetch_top_users(cursor=None):
+    query = "SELECT user_id, screen_name, followers_count FROM users ORDER BY followers_count DESC LIMIT 10"
+    record_round_trip('mysql')
+    if cursor is None:
+        with mysql_pool.cursor() as pooled_cursor:
+            pooled_cursor.execute(query)
+            rows = pooled_cursor.fetchall()
+    else:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+    return [{"user_id": row['user_id'], "screen_name": row['screen_name'],
+             "followers_count": row['followers_count']} for row in rows]
+
+
+# Fetch top 10 tweets by retweet count, read off the (retweet_count, tweet_id) index
+def fetch_top_tweets():
+    top_tweets = tweets_collection.find().sort('retweet_count', -1).limit(10)
+
+    # Processing MongoDB results to be JSON serializable and more informative
+    return [
+        {
+            # Ensure the ID is serializable
+            'tweet_id': str(tweet['tweet_id']),
+            'text': tweet.get('text', ''),
+            'retweet_count': tweet.get('retweet_count', 0)
+        }
+        for tweet in top_tweets
+    ]
+
+
+def calculate_top_metrics(cursor=None):
     try:
-        # Fetch top 10 users by followers count
-        cursor.execute(
-            "SELECT user_id, screen_name, followers_count FROM users ORDER BY followers_count DESC LIMIT 10")
-        top_users = [{"user_id": row['user_id'], "screen_name": row['screen_name'],
-                      "followers_count": row['followers_count']} for row in cursor.fetchall()]
-
-        # Ensure index on 'retweet_count' in MongoDB for performance
-        tweets_collection.create_index([('retweet_count', -1)])
-
-        # Fetch top 10 tweets by retweet count
-        top_tweets = list(tweets_collection.find().sort(
-            'retweet_count', -1).limit(10))
-
-        # Processing MongoDB results to be JSON serializable and more informative
-        processed_tweets = [
-            {
-                # Ensure the ID is serializable
-                'tweet_id': str(tweet['tweet_id']),
-                'text': tweet.get('text', ''),
-                'retweet_count': tweet.get('retweet_count', 0)
-            }
-            for tweet in top_tweets
-        ]
-
-        return {'top_users': top_users, 'top_tweets': processed_tweets}
+        return {'top_users': fetch_top_users(cursor), 'top_tweets': fetch_top_tweets()}
     except Exception as e:
         print(f"An error occurred: {e}")
         # Handle the error appropriately or re-raise it
@@ -147,84 +307,402 @@ def calculate_top_metrics(cursor):
 
 # Define a helper function for TTL cache
 def get_cached_top_metrics():
-    top_metrics_key = 'top_metrics'
-    top_metrics = lru_cache.get(top_metrics_key)
-    if not top_metrics:
-        top_metrics = calculate_top_metrics(mysql_cursor)
-        lru_cache.put(top_metrics_key, top_metrics)
-    return top_metrics
+    if top_metrics is not None:
+        return top_metrics.snapshot()  # Maintained by the loader, no query needed
+    return cached_call('metrics', 'top_metrics', calculate_top_metrics)
+
+
+# Pick up the loader's top metrics file when it changed, returns True when a new version was loaded
+def reload_top_metrics():
+    global top_metrics, top_metrics_mtime
+    try:
+        mtime = os.path.getmtime(top_metrics_file)
+    except OSError:
+        return False
+    if mtime == top_metrics_mtime:
+        return False
+    try:
+        top_metrics = TopMetrics.load(top_metrics_file)
+    except Exception as e:
+        print(f"An error occurred loading {top_metrics_file}: {e}")
+        return False
+    top_metrics_mtime = mtime
+    return True
+
+
+# Pick up the loader's text index file when it changed, returns True when a new version was loaded
+def reload_text_index():
+    global text_index, text_index_mtime
+    try:
+        mtime = os.path.getmtime(text_index_file)
+    except OSError:
+        return False
+    if mtime == text_index_mtime:
+        return False
+    try:
+        text_index = InvertedIndex.load(text_index_file)
+    except Exception as e:
+        print(f"An error occurred loading {text_index_file}: {e}")
+        return False
+    text_index_mtime = mtime
+    return True
+
+
+# Pick up the loader's hot store file when it changed, returns True when a new version was loaded
+def reload_hot_store():
+    global hot_store, hot_store_mtime
+    try:
+        mtime = os.path.getmtime(hot_store_file)
+    except OSError:
+        return False
+    if mtime == hot_store_mtime:
+        return False
+    try:
+        hot_store = HotTweetStore.load(hot_store_file)
+    except Exception as e:
+        print(f"An error occurred loading {hot_store_file}: {e}")
+        return False
+    hot_store_mtime = mtime
+    return True
+
+
+# Read the ranking columns from MongoDB into a new store and swap it in, picking up counts changed in place
+def refresh_hot_store():
+    global hot_store
+    try:
+        hot_store = HotTweetStore().add_from_collection(tweets_collection)
+    except Exception as e:
+        print(f"An error occurred filling the hot store: {e}")
+
+
+# Add the tweets inserted since the store's newest one, instead of reading the whole collection again
+def sync_hot_store():
+    store = hot_store
+    if store is None:
+        return
+    try:
+        store.add_new_from_collection(tweets_collection)
+    except Exception as e:
+        print(f"An error occurred updating the hot store: {e}")
+
+
+# Compare the store with the collection's tweet count, which MongoDB keeps in its metadata
+def check_hot_store():
+    global hot_store_behind
+    try:
+        hot_store_behind = hot_store is not None and tweets_collection.estimated_document_count() != len(hot_store)
+    except Exception as e:
+        print(f"An error occurred checking the hot store: {e}")
+        hot_store_behind = True
 
 # Function to search tweets with ranking and drill-down features
 
 
 def search_and_rank_tweets(query_params, cache=True):
-    # Create a unique key based on the query parameters to cache search results
-    query_key = frozenset(query_params.items())
+    # Canonical parameters run the search and key its cache entry, so equivalent queries share results
+    params = normalize_query(query_params)
+    query_key_stats.record(query_params, params)
 
     if cache:
-        # Try to get cached results
-        cached_results = lru_cache.get(query_key)
-        if cached_results:
-            return cached_results
-
-    # If no cached results, perform the search
-    query_string = query_params.get('query_string')
-    hashtag = query_params.get('hashtag')
-    user = query_params.get('user')
-    time_range = query_params.get('time_range')
-
-    top_by_category, ranked_results_list = search_tweets(
-        query_string=query_string,
-        hashtag=hashtag,
-        user=user,
-        time_range=time_range
-    )
+        # Cached results, or the results of the same search already running
+        return cached_call('search', query_key(params), lambda: run_search(params))
+    return run_search(params)
+
+
+def search_options(query_params):
+    """search_tweets arguments for canonical search parameters.
+
+    One extra result tells whether there is a next page; categories only come with the first page.
+    """
+    fields = query_params.get('fields')
+    return {
+        'query_string': query_params.get('query_string'),
+        'hashtag': query_params.get('hashtag'),
+        'user': query_params.get('user'),
+        'time_range': query_params.get('time_range'),
+        'formula': query_params.get('rank_by') or 'retweets',
+        'limit': (query_params.get('page_size') or 50) + 1,
+        'after': query_params.get('cursor'),
+        'fields': tuple(fields) + REQUIRED_FIELDS if fields else None,
+        'category_limit': 0 if query_params.get('cursor') else 10,
+    }
+
+
+def run_search(query_params):
+    top_by_category, ranked_results_list, key = search_tweets(**search_options(query_params))
+    return package_results(query_params, top_by_category, ranked_results_list, key)
+
+
+# Page the ranked results, enrich them and drop the fields the client did not ask for
+def package_results(query_params, top_by_category, ranked_results_list, key):
+    page_size = query_params.get('page_size') or 50
+    cursor = query_params.get('cursor')
+    fields = query_params.get('fields')
+
+    next_cursor = None
+    if len(ranked_results_list) > page_size:
+        ranked_results_list = ranked_results_list[:page_size]
+        next_cursor = encode_cursor(ranked_results_list[-1], key)
+
+    result_ids = {tweet['tweet_id'] for tweet in ranked_results_list}
+    category_tweets = tweets_outside_results(top_by_category, result_ids)
 
     # Enhance tweet list with metadata from cache or database
-    for tweet in ranked_results_list:
-        tweet_id = tweet.get('tweet_id')
-        tweet['metadata'] = tweet_metadata(tweet_id)
-        # del tweet['_id']
+    with stage('metadata'):
+        enrich_with_metadata(ranked_results_list + category_tweets)
+    select_fields(ranked_results_list + category_tweets, fields)
 
     # Package the results
     results = {
         'results': ranked_results_list,
-        'top_by_category': top_by_category
+        'next_cursor': next_cursor
     }
-
-    if cache:
-        # Cache the new results before returning
-        lru_cache.put(query_key, results)
+    if not cursor:
+        results['top_by_category'] = {category: [tweet['tweet_id'] for tweet in tweets]
+                                      for category, tweets in top_by_category.items()}
+        results['category_tweets'] = category_tweets
 
     return results
 
 
-def periodic_cache_update(interval):  # 定时启动cache
-    # Establish its own database connection
-    local_db_connection = create_server_connection(
-        "localhost", "root", "Qyf19980504", "TwitterData")
-    local_mysql_cursor = local_db_connection.cursor()
-
+# Categories reference results by tweet_id, tweets missing from this page are sent once
+def tweets_outside_results(top_by_category, result_ids):
+    category_tweets = {}
+    for tweets in top_by_category.values():
+        for tweet in tweets:
+            if tweet['tweet_id'] not in result_ids:
+                category_tweets.setdefault(tweet['tweet_id'], tweet)
+    return list(category_tweets.values())
+
+
+def select_fields(tweets, fields):
+    if fields:
+        keep = set(fields) | {'tweet_id', 'metadata'}
+        for tweet in tweets:
+            for field in set(tweet) - keep:
+                del tweet[field]
+
+
+def stream_search(query_params, batch_size=100):
+    """The /search response as (key, value) parts for json_stream, without building it in memory.
+
+    The user lookup and the cursor are checked before returning, so their errors can still become a
+    400; the parts then follow the aggregation cursor a batch at a time. A cached response is streamed
+    from the cache, a streamed one is not cached.
+    """
+    params = normalize_query(query_params)
+    query_key_stats.record(query_params, params)
+    results, fresh = search_cache.get_entry(query_key(params))
+    if results and fresh:
+        return cached_parts(results)
+
+    options = search_options(params)
+    query_filter = build_query_filter(options['query_string'], options['hashtag'],
+                                      lookup_user_id(options['user']) if options['user'] else None,
+                                      options['time_range'])
+    key = rank_key(options['formula'], '$text' in query_filter)
+    if len(chunked_filters(query_filter)) > 1:
+        # Candidates of a common keyword are ranked chunk by chunk, only the merged page can be sent
+        top_by_category, ranked_results_list = rank_tweets(
+            tweets_collection, query_filter, formula=options['formula'], limit=options['limit'],
+            category_limit=options['category_limit'], after=options['after'], fields=options['fields'])
+        return cached_parts(package_results(params, top_by_category, ranked_results_list, key))
+    pipeline, category_pipelines = ranking_plan(query_filter, options['formula'], options['limit'],
+                                                options['category_limit'], options['after'], options['fields'])
+    return streamed_parts(params, options, pipeline, category_pipelines, key, batch_size)
+
+
+def cached_parts(results):
+    for tweet in results['results']:
+        yield 'result', tweet
+    yield 'next_cursor', results['next_cursor']
+    if 'top_by_category' in results:
+        yield 'top_by_category', results['top_by_category']
+        yield 'category_tweets', results['category_tweets']
+
+
+def streamed_parts(params, options, pipeline, category_pipelines, key, batch_size):
+    page_size = options['limit'] - 1  # The extra result only tells whether there is a next page
+    fields = params.get('fields')
+    leading = []  # The first results, for categories that are a slice of them
+    result_ids = set()
+    has_more, next_cursor = False, None
+    cursor = tweets_collection.aggregate(pipeline, batchSize=batch_size)
     try:
         while True:
-            print("Updating cache with top metrics...")
-            top_metrics = calculate_top_metrics(
-                local_mysql_cursor)  # Pass the local cursor
-            lru_cache.put('top_metrics', top_metrics)
-            time.sleep(interval)
+            with stage('rank'):
+                batch = list(itertools.islice(cursor, batch_size))
+            if not batch:
+                break
+            leading += batch[:options['category_limit'] - len(leading)]
+            page = batch[:page_size - len(result_ids)]
+            has_more = len(page) < len(batch)
+            if not page:
+                break
+            next_cursor = encode_cursor(page[-1], key)  # Before select_fields drops the ranking field
+            with stage('metadata'):
+                enrich_with_metadata(page)
+            select_fields(page, fields)
+            for tweet in page:
+                result_ids.add(tweet['tweet_id'])
+                yield 'result', tweet
     finally:
-        local_mysql_cursor.close()
-        local_db_connection.close()
+        cursor.close()
+    yield 'next_cursor', next_cursor if has_more else None
+
+    if not options['after']:
+        with stage('rank'):
+            category_results = {category: None if category_pipeline is None
+                                else list(tweets_collection.aggregate(category_pipeline))
+                                for category, category_pipeline in category_pipelines.items()}
+        top_by_category = assemble_categories(leading, category_results, options['category_limit'])
+        category_tweets = tweets_outside_results(top_by_category, result_ids)
+        with stage('metadata'):
+            enrich_with_metadata(category_tweets)
+        select_fields(category_tweets, fields)
+        yield 'top_by_category', {category: [tweet['tweet_id'] for tweet in tweets]
+                                  for category, tweets in top_by_category.items()}
+        yield 'category_tweets', category_tweets
+
 
+def periodic_cache_update(interval):  # 定时启动cache
+    # Incremental metrics are reloaded as the loader saves them, the collections are only re-sorted
+    # when there are none. Each refresh takes a connection from the pool; the first /top-metrics
+    # request computes them, so starting up doesn't. The hot store is read from MongoDB here every
+    # full update, and gets the tweets inserted since its newest one in between
+    last_full_update = time.time()
+    last_store_update = None
+    while True:
+        reload_top_metrics()
+        reload_text_index()
+        if use_hot_store:
+            if reload_hot_store():
+                last_store_update = time.time()
+            elif last_store_update is None or time.time() - last_store_update >= full_update_interval:
+                refresh_hot_store()
+                last_store_update = time.time()
+            else:
+                sync_hot_store()
+            check_hot_store()
+        if top_metrics is None and time.time() - last_full_update >= full_update_interval:
+            print("Updating cache with top metrics...")
+            metrics_cache.put('top_metrics', calculate_top_metrics())
+            last_full_update = time.time()
+        time.sleep(interval)
+
+
+# Counters the caches, the user directory, the MySQL pool and the single flights keep themselves
+def collect_service_metrics():
+    if service_pid != os.getpid():
+        return  # Not started in this process
+    for namespace, totals in caches.stats().items():
+        labels = {'namespace': namespace}
+        for name in ('hits', 'stale_hits', 'misses', 'evictions', 'expirations'):
+            yield f'tweeter_cache_{name}_total', 'counter', labels, totals.get(name, 0)
+        for name in ('entries', 'bytes'):
+            yield f'tweeter_cache_{name}', 'gauge', labels, totals.get(name, 0)
+    query_keys = query_key_stats.stats()
+    yield 'tweeter_search_requests_total', 'counter', {}, query_keys['requests']
+    yield 'tweeter_search_normalized_total', 'counter', {}, query_keys['normalized']
+    directory = user_directory.stats()
+    yield 'tweeter_user_directory_users', 'gauge', {}, directory['users']
+    yield 'tweeter_user_directory_hits_total', 'counter', {}, directory['hits']
+    yield 'tweeter_user_directory_misses_total', 'counter', {}, directory['misses']
+    pool = mysql_pool.stats()
+    for name in ('checkouts', 'timeouts', 'failures', 'reconnects'):
+        yield f'tweeter_mysql_pool_{name}_total', 'counter', {}, pool[name]
+    for name in ('size', 'in_use', 'idle', 'waiting'):
+        yield f'tweeter_mysql_pool_{name}', 'gauge', {}, pool[name]
+    yield 'tweeter_mysql_pool_wait_seconds_total', 'counter', {}, pool['wait_time_total']
+    yield 'tweeter_single_flight_executions_total', 'counter', {}, flights.executions
+    yield 'tweeter_single_flight_shared_total', 'counter', {}, flights.shared
+    if hot_store is not None:
+        store = hot_store.stats()
+        yield 'tweeter_hot_store_tweets', 'gauge', {}, store['tweets']
+        yield 'tweeter_hot_store_bytes', 'gauge', {}, store['column_bytes'] + store['posting_bytes']
+
+
+metrics.add_collector(collect_service_metrics)
+
+# Written by the loaders with --ingest-metrics, appended to /metrics while it exists
+ingest_metrics_file = 'ingest_metrics.prom'
+
+
+def metrics_text():
+    text = metrics.render()
+    try:
+        with open(ingest_metrics_file) as f:
+            text += f.read()
+    except OSError:
+        pass
+    return text
+
+
+update_interval = 10  # Check for new incremental metrics every 10 seconds
+full_update_interval = 3600  # Re-sort the collections every hour without them
+checkpoint_interval = 600
+
+
+def start(background=True):
+    """Create the connections, caches and text index and start the background threads, once per process.
+
+    Called on the first request by api.py and at startup by async_api.py. A process forked after
+    start() runs it again, so it doesn't share sockets or threads with its parent. With
+    background=False no thread is started, for callers that drive the service themselves.
+    """
+    global service_pid, mongo_client, mongo_db, tweets_collection, mysql_pool, user_directory, flights, \
+        caches, search_cache, metadata_cache, metrics_cache, text_index, search_backend
+    if service_pid == os.getpid():
+        return
+    with start_lock:
+        if service_pid == os.getpid():
+            return
+
+        # MongoDB connection setup, connecting on the first query
+        mongo_client = MongoClient('...', connect=False,
+                                   event_listeners=[MongoCommandTimer()])  # Counts and times round trips
+        mongo_db = mongo_client['TwitterData']
+        tweets_collection = mongo_db['tweets']
+
+        # Connections are opened on demand
+        mysql_pool = ConnectionPool(
+            lambda: create_server_connection("localhost", "root", "...", "TwitterData"),
+            max_size=10, checkout_timeout=5.0)
+        user_directory = UserDirectory(lambda: mysql_pool.connection(), refresh_interval=60)
+
+        if shared_cache_address:
+            caches = NamespacedCache(cache_budgets, ttl=3600, checkpoint_file=None,
+                                     backend_factory=socket_backend_factory(shared_cache_address))
+        else:
+            # Restored in the background while requests are served
+            caches = NamespacedCache(cache_budgets, ttl=3600, lazy_load=background)
+        search_cache, metadata_cache, metrics_cache = caches['search'], caches['metadata'], caches['metrics']
+        flights = SingleFlight()
+
+        reload_text_index()
+        search_backend = 'index' if text_index is not None else 'text'
+
+        if background:
+            # Run periodic cache update as a background thread
+            update_thread = threading.Thread(
+                target=periodic_cache_update, args=(update_interval,))
+            update_thread.daemon = True  # Daemonize thread
+            update_thread.start()
+
+            user_directory.start()
+
+            # Checkpoint the caches in the background so a restart comes back warm, the shared server does its own.
+            # Every worker runs the thread, the one holding the checkpoint lock writes the files
+            if not shared_cache_address:
+                checkpoint_thread = threading.Thread(
+                    target=caches.periodic_checkpoint, args=(checkpoint_interval,))
+                checkpoint_thread.daemon = True
+                checkpoint_thread.start()
+        service_pid = os.getpid()
 
-# Run periodic cache update as a background thread
-update_interval = 3600  # Update every hour
-update_thread = threading.Thread(
-    target=periodic_cache_update, args=(update_interval,))
-update_thread.daemon = True  # Daemonize thread
-update_thread.start()
 
 if __name__ == '__main__':
+    start()
 
     search_params = {
         'query_string': 'trump',
@@ -236,7 +714,7 @@ if __name__ == '__main__':
     results = search_and_rank_tweets(search_params)
     print(results)
 
-    # top_metrics_results = calculate_top_metrics(mysql_cursor)
+    # top_metrics_results = calculate_top_metrics()
     # print(top_metrics_results)
     #
     # tweet_id = 1249403767180668930
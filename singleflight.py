@@ -0,0 +1,64 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one computation whose result every caller shares."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.executions = self.shared = 0
+
+    def run(self, key, flight, fn):
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.done.set()
+
+    def do(self, key, fn, timeout=None):
+        """Return fn(), or wait for the result of the call for key already in flight."""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.executions += 1
+            else:
+                self.shared += 1
+        if leader:
+            self.run(key, flight, fn)
+        elif not flight.done.wait(timeout):
+            raise TimeoutError(f"Timed out waiting for the computation of {key!r}")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def refresh(self, key, fn):
+        """Start fn in the background unless a computation for key is already in flight."""
+        with self.lock:
+            if key in self.flights:
+                return False
+            flight = self.flights[key] = Flight()
+            self.executions += 1
+
+        def background():
+            self.run(key, flight, fn)
+            if flight.error is not None:
+                logger.warning("Background refresh of %r failed: %s", key, flight.error)
+
+        threading.Thread(target=background, daemon=True).start()
+        return True
@@ -0,0 +1,584 @@
+import copy
+import random
+import re
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from instrumentation import record_round_trip
+
+# In-process stand-ins for the MongoDB tweets collection and the MySQL users table, with a fixed
+# latency per round trip. They understand the queries this project sends, not MongoDB or SQL in general.
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# What the database modules read with `from config import *`, for checkouts without a config.py. The stand-ins
+# replace the connections, so these only need to be well formed
+STAND_IN_CONFIG = {
+    'mongo_config': {'uri': 'mongodb://localhost:27017', 'db': 'TwitterData', 'tweets_collection': 'tweets',
+                     'hashtags_collection': 'hashtags'},
+    'mysql_config': {'host': 'localhost', 'user': 'root', 'password': '', 'db': 'TwitterData'},
+    'data_path': 'data.jsonl',
+}
+
+
+def install_config():
+    """Register a config module built from STAND_IN_CONFIG unless a real one can be imported."""
+    try:
+        import config  # noqa: F401
+    except ModuleNotFoundError:
+        module = types.ModuleType('config')
+        module.__dict__.update(STAND_IN_CONFIG)
+        sys.modules['config'] = module
+
+
+def field_values(document, path):
+    """Values at a dotted path, looking through lists like MongoDB does."""
+    if '.' not in path:
+        value = document.get(path)
+        return value if isinstance(value, list) else [] if value is None and path not in document else [value]
+    values = [document]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(item.get(part) for item in value if isinstance(item, dict) and part in item)
+            elif isinstance(value, dict) and part in value:
+                found.append(value[part])
+        values = found
+    flattened = []
+    for value in values:
+        flattened.extend(value if isinstance(value, list) else [value])
+    return flattened
+
+
+def compare(value, operator, operand):
+    try:
+        if operator == '$gte':
+            return value >= operand
+        if operator == '$lte':
+            return value <= operand
+        if operator == '$gt':
+            return value > operand
+        if operator == '$lt':
+            return value < operand
+    except TypeError:
+        return False  # MongoDB does not compare across types either
+    raise ValueError(f"Unsupported operator {operator}")
+
+
+def matches_condition(values, condition):
+    if not isinstance(condition, dict) or not any(key.startswith('$') for key in condition):
+        return condition in values
+    for operator, operand in condition.items():
+        if operator == '$in':
+            if not any(value in operand for value in values):
+                return False
+        elif operator == '$all':
+            if not all(item in values for item in operand):
+                return False
+        elif operator == '$eq':
+            if operand not in values:
+                return False
+        elif operator == '$regex':
+            flags = re.IGNORECASE if 'i' in condition.get('$options', '') else 0
+            if not any(isinstance(value, str) and re.search(operand, value, flags) for value in values):
+                return False
+        elif operator == '$options':
+            continue
+        elif not any(compare(value, operator, operand) for value in values):
+            return False
+    return True
+
+
+def text_score(document, search):
+    terms = set(TOKEN_PATTERN.findall(search.lower()))
+    tokens = TOKEN_PATTERN.findall(document.get('text', '').lower())
+    return float(sum(token in terms for token in tokens))
+
+
+def matches(document, query_filter):
+    for key, condition in query_filter.items():
+        if key == '$or':
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif key == '$text':
+            if not text_score(document, condition['$search']):
+                return False
+        elif not matches_condition(field_values(document, key), condition):
+            return False
+    return True
+
+
+def evaluate(expression, document, search):
+    if isinstance(expression, str) and expression.startswith('$'):
+        values = field_values(document, expression[1:])
+        return values[0] if values else None
+    if isinstance(expression, dict):
+        (operator, operand), = expression.items()
+        if operator == '$meta':
+            return text_score(document, search or '')
+        arguments = [evaluate(argument, document, search) for argument in operand]
+        if operator == '$ifNull':
+            return arguments[0] if arguments[0] is not None else arguments[1]
+        if operator == '$add':
+            return sum(arguments)
+        if operator == '$multiply':
+            product = 1
+            for argument in arguments:
+                product *= argument
+            return product
+        raise ValueError(f"Unsupported expression {operator}")
+    return expression
+
+
+def sort_value(document, field):
+    values = field_values(document, field)
+    return (0, 0) if not values or values[0] is None else (1, values[0])  # Missing sorts lowest, like null
+
+
+def sort_documents(documents, keys):
+    # Stable sorts from the last key to the first
+    for field, direction in reversed(list(keys)):
+        documents.sort(key=lambda document: sort_value(document, field), reverse=direction < 0)
+    return documents
+
+
+def project_fields(value, fields):
+    """Keep the fields of a projection tree, looking through lists like MongoDB does."""
+    if isinstance(value, list):
+        return [project_fields(item, fields) for item in value if isinstance(item, (dict, list))]
+    projected = {}
+    for field, subfields in fields.items():
+        if field not in value:
+            continue
+        if not subfields:
+            projected[field] = value[field]
+        elif isinstance(value[field], (dict, list)):
+            projected[field] = project_fields(value[field], subfields)
+    return projected
+
+
+def project(document, projection):
+    included = [field for field, flag in projection.items() if flag and field != '_id']
+    if included:
+        fields = {}
+        for path in included:
+            node = fields
+            for part in path.split('.'):
+                node = node.setdefault(part, {})
+        projected = project_fields(document, fields)
+        if projection.get('_id', 1) and '_id' in document:
+            projected['_id'] = document['_id']
+        return projected
+    return {field: value for field, value in document.items() if projection.get(field, 1)}
+
+
+class RoundTrips:
+    """Round trips per stand-in database, shared by every connection to it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, database, latency):
+        with self.lock:
+            self.counts[database] = self.counts.get(database, 0) + 1
+        if latency:
+            time.sleep(latency)
+
+
+class FakeCursor:
+    def __init__(self, collection, documents):
+        self.collection = collection
+        self.documents = documents
+        self.limit_count = 0
+
+    def sort(self, key, direction=1):
+        keys = [(key, direction)] if isinstance(key, str) else key
+        sort_documents(self.documents, keys)
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        self.collection.round_trip()
+        documents = self.documents[:self.limit_count] if self.limit_count else self.documents
+        return iter([copy.deepcopy(document) for document in documents])
+
+
+class FakeCommandCursor:
+    """Aggregation results, iterated and closed like pymongo's CommandCursor."""
+
+    def __init__(self, documents):
+        self.documents = iter(documents)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.documents)
+
+    def close(self):
+        self.documents = iter(())
+
+
+class WriteResult:
+    def __init__(self, inserted_ids=(), matched_count=0, upserted_count=0):
+        self.inserted_ids = list(inserted_ids)
+        self.matched_count = matched_count
+        self.modified_count = matched_count
+        self.upserted_count = upserted_count
+
+
+def apply_update(document, update):
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            if operator == '$set':
+                document[field] = value
+            elif operator == '$inc':
+                document[field] = document.get(field, 0) + value
+            elif operator == '$addToSet':
+                values = document.setdefault(field, [])
+                for item in value['$each'] if isinstance(value, dict) and '$each' in value else [value]:
+                    if item not in values:
+                        values.append(item)
+            else:
+                raise ValueError(f"Unsupported update {operator}")
+
+
+class FakeCollection:
+    """Collection kept in a list with a unique key, supporting find, find_one, the ranking pipelines
+    and the writes of the loaders."""
+
+    def __init__(self, documents=(), latency=0.0, round_trips=None, key='tweet_id'):
+        self.documents = list(documents)
+        for document in self.documents:
+            document.setdefault('_id', ObjectId())  # Set on the caller's dicts, like insert_many does
+        self.latency = latency
+        self.round_trips = round_trips or RoundTrips()
+        self.key = key
+        self.by_key = {document[key]: document for document in self.documents}  # Unique index
+        self.positions = {document[key]: position for position, document in enumerate(self.documents)}
+        # Documents matching recent filters; the results and category pipelines of a search share one
+        self.matched = OrderedDict()
+        self.lock = threading.Lock()
+
+    def match(self, query_filter):
+        key = repr(query_filter)
+        with self.lock:
+            documents = self.matched.get(key)
+            if documents is not None:
+                self.matched.move_to_end(key)
+                return documents
+        documents = [document for document in self.documents if matches(document, query_filter)]
+        with self.lock:
+            self.matched[key] = documents
+            if len(self.matched) > 256:
+                self.matched.popitem(last=False)
+        return documents
+
+    def round_trip(self):
+        record_round_trip('mongo')  # What the driver's command listener reports for a real server
+        self.round_trips.record('mongo', self.latency)
+
+    def create_index(self, keys, **kwargs):
+        self.round_trip()
+        return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+    def find_one(self, query_filter=None):
+        self.round_trip()
+        if query_filter and list(query_filter) == [self.key] and not isinstance(query_filter[self.key], dict):
+            document = self.by_key.get(query_filter[self.key])
+            return copy.deepcopy(document) if document is not None else None
+        for document in self.documents:
+            if matches(document, query_filter or {}):
+                return copy.deepcopy(document)
+        return None
+
+    def store(self, document):
+        position = self.positions.get(document[self.key])
+        if position is not None:
+            document.setdefault('_id', self.documents[position]['_id'])  # Replacing keeps the _id
+            self.documents[position] = document
+        else:
+            document.setdefault('_id', ObjectId())
+            self.positions[document[self.key]] = len(self.documents)
+            self.documents.append(document)
+        self.by_key[document[self.key]] = document
+        self.matched.clear()
+
+    def insert_many(self, documents, ordered=True):
+        from pymongo.errors import BulkWriteError
+        self.round_trip()
+        inserted, errors = [], []
+        with self.lock:
+            for index, document in enumerate(documents):
+                if document[self.key] in self.by_key:
+                    errors.append({'index': index, 'code': 11000, 'errmsg': 'E11000 duplicate key error'})
+                    if ordered:
+                        break
+                    continue
+                self.store(document)
+                inserted.append(document[self.key])
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted)})
+        return WriteResult(inserted_ids=inserted)
+
+    def replace(self, query_filter, document, upsert):
+        existing = self.by_key.get(query_filter[self.key])
+        if existing is None and not upsert:
+            return WriteResult()
+        self.store(dict(document))
+        return WriteResult(matched_count=existing is not None, upserted_count=existing is None)
+
+    def update(self, query_filter, update, upsert):
+        existing = self.by_key.get(query_filter[self.key])
+        if existing is None and not upsert:
+            return WriteResult()
+        document = copy.deepcopy(existing) if existing is not None else dict(query_filter)
+        apply_update(document, update)
+        self.store(document)
+        return WriteResult(matched_count=existing is not None, upserted_count=existing is None)
+
+    def replace_one(self, query_filter, document, upsert=False):
+        self.round_trip()
+        with self.lock:
+            return self.replace(query_filter, document, upsert)
+
+    def update_one(self, query_filter, update, upsert=False):
+        self.round_trip()
+        with self.lock:
+            return self.update(query_filter, update, upsert)
+
+    def bulk_write(self, requests, ordered=True):
+        # ReplaceOne and UpdateOne keep their arguments in these attributes
+        self.round_trip()
+        result = WriteResult()
+        with self.lock:
+            for request in requests:
+                write = self.replace if type(request).__name__ == 'ReplaceOne' else self.update
+                outcome = write(request._filter, request._doc, request._upsert)
+                result.matched_count += outcome.matched_count
+                result.upserted_count += outcome.upserted_count
+        result.modified_count = result.matched_count
+        return result
+
+    def estimated_document_count(self):
+        self.round_trip()
+        return len(self.documents)
+
+    def find(self, query_filter=None, projection=None):
+        documents = list(self.match(query_filter or {}))
+        if projection:
+            documents = [project(document, projection) for document in documents]
+        return FakeCursor(self, documents)
+
+    def aggregate(self, pipeline, batchSize=None):
+        self.round_trip()
+        documents, search = self.documents, None
+        for position, stage in enumerate(pipeline):
+            (operator, spec), = stage.items()
+            if operator == '$match':
+                search = spec.get('$text', {}).get('$search', search)
+                documents = self.match(spec) if position == 0 else [
+                    document for document in documents if matches(document, spec)]
+            elif operator == '$addFields':
+                documents = [dict(document, **{field: evaluate(expression, document, search)
+                                               for field, expression in spec.items()})
+                             for document in documents]
+            elif operator == '$sort':
+                documents = sort_documents(list(documents), spec.items())
+            elif operator == '$limit':
+                documents = documents[:spec]
+            elif operator == '$project':
+                documents = [project(document, spec) for document in documents]
+            else:
+                raise ValueError(f"Unsupported stage {operator}")
+        return FakeCommandCursor([copy.deepcopy(document) for document in documents])
+
+
+INSERT_PATTERN = re.compile(r"\s*INSERT INTO users\s*\((?P<columns>[^)]*)\)", re.IGNORECASE)
+SELECT_PATTERN = re.compile(
+    r"SELECT\s+(?P<columns>.+?)\s+FROM\s+users"
+    r"(?:\s+WHERE\s+(?P<column>\w+)\s*(?P<operator>>=|=|>|IN)\s*(?P<placeholder>\(.*?\)|%s))?"
+    r"(?:\s+ORDER BY\s+(?P<order>\w+)(?:\s+(?P<direction>ASC|DESC))?)?"
+    r"(?:\s+LIMIT\s+(?P<limit>\d+))?\s*$", re.IGNORECASE | re.DOTALL)
+
+
+class FakeMySQLCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def upsert(self, sql, row):
+        # INSERT ... ON DUPLICATE KEY UPDATE of every column; updated_at only moves when a value changed
+        columns = [name.strip() for name in INSERT_PATTERN.match(sql).group('columns').split(',')]
+        values = dict(zip(columns, row))
+        values['user_id'] = int(values['user_id'])
+        users = self.connection.users
+        current = users.get(values['user_id'])
+        if current is None or any(current.get(column) != value for column, value in values.items()):
+            values['updated_at'] = datetime.now(timezone.utc).replace(tzinfo=None)
+            users[values['user_id']] = dict(current or {}, **values)
+            if self.connection.snapshot is not None:
+                self.connection.snapshot[values['user_id']] = users[values['user_id']]  # Own writes are visible
+
+    def executemany(self, sql, rows):
+        self.connection.round_trip()
+        for row in rows:
+            self.upsert(sql, row)
+        return len(rows)
+
+    def execute(self, sql, args=None):
+        self.connection.round_trip()
+        if INSERT_PATTERN.match(sql):
+            self.upsert(sql, args)
+            return 1
+        if sql.startswith(('SAVEPOINT', 'ROLLBACK TO SAVEPOINT')):
+            return 0  # Writes are applied immediately, there is nothing to roll back
+        match = SELECT_PATTERN.match(sql.strip())
+        if match is None:
+            raise ValueError(f"Unsupported statement: {sql}")
+        args = list(args) if isinstance(args, (list, tuple)) else [] if args is None else [args]
+        rows = list(self.connection.visible_users().values())
+        column = match.group('column')
+        if column:
+            operator = match.group('operator').upper()
+            if operator == 'IN':
+                wanted = {str(arg) for arg in args}
+                rows = [row for row in rows if str(row[column]) in wanted]
+            elif operator == '>':
+                rows = [row for row in rows if row[column] > args[0]]
+            elif operator == '>=':
+                rows = [row for row in rows if row[column] >= args[0]]
+            else:  # Case-insensitive like the default MySQL collation
+                rows = [row for row in rows if str(row[column]).casefold() == str(args[0]).casefold()]
+        if match.group('order'):
+            rows.sort(key=lambda row: row[match.group('order')],
+                      reverse=(match.group('direction') or '').upper() == 'DESC')
+        if match.group('limit'):
+            rows = rows[:int(match.group('limit'))]
+        columns = [name.strip() for name in match.group('columns').split(',')]
+        if columns != ['*']:
+            rows = [{name: row[name] for name in columns} for row in rows]
+        self.rows = [dict(row) for row in rows]
+        return len(self.rows)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeMySQLConnection:
+    """pymysql DictCursor connection over a dict of user rows keyed by user_id.
+
+    Like InnoDB under REPEATABLE READ, without autocommit the first SELECT of a transaction takes a
+    snapshot that later SELECTs read until commit or rollback.
+    """
+
+    def __init__(self, users, latency=0.0, round_trips=None):
+        self.users = users
+        self.latency = latency
+        self.round_trips = round_trips or RoundTrips()
+        self.autocommit_mode = False  # pymysql's default
+        self.snapshot = None
+
+    def round_trip(self):
+        self.round_trips.record('mysql', self.latency)
+
+    def visible_users(self):
+        if self.autocommit_mode:
+            return self.users
+        if self.snapshot is None:
+            self.snapshot = dict(self.users)  # Rows are replaced on upsert, never changed in place
+        return self.snapshot
+
+    def autocommit(self, value):
+        self.round_trip()
+        self.autocommit_mode = bool(value)
+        self.snapshot = None
+
+    def get_autocommit(self):
+        return self.autocommit_mode
+
+    def cursor(self, cursor_class=None):
+        return FakeMySQLCursor(self)  # Every cursor returns dicts
+
+    def ping(self, reconnect=False):
+        pass
+
+    def commit(self):
+        self.snapshot = None
+
+    def rollback(self):
+        self.snapshot = None
+
+    def close(self):
+        pass
+
+
+def make_dataset(tweets=10000, users=1000, hashtags=200, seed=0):
+    """Tweet documents shaped like create_tweet_document output and the matching user rows."""
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(500)]
+    tags = [f"tag{i}" for i in range(hashtags)]
+    start = datetime(2020, 4, 1, tzinfo=timezone.utc)
+    user_rows = {
+        user_id: {'user_id': user_id, 'name': f"User {user_id}", 'screen_name': f"user{user_id}",
+                  'followers_count': rng.randint(0, 100000), 'updated_at': start.replace(tzinfo=None)}
+        for user_id in range(1, users + 1)
+    }
+    documents = []
+    for tweet_id in range(1, tweets + 1):
+        user_id = rng.randint(1, users)
+        tweet_tags = rng.sample(tags, rng.randint(0, 3))
+        documents.append({
+            'tweet_id': str(tweet_id),
+            'user_id': str(user_id),
+            'name': user_rows[user_id]['name'],
+            'screen_name': user_rows[user_id]['screen_name'],
+            'text': ' '.join(rng.choices(words, k=12)),
+            'created_at': start + timedelta(seconds=tweet_id * 60),
+            'is_retweet': False,
+            'quote_count': rng.randint(0, 50),
+            'reply_count': rng.randint(0, 50),
+            'retweet_count': int(rng.paretovariate(1.2)) - 1,
+            'favorite_count': int(rng.paretovariate(1.1)) - 1,
+            'hashtags': [{'text': tag} for tag in tweet_tags],
+        })
+    return documents, user_rows
+
+
+def install(search_service, documents, users, latency=0.0, pool_size=10):
+    """Point an imported search_service at stand-ins instead of the real databases."""
+    from mysql_pool import ConnectionPool
+    search_service.start(background=False)  # No refresh threads against the real databases
+    round_trips = RoundTrips()
+    search_service.tweets_collection = FakeCollection(documents, latency, round_trips)
+    search_service.mysql_pool = ConnectionPool(lambda: FakeMySQLConnection(users, latency, round_trips),
+                                               max_size=pool_size)
+    search_service.search_backend = 'regex'  # No text index or $text outside MongoDB
+    search_service.user_directory.load()
+    return round_trips
@@ -0,0 +1,150 @@
+import pickle
+import threading
+import time
+import pytest
+from cache import LRUCacheWithTTL
+
+
+def make_cache(**options):
+    options.setdefault('ttl', 3600)
+    return LRUCacheWithTTL(checkpoint_file=None, **options)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = make_cache(capacity=2, shards=1)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # b is now the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['totals']['evictions'] == 1
+
+
+@pytest.mark.parametrize('capacity, shards', [(10, 4), (3, 16), (1000, 7)])
+def test_shards_split_the_capacity(capacity, shards):
+    cache = make_cache(capacity=capacity, shards=shards)
+    assert sum(shard.capacity for shard in cache.shards) == capacity
+    assert len(cache.shards) == min(capacity, shards)
+    for i in range(capacity * 5):
+        cache.put(f'key{i}', i)
+    assert len(cache) <= capacity
+
+
+def test_shards_split_the_byte_budget():
+    cache = make_cache(max_bytes=20000, shards=4)
+    assert sum(shard.max_bytes for shard in cache.shards) == 20000
+    for i in range(500):
+        cache.put(f'key{i}', 'x' * 100)
+    assert 0 < cache.stats()['totals']['bytes'] <= 20000
+    assert all(shard.bytes <= shard.max_bytes for shard in cache.shards)
+
+
+def test_expired_entries_are_stale_then_gone(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('cache.time.time', lambda: now[0])
+    cache = make_cache(capacity=10, ttl=10, stale_ttl=5)
+    cache.put('a', 1)
+    now[0] += 12
+    assert cache.get('a') is None
+    assert cache.get_entry('a') == (1, False)
+    now[0] += 5
+    assert cache.get_entry('a') == (None, False)
+    assert len(cache) == 0
+
+
+def test_concurrent_puts_and_gets_keep_the_counters_and_budget():
+    cache = make_cache(capacity=64, shards=8)
+    threads, gets_per_thread = 8, 2000
+    errors = []
+
+    def worker(seed):
+        try:
+            for i in range(gets_per_thread):
+                key = f'key{(seed * 7919 + i) % 200}'
+                if cache.get(key) is None:
+                    cache.put(key, i)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    assert not errors
+    totals = cache.stats()['totals']
+    assert totals['hits'] + totals['stale_hits'] + totals['misses'] == threads * gets_per_thread
+    assert totals['entries'] == len(cache) <= 64
+    assert all(len(shard.entries) <= shard.capacity for shard in cache.shards)
+
+
+def checkpointed_cache(path, **options):
+    options.setdefault('capacity', 100)
+    return LRUCacheWithTTL(ttl=3600, checkpoint_file=str(path), shards=4, **options)
+
+
+def test_snapshot_and_delta_log_restore_every_entry(tmp_path):
+    path = tmp_path / 'cache.pkl'
+    cache = checkpointed_cache(path)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.checkpoint(full=True)
+    cache.put('b', 3)
+    cache.put('c', 4)
+    cache.checkpoint()
+    assert cache.log_records == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['cache.pkl', 'cache.pkl.lock', 'cache.pkl.log']
+
+    restored = checkpointed_cache(path)
+    assert {key: restored.get(key) for key in 'abc'} == {'a': 1, 'b': 3, 'c': 4}
+    assert restored.generation == cache.generation
+
+
+def test_torn_log_tail_is_dropped_and_cut(tmp_path):
+    path = tmp_path / 'cache.pkl'
+    cache = checkpointed_cache(path)
+    cache.put('a', 1)
+    cache.checkpoint(full=True)
+    cache.put('b', 2)
+    cache.checkpoint()
+    good_size = (tmp_path / 'cache.pkl.log').stat().st_size
+    with open(tmp_path / 'cache.pkl.log', 'ab') as log:
+        log.write(pickle.dumps(('c', 3, time.time()))[:-3])  # Crashed halfway through an append
+    cache.owner_file.close()  # The crashed writer's lock goes with it
+
+    restored = checkpointed_cache(path)
+    assert restored.get('a') == 1 and restored.get('b') == 2 and restored.get('c') is None
+    assert (tmp_path / 'cache.pkl.log').stat().st_size == good_size
+    restored.put('d', 4)
+    restored.checkpoint()
+    assert checkpointed_cache(path).get('d') == 4
+
+
+def test_log_of_an_older_snapshot_is_ignored(tmp_path):
+    path = tmp_path / 'cache.pkl'
+    cache = checkpointed_cache(path)
+    cache.put('a', 1)
+    cache.checkpoint(full=True)
+    cache.put('a', 2)
+    cache.checkpoint()
+    old_log = (tmp_path / 'cache.pkl.log').read_bytes()
+    cache.put('a', 3)
+    cache.checkpoint(full=True)
+    # Crashed after the new snapshot replaced the old one, before the log was started over
+    (tmp_path / 'cache.pkl.log').write_bytes(old_log)
+
+    assert checkpointed_cache(path).get('a') == 3
+
+
+def test_only_the_lock_owner_writes_the_checkpoint(tmp_path):
+    path = tmp_path / 'cache.pkl'
+    owner, other = checkpointed_cache(path), checkpointed_cache(path)
+    owner.put('a', 1)
+    owner.checkpoint()
+    other.put('b', 2)
+    other.checkpoint()
+    assert owner.owns_checkpoint() and not other.owns_checkpoint()
+    restored = checkpointed_cache(path)
+    assert restored.get('a') == 1 and restored.get('b') is None
+    assert not [p for p in tmp_path.iterdir() if p.suffix == '.tmp']
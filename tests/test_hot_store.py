@@ -0,0 +1,108 @@
+import copy
+import pickle
+from datetime import datetime, timedelta, timezone
+import pytest
+import hot_store
+from hot_store import HotTweetStore
+from ranking import encode_cursor, rank_key, ranking_pipeline
+from stand_ins import FakeCollection, make_dataset
+
+T0 = datetime(2020, 4, 1, tzinfo=timezone.utc)
+
+SELECTIVE_FILTERS = [
+    {'hashtags.text': 'tag3'},
+    {'hashtags.text': {'$all': ['tag3', 'tag5']}},
+    {'user_id': '17'},
+    {'user_id': '17', 'hashtags.text': 'tag2'},
+    {'hashtags.text': 'tag1', 'created_at': {'$gte': T0 + timedelta(hours=2), '$lte': T0 + timedelta(hours=8)}},
+    {'tweet_id': {'$in': [str(i) for i in range(1, 600, 3)] + ['nope']}, 'user_id': '3'},
+    {'hashtags.text': 'missing'},
+]
+FORMULAS = ['retweets', 'favorites', 'engagement', {'retweet_count': 1, 'reply_count': 3}, {'favorite_count': -1}]
+
+
+def dataset():
+    # Ids of 1 to 3 digits and mostly tied counts, so the tweet_id tie-break decides most pages
+    documents, _ = make_dataset(600, 40, hashtags=12, seed=4)
+    for document in documents:
+        document['retweet_count'] %= 3
+        document['favorite_count'] %= 2
+    return documents
+
+
+@pytest.fixture(scope='module')
+def collection():
+    return FakeCollection(dataset())
+
+
+def pages(rank, query_filter, formula, limit, pages=4):
+    """Every page of a ranking, following the keyset cursor of each page's last tweet."""
+    key, after, ranked = rank_key(formula), None, []
+    for _ in range(pages):
+        page = rank(query_filter, formula, limit, after)
+        ranked.append(page)
+        if not page:
+            break
+        after = encode_cursor({'tweet_id': page[-1][0], key: page[-1][1]}, key)
+    return ranked
+
+
+def pipeline_rank(collection):
+    def rank(query_filter, formula, limit, after):
+        key = rank_key(formula)
+        return [(tweet['tweet_id'], tweet[key])
+                for tweet in collection.aggregate(ranking_pipeline(query_filter, formula, limit, after))]
+    return rank
+
+
+def store_of(documents):
+    store = HotTweetStore()
+    store.add_many(documents)
+    return store
+
+
+@pytest.fixture(scope='module')
+def stores(collection):
+    """The same tweets added in one batch, read from the collection, and saved halfway then resumed."""
+    documents = [copy.deepcopy(document) for document in collection.documents]
+    half = HotTweetStore().add_from_collection(FakeCollection(documents[:300]))
+    resumed = pickle.loads(pickle.dumps(half))
+    resumed.add_many(documents[300:])
+    return {'add_many': store_of(documents),
+            'add_from_collection': HotTweetStore().add_from_collection(collection),
+            'saved and resumed': resumed}
+
+
+@pytest.mark.parametrize('query_filter', SELECTIVE_FILTERS)
+@pytest.mark.parametrize('formula', FORMULAS, ids=str)
+@pytest.mark.parametrize('limit', [1, 7, 50])
+def test_store_pages_match_the_ranking_pipeline(collection, stores, query_filter, formula, limit):
+    expected = pages(pipeline_rank(collection), query_filter, formula, limit)
+    for name, store in stores.items():
+        assert pages(store.rank, query_filter, formula, limit) == expected, name
+
+
+@pytest.mark.parametrize('query_filter', [{}, {'created_at': {'$gte': T0, '$lte': T0 + timedelta(hours=3)}},
+                                          {'$text': {'$search': 'word1'}}, {'text': {'$regex': 'word1'}}])
+def test_unselective_filters_are_left_to_mongodb(stores, query_filter):
+    assert stores['add_from_collection'].rank(query_filter) is None
+
+
+def test_too_many_candidates_are_left_to_mongodb(stores, monkeypatch):
+    store = stores['add_from_collection']
+    assert store.rank({'hashtags.text': 'tag3'}) is not None
+    monkeypatch.setattr(hot_store, 'MAX_CANDIDATES', 10)
+    assert store.rank({'hashtags.text': 'tag3'}) is None
+
+
+def test_new_tweets_are_added_from_the_newest_id():
+    documents = dataset()
+    collection = FakeCollection(copy.deepcopy(documents[:400]))
+    store = HotTweetStore().add_from_collection(collection)
+    collection.insert_many(copy.deepcopy(documents[400:]))
+    assert store.add_new_from_collection(collection) >= 200
+    assert len(store) == 600
+    for query_filter in SELECTIVE_FILTERS:
+        assert (pages(store.rank, query_filter, 'engagement', 20) ==
+                pages(pipeline_rank(collection), query_filter, 'engagement', 20))
+    assert store_of(documents).add_new_from_collection(collection) is None  # No _id to go on
@@ -0,0 +1,113 @@
+import threading
+import time
+import pymysql
+import pytest
+from mysql_pool import ConnectionPool, PoolTimeout
+from stand_ins import FakeMySQLConnection
+
+
+class CountingConnect:
+    """Connection factory that remembers what it made; fail=True returns None like create_server_connection."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.connections = []
+
+    def __call__(self):
+        if self.fail:
+            return None
+        connection = FakeMySQLConnection({})
+        self.connections.append(connection)
+        return connection
+
+
+class DeadConnection(FakeMySQLConnection):
+    def ping(self, reconnect=False):
+        raise pymysql.OperationalError(2006, 'MySQL server has gone away')
+
+
+def test_connections_are_reused_in_autocommit_mode():
+    connect = CountingConnect()
+    pool = ConnectionPool(connect, max_size=2)
+    for _ in range(5):
+        with pool.connection() as connection:
+            assert connection.get_autocommit()
+    assert len(connect.connections) == 1
+    assert pool.stats()['checkouts'] == 5 and pool.stats()['idle'] == 1
+
+
+def test_concurrent_checkouts_stay_within_max_size():
+    connect = CountingConnect()
+    pool = ConnectionPool(connect, max_size=3)
+    in_use, peak, errors = [0], [0], []
+    lock = threading.Lock()
+
+    def work():
+        try:
+            for _ in range(20):
+                with pool.connection():
+                    with lock:
+                        in_use[0] += 1
+                        peak[0] = max(peak[0], in_use[0])
+                    time.sleep(0.001)
+                    with lock:
+                        in_use[0] -= 1
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert peak[0] <= 3 and len(connect.connections) <= 3
+    stats = pool.stats()
+    assert stats['checkouts'] == 200 and stats['in_use'] == 0 and stats['waiting'] == 0
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted():
+    pool = ConnectionPool(CountingConnect(), max_size=1)
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            pool.checkout(timeout=0.05)
+    assert pool.stats()['timeouts'] == 1
+    with pool.connection(timeout=0.05):
+        pass
+
+
+def test_connection_that_failed_a_query_is_replaced():
+    connect = CountingConnect()
+    pool = ConnectionPool(connect, max_size=1)
+    with pytest.raises(pymysql.OperationalError):
+        with pool.connection():
+            raise pymysql.OperationalError(2013, 'Lost connection to MySQL server during query')
+    assert pool.stats()['size'] == 0
+    with pool.connection() as connection:
+        assert connection is connect.connections[1]
+
+
+def test_failed_connect_frees_its_slot():
+    connect = CountingConnect(fail=True)
+    pool = ConnectionPool(connect, max_size=1)
+    with pytest.raises(ConnectionError):
+        pool.checkout(timeout=0.05)
+    assert pool.stats()['size'] == 0 and pool.stats()['failures'] == 1
+    connect.fail = False
+    with pool.connection(timeout=0.05) as connection:
+        assert connection is connect.connections[0]
+
+
+def test_idle_connection_failing_its_ping_is_reopened():
+    made = []
+
+    def connect():
+        made.append(DeadConnection({}) if not made else FakeMySQLConnection({}))
+        return made[-1]
+
+    pool = ConnectionPool(connect, max_size=1, health_check_interval=0)
+    with pool.connection():
+        pass
+    with pool.connection() as connection:
+        assert connection is made[1]
+    assert pool.stats()['reconnects'] == 1 and pool.stats()['size'] == 1
@@ -0,0 +1,94 @@
+import threading
+import pytest
+from singleflight import SingleFlight
+
+
+def run_concurrently(count, target):
+    results, errors = [None] * count, []
+
+    def call(index):
+        try:
+            results[index] = target()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def release_when_shared(flights, waiters, release):
+    """Let the computation finish once every waiter joined it."""
+    def watch():
+        while flights.shared < waiters:
+            release.wait(0.001)
+        release.set()
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def test_concurrent_callers_share_one_computation():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    leader = threading.Thread(target=flights.do, args=('key', compute))
+    leader.start()
+    started.wait(5)
+    release_when_shared(flights, 8, release)
+    results, errors = run_concurrently(8, lambda: flights.do('key', compute))
+    leader.join()
+    assert not errors and results == ['value'] * 8
+    assert len(calls) == 1
+    assert (flights.executions, flights.shared) == (1, 8)
+    assert not flights.flights
+
+
+def test_every_caller_sees_the_error():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def compute():
+        release.wait(5)
+        raise ValueError('failed')
+
+    release_when_shared(flights, 3, release)
+    results, errors = run_concurrently(4, lambda: flights.do('key', compute))
+    assert len(errors) == 4 and all(isinstance(e, ValueError) for e in errors)
+    assert flights.do('key', lambda: 'retried') == 'retried'
+
+
+def test_waiter_times_out():
+    flights = SingleFlight()
+    release = threading.Event()
+    leader = threading.Thread(target=flights.do, args=('key', lambda: release.wait(5)))
+    leader.start()
+    while 'key' not in flights.flights:
+        pass
+    with pytest.raises(TimeoutError):
+        flights.do('key', lambda: 'unused', timeout=0.05)
+    release.set()
+    leader.join()
+
+
+def test_refresh_runs_once_in_the_background():
+    flights = SingleFlight()
+    release, done = threading.Event(), threading.Event()
+
+    def compute():
+        release.wait(5)
+        done.set()
+
+    assert flights.refresh('key', compute)
+    assert not flights.refresh('key', compute)
+    release.set()
+    assert done.wait(5)
+    assert flights.executions == 1
@@ -0,0 +1,50 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from twitter_dates import TWITTER_DATE_FORMAT, parse_twitter_datetime, twitter_date_to_sql
+
+MALFORMED = [
+    'Wed Oct 10 20:19:24 +0000 2018', 'Mon Feb 29 00:00:00 +0000 2021', 'Thu Feb 29 23:59:59 +0000 2024',
+    'Wed Oct 32 20:19:24 +0000 2018', 'Wed Oct 10 24:19:24 +0000 2018', 'Wed Oct 10 20:60:24 +0000 2018',
+    'Wed Oct 10 20:19:61 +0000 2018', 'Wed Foo 10 20:19:24 +0000 2018', 'Xyz Oct 10 20:19:24 +0000 2018',
+    'Wed Oct 10 20:19:24 0000 2018', 'Wed Oct 10 20:19:24 +00:00 2018', 'Wed Oct  1 20:19:24 +0000 2018',
+    'Wed Oct 1 20:19:24 +0000 2018', 'wed oct 10 20:19:24 +0000 2018', 'Wed Oct 10 20:19:24 +0000 018',
+    'Wed Oct 10 20:19:24 +0000 2018 ', 'Wed Oct 10 ２0:19:24 +0000 2018', '', 'not a date',
+    'Wed Oct 10 20:19:24 +0099 2018', 'Wed Oct 10 20:19:24 -0060 2018', 'Wed Oct 10 20:19:24 +0059 2018',
+    'Wed Oct 10 20:19:24 +2359 2018', 'Wed Oct 10 20:19:24 +2400 2018', 'Wed Oct 10 20:19:24 +9900 2018',
+]
+
+
+def generated_dates(samples=20000, seed=0):
+    rng = random.Random(seed)
+    for _ in range(samples):
+        moment = datetime(2006, 1, 1) + timedelta(seconds=rng.randrange(20 * 365 * 86400))
+        offset = rng.choice(['+0000', '+0000', '-0500', '+0530', '+1400', '-1200'])
+        yield moment.strftime('%a %b %d %H:%M:%S ') + offset + moment.strftime(' %Y')
+
+
+def outcome(parse, value):
+    try:
+        return parse(value)
+    except ValueError:
+        return ValueError
+
+
+def mismatch(twitter_date):
+    """None when the fast path and strptime agree on the result, offset, SQL form or error."""
+    expected = outcome(lambda value: datetime.strptime(value, TWITTER_DATE_FORMAT), twitter_date)
+    actual = outcome(parse_twitter_datetime, twitter_date)
+    if actual != expected or (expected is not ValueError and actual.utcoffset() != expected.utcoffset()):
+        return twitter_date, expected, actual
+    if expected is not ValueError and twitter_date_to_sql(twitter_date) != expected.strftime('%Y-%m-%d %H:%M:%S'):
+        return twitter_date, expected, twitter_date_to_sql(twitter_date)
+    return None
+
+
+def test_generated_dates_match_strptime():
+    assert [case for case in map(mismatch, generated_dates()) if case] == []
+
+
+@pytest.mark.parametrize('twitter_date', MALFORMED)
+def test_edge_cases_match_strptime(twitter_date):
+    assert mismatch(twitter_date) is None
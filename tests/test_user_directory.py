@@ -0,0 +1,61 @@
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import pytest
+from mysql_pool import ConnectionPool
+from stand_ins import FakeMySQLConnection
+from user_directory import UserDirectory
+
+UPSERT_SQL = ("INSERT INTO users (user_id, name, screen_name, followers_count) VALUES (%s, %s, %s, %s) "
+              "ON DUPLICATE KEY UPDATE name=VALUES(name)")
+
+
+def user_row(user_id, screen_name):
+    return {'user_id': user_id, 'screen_name': screen_name, 'name': screen_name.title(), 'followers_count': 1,
+            'updated_at': datetime(2020, 1, 1)}
+
+
+def write_user(users, user_id, screen_name):
+    # Committed by another connection, like a loader running next to the service
+    FakeMySQLConnection(users).cursor().execute(UPSERT_SQL, (user_id, screen_name.title(), screen_name, 1))
+
+
+def single_connection(users):
+    """One connection reused for every read, left in pymysql's default non-autocommit mode."""
+    connection = FakeMySQLConnection(users)
+    lock = threading.Lock()
+
+    @contextmanager
+    def checkout():
+        with lock:
+            yield connection
+    return checkout
+
+
+def pooled_connection(users):
+    pool = ConnectionPool(lambda: FakeMySQLConnection(users), max_size=1)
+    return lambda: pool.connection()
+
+
+@pytest.mark.parametrize('connect', [single_connection, pooled_connection])
+def test_refresh_sees_users_written_after_load(connect):
+    users = {1: user_row(1, 'alice')}
+    directory = UserDirectory(connect(users))
+    directory.load()
+    assert directory.get('2') is None
+
+    write_user(users, 2, 'bob')
+    directory.refresh()
+    assert directory.get('2')['screen_name'] == 'bob'
+    assert directory.user_id('Bob') == '2'
+
+
+@pytest.mark.parametrize('connect', [single_connection, pooled_connection])
+def test_miss_falls_back_to_rows_written_after_load(connect):
+    users = {1: user_row(1, 'alice')}
+    directory = UserDirectory(connect(users))
+    directory.load()
+
+    write_user(users, 3, 'carol')
+    assert directory.user_id('carol') == '3'
+    assert directory.users(['3'])['3']['name'] == 'Carol'
@@ -0,0 +1,148 @@
+import bisect
+import os
+import pickle
+import re
+import threading
+
+TOKEN_PATTERN = re.compile(r"\w+")
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+# Split a query into phrases ("make america"), prefixes (trum*) and plain terms
+def parse_query(query_string):
+    phrases, prefixes, terms = [], [], []
+    for phrase, word in QUERY_PATTERN.findall(query_string or ''):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) > 1:
+                phrases.append(tokens)
+            else:
+                terms.extend(tokens)
+        else:
+            tokens = tokenize(word)
+            if word.endswith('*') and tokens:
+                # Only the last token of 'foo-ba*' is a prefix
+                terms.extend(tokens[:-1])
+                prefixes.append(tokens[-1])
+            else:
+                terms.extend(tokens)
+    return phrases, prefixes, terms
+
+
+def intersect(postings_lists):
+    """Intersect sorted posting lists, probing the longer lists with binary search."""
+    if not postings_lists:
+        return []
+    postings_lists = sorted(postings_lists, key=len)
+    result = postings_lists[0]
+    for postings in postings_lists[1:]:
+        matched = []
+        for doc in result:
+            i = bisect.bisect_left(postings, doc)
+            if i < len(postings) and postings[i] == doc:
+                matched.append(doc)
+        result = matched
+        if not result:
+            break
+    return result
+
+
+class InvertedIndex:
+    """In-process index from token to the sorted tweet ids containing it, with positions for phrases."""
+
+    def __init__(self):
+        self.postings = {}  # token -> sorted list of integer tweet ids
+        self.positions = {}  # token -> {tweet id: [positions]}
+        self.vocabulary = []  # sorted tokens, for prefix lookups
+        self.documents = set()
+        self.offsets = {}  # file -> byte offset the incremental loader had indexed it to when this was saved
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('offsets', {})  # Saved before offsets were tracked
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def add(self, tweet_id, text):
+        doc = int(tweet_id)
+        with self.lock:
+            if doc in self.documents:
+                return
+            self.documents.add(doc)
+            for position, token in enumerate(tokenize(text)):
+                token_positions = self.positions.get(token)
+                if token_positions is None:
+                    token_positions = self.positions[token] = {}
+                    self.postings[token] = []
+                    bisect.insort(self.vocabulary, token)
+                if doc not in token_positions:
+                    token_positions[doc] = []
+                    postings = self.postings[token]
+                    # Tweet ids grow over time, so appending is the common case
+                    if not postings or postings[-1] < doc:
+                        postings.append(doc)
+                    else:
+                        bisect.insort(postings, doc)
+                token_positions[doc].append(position)
+
+    def prefix_postings(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        docs = set()
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            docs.update(self.postings[token])
+        return sorted(docs)
+
+    def phrase_matches(self, tokens, doc):
+        first = self.positions[tokens[0]][doc]
+        others = [set(self.positions[token][doc]) for token in tokens[1:]]
+        return any(all(start + offset in positions for offset, positions in enumerate(others, 1))
+                   for start in first)
+
+    def search(self, query_string, limit=None):
+        """Tweet ids (as strings, newest first) matching every term, prefix and phrase in the query."""
+        phrases, prefixes, terms = parse_query(query_string)
+        with self.lock:
+            tokens = set(terms) | {token for phrase in phrases for token in phrase}
+            if any(token not in self.postings for token in tokens):
+                return []
+            postings_lists = [self.postings[token] for token in tokens]
+            postings_lists += [self.prefix_postings(prefix) for prefix in prefixes]
+            docs = intersect(postings_lists)
+            matches = []
+            for doc in reversed(docs):
+                if all(self.phrase_matches(phrase, doc) for phrase in phrases):
+                    matches.append(str(doc))
+                    if limit and len(matches) >= limit:
+                        break
+            return matches
+
+    # Build the index from tweets already stored in MongoDB
+    def add_from_collection(self, collection, batch_size=10000):
+        for tweet in collection.find({}, {'_id': 0, 'tweet_id': 1, 'text': 1}).batch_size(batch_size):
+            self.add(tweet['tweet_id'], tweet.get('text', ''))
+        return self
+
+    def save(self, path):
+        temp_path = path + '.tmp'
+        with self.lock, open(temp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
@@ -0,0 +1,230 @@
+import heapq
+import os
+import pickle
+import threading
+import time
+from collections import Counter
+
+
+class TopK:
+    """The k highest scores by key, updated in place as new scores arrive.
+
+    A few times k candidates are kept, so a member whose score drops is replaced by the next best
+    without rescanning the collection.
+    """
+
+    def __init__(self, k=10, slack=4):
+        self.k = k
+        self.capacity = k * slack
+        self.scores = {}  # key -> (score, item)
+        self.heap = []  # (score, key), entries whose score changed are skipped lazily
+
+    def __len__(self):
+        return len(self.scores)
+
+    def minimum(self):
+        while True:
+            score, key = self.heap[0]
+            entry = self.scores.get(key)
+            if entry is not None and entry[0] == score:
+                return score, key
+            heapq.heappop(self.heap)
+
+    def offer(self, key, score, item):
+        current = self.scores.get(key)
+        if current is None and len(self.scores) >= self.capacity:
+            lowest, lowest_key = self.minimum()
+            if score <= lowest:
+                return False
+            heapq.heappop(self.heap)
+            del self.scores[lowest_key]
+        self.scores[key] = (score, item)
+        if current is None or current[0] != score:
+            heapq.heappush(self.heap, (score, key))
+            if len(self.heap) > 4 * self.capacity:
+                self.heap = [(score, key) for key, (score, _) in self.scores.items()]
+                heapq.heapify(self.heap)
+        return True
+
+    def merge(self, other):
+        # Counts only grow, so of two versions of a key the higher score is the newer one
+        for key, (score, item) in other.scores.items():
+            current = self.scores.get(key)
+            if current is None or score > current[0]:
+                self.offer(key, score, item)
+
+    def top(self, n=None):
+        ranked = sorted(self.scores.items(), key=lambda entry: (-entry[1][0], entry[0]))
+        return [item for _, (_, item) in ranked[:n or self.k]]
+
+
+class TimeWindow:
+    """Top tweets and hashtag counts over the last buckets * bucket_seconds.
+
+    The window ends at the newest tweet seen, not the wall clock, so replaying an archive still fills it.
+    Tweets are counted once per process; seen is not pickled, so one loaded again after a reload is
+    counted again.
+    """
+
+    def __init__(self, bucket_seconds, buckets, k=10):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.k = k
+        self.tweets = {}  # bucket -> TopK of the tweets created in it
+        self.hashtags = {}  # bucket -> Counter of hashtags, each tweet counted once
+        self.seen = {}  # bucket -> tweet_id -> its hashtags, so a tweet loaded twice is counted once
+        self.newest = None
+
+    def add(self, tweet_id, created_at, retweet_count, item, hashtags):
+        bucket = int(created_at.timestamp()) // self.bucket_seconds
+        if self.newest is None or bucket > self.newest:
+            self.newest = bucket
+            for old in [old for old in self.tweets if old <= bucket - self.buckets]:
+                self.drop_bucket(old)
+        if bucket <= self.newest - self.buckets:
+            return  # Older than the window
+        self.ensure_bucket(bucket)
+        self.tweets[bucket].offer(tweet_id, retweet_count, item)
+        self.count_hashtags(bucket, tweet_id, hashtags)
+
+    def __getstate__(self):
+        # seen holds every tweet of the window, far more than the file the service reloads should
+        state = self.__dict__.copy()
+        state['seen'] = {}
+        return state
+
+    def ensure_bucket(self, bucket):
+        if bucket not in self.tweets:
+            self.tweets[bucket], self.hashtags[bucket] = TopK(self.k), Counter()
+
+    def drop_bucket(self, bucket):
+        del self.tweets[bucket], self.hashtags[bucket]
+        self.seen.pop(bucket, None)
+
+    def count_hashtags(self, bucket, tweet_id, hashtags):
+        seen = self.seen.setdefault(bucket, {})
+        if tweet_id not in seen:
+            seen[tweet_id] = hashtags
+            self.hashtags[bucket].update(hashtags)
+
+    def merge(self, other, seen=None):
+        """Add another window, with seen as its bucket -> tweet_id -> hashtags when it was pickled."""
+        seen = other.seen if seen is None else seen
+        for bucket in other.tweets:
+            self.ensure_bucket(bucket)
+            self.tweets[bucket].merge(other.tweets[bucket])
+            if seen.get(bucket):
+                for tweet_id, hashtags in seen[bucket].items():
+                    self.count_hashtags(bucket, tweet_id, hashtags)
+            else:
+                self.hashtags[bucket].update(other.hashtags[bucket])  # Its tweets are unknown, can't deduplicate
+        if other.newest is not None and (self.newest is None or other.newest > self.newest):
+            self.newest = other.newest
+        for old in [old for old in self.tweets if old <= self.newest - self.buckets]:
+            self.drop_bucket(old)
+
+    def top_tweets(self):
+        merged = TopK(self.k)
+        for tweets in self.tweets.values():
+            merged.merge(tweets)
+        return merged.top()
+
+    def top_hashtags(self):
+        totals = Counter()
+        for hashtags in self.hashtags.values():
+            totals.update(hashtags)
+        return [{'hashtag': tag, 'count': count} for tag, count in totals.most_common(self.k)]
+
+
+class TopMetrics:
+    """Top users, top tweets and windowed tweets and hashtags, maintained by the loaders as tweets arrive.
+
+    The loader saves it next to the data and search_service reloads the file when it changes, so
+    /top-metrics is answered without querying either database.
+    """
+
+    WINDOWS = {'last_hour': (60, 60), 'last_day': (3600, 24)}  # name -> (bucket_seconds, buckets)
+
+    def __init__(self, k=10):
+        self.k = k
+        self.top_users = TopK(k)
+        self.top_tweets = TopK(k)
+        self.windows = {name: TimeWindow(bucket_seconds, buckets, k)
+                        for name, (bucket_seconds, buckets) in self.WINDOWS.items()}
+        self.tweets = 0
+        self.lock = threading.Lock()
+        self.snapshot_cache = None
+        self.saved_at = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['snapshot_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    # Record a tweet document together with the user object of the raw tweet it was built from
+    def add(self, document, user_data=None):
+        tweet_id = document['tweet_id']
+        retweet_count = document.get('retweet_count') or 0
+        item = {'tweet_id': str(tweet_id), 'text': document.get('text', ''), 'retweet_count': retweet_count}
+        hashtags = tuple({hashtag['text'] for hashtag in document.get('hashtags', [])})
+        with self.lock:
+            self.snapshot_cache = None
+            self.tweets += 1
+            self.top_tweets.offer(tweet_id, retweet_count, item)
+            if document.get('created_at') is not None:
+                for window in self.windows.values():
+                    window.add(tweet_id, document['created_at'], retweet_count, item, hashtags)
+            if user_data is not None and user_data.get('followers_count') is not None:
+                self.top_users.offer(user_data['id_str'], user_data['followers_count'], {
+                    'user_id': int(user_data['id_str']), 'screen_name': user_data['screen_name'],
+                    'followers_count': user_data['followers_count']})
+
+    def merge(self, other, seen=None):
+        """Add the metrics of another loader, with seen from its seen_tweets() when it was pickled."""
+        with self.lock:
+            self.snapshot_cache = None
+            self.tweets += other.tweets
+            self.top_users.merge(other.top_users)
+            self.top_tweets.merge(other.top_tweets)
+            for name, window in other.windows.items():
+                self.windows[name].merge(window, None if seen is None else seen.get(name, {}))
+
+    # Tweets counted per window, which pickling leaves out; parse_range sends them along with its metrics
+    def seen_tweets(self):
+        with self.lock:
+            return {name: window.seen for name, window in self.windows.items()}
+
+    def snapshot(self):
+        """/top-metrics response: the original top_users and top_tweets plus one entry per window."""
+        with self.lock:
+            if self.snapshot_cache is None:
+                metrics = {'top_users': self.top_users.top(), 'top_tweets': self.top_tweets.top()}
+                for name, window in self.windows.items():
+                    metrics[f'top_tweets_{name}'] = window.top_tweets()
+                    metrics[f'top_hashtags_{name}'] = window.top_hashtags()
+                self.snapshot_cache = metrics
+            return self.snapshot_cache
+
+    def save(self, path):
+        with self.lock:
+            data = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:  # Written without the lock, so add doesn't wait for the disk
+            f.write(data)
+        os.replace(temp_path, path)
+        self.saved_at = time.time()
+
+    # Save during long loads so the service sees progress, at most once per interval
+    def save_every(self, path, interval=10):
+        if path and time.time() - self.saved_at >= interval:
+            self.save(path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
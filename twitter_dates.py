@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+WEEKDAYS = {'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'}
+
+# Layout of 'Wed Oct 10 20:19:24 +0000 2018': separators at fixed offsets
+SEPARATORS = ((3, ' '), (7, ' '), (10, ' '), (13, ':'), (16, ':'), (19, ' '), (25, ' '))
+
+
+@lru_cache(maxsize=64)
+def _utc_offset(offset):
+    # Offsets repeat constantly, share one tzinfo per distinct value
+    if offset == '+0000':
+        return timezone.utc
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    return timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+
+
+def _fields(twitter_date):
+    """Slice the fixed Twitter layout, returns None when the string does not match it exactly."""
+    if len(twitter_date) != 30 or any(twitter_date[i] != c for i, c in SEPARATORS):
+        return None
+    month = MONTHS.get(twitter_date[4:7])
+    offset = twitter_date[20:25]
+    digits = (twitter_date[8:10], twitter_date[11:13], twitter_date[14:16], twitter_date[17:19],
+              offset[1:], twitter_date[26:30])
+    if month is None or twitter_date[:3] not in WEEKDAYS or offset[0] not in '+-' \
+            or not all(d.isdigit() and d.isascii() for d in digits) or offset[3:5] >= '60':
+        return None  # strptime rejects offset minutes above 59 too
+    return (int(twitter_date[26:30]), month, int(twitter_date[8:10]), int(twitter_date[11:13]),
+            int(twitter_date[14:16]), int(twitter_date[17:19]), offset)
+
+
+@lru_cache(maxsize=65536)
+def parse_twitter_datetime(twitter_date):
+    """Parse a Twitter 'created_at' string to an aware datetime, same result and errors as strptime."""
+    fields = _fields(twitter_date)
+    if fields is None:
+        # Anything off the fixed layout goes through strptime for identical behaviour
+        return datetime.strptime(twitter_date, TWITTER_DATE_FORMAT)
+    year, month, day, hour, minute, second, offset = fields
+    return datetime(year, month, day, hour, minute, second, tzinfo=_utc_offset(offset))
+
+
+@lru_cache(maxsize=65536)
+def twitter_date_to_sql(twitter_date):
+    """Convert a Twitter 'created_at' string to MySQL 'YYYY-MM-DD HH:MM:SS' (wall time of the original offset)."""
+    return parse_twitter_datetime(twitter_date).strftime('%Y-%m-%d %H:%M:%S')
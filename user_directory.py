@@ -0,0 +1,173 @@
+import threading
+import time
+import pymysql
+from instrumentation import record_round_trip
+
+USER_COLUMNS = "user_id, screen_name, name, followers_count, updated_at"
+
+
+# Each read is its own transaction, so the next one sees rows committed since rather than the snapshot
+# of the first read, on connections not in autocommit mode too
+def end_transaction(connection):
+    if not connection.get_autocommit():
+        connection.rollback()
+
+
+class UserRecord:
+    __slots__ = ('user_id', 'screen_name', 'name', 'followers_count')
+
+    def __init__(self, user_id, screen_name, name, followers_count):
+        self.user_id = user_id
+        self.screen_name = screen_name
+        self.name = name
+        self.followers_count = followers_count
+
+    # Read like the MySQL rows they replace, e.g. record['name'] in build_metadata
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class UserDirectory:
+    """In-process copy of the users table for screen_name and user_id lookups.
+
+    Loaded once in the background, then refreshed from rows whose updated_at moved. Until the load
+    finishes, and for users it doesn't know yet, lookups fall through to MySQL.
+    """
+
+    def __init__(self, connection, refresh_interval=60, chunk_size=10000):
+        self.connection = connection  # returns a context manager holding a MySQL connection
+        self.refresh_interval = refresh_interval
+        self.chunk_size = chunk_size
+        self.by_id = {}  # user_id as a string, like the tweet documents -> UserRecord
+        self.by_screen_name = {}  # casefolded screen_name -> UserRecord
+        self.missing = set()  # screen names MySQL didn't have either, forgotten at the next refresh
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.last_update = None
+        self.hits = self.misses = self.refreshes = 0
+
+    def add(self, row):
+        record = UserRecord(str(row['user_id']), row['screen_name'], row['name'], row['followers_count'])
+        with self.lock:
+            previous = self.by_id.get(record.user_id)
+            if previous is not None and previous.screen_name and previous.screen_name != record.screen_name:
+                self.by_screen_name.pop(previous.screen_name.casefold(), None)  # Renamed
+            self.by_id[record.user_id] = record
+            if record.screen_name:
+                self.by_screen_name[record.screen_name.casefold()] = record
+        return record
+
+    def read(self, query, args=None):
+        # Only full reads move last_update, a row fetched on a miss may be newer than ones not seen yet
+        count, last_update = 0, self.last_update
+        with self.connection() as connection:
+            cursor = connection.cursor(pymysql.cursors.SSDictCursor)  # Streamed, not buffered in full
+            try:
+                record_round_trip('mysql')
+                cursor.execute(query, args)
+                while True:
+                    rows = cursor.fetchmany(self.chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        self.add(row)
+                        updated_at = row['updated_at']
+                        if updated_at is not None and (last_update is None or updated_at > last_update):
+                            last_update = updated_at
+                    count += len(rows)
+            finally:
+                cursor.close()
+                end_transaction(connection)
+        self.last_update = last_update
+        return count
+
+    def load(self):
+        start_time = time.time()
+        count = self.read(f"SELECT {USER_COLUMNS} FROM users")
+        self.loaded.set()
+        print(f"Loaded {count} users into the directory in {time.time() - start_time:.1f}s")
+        return count
+
+    def refresh(self):
+        # >= so rows written in the same second as the last refresh aren't missed, re-adding is harmless
+        if self.last_update is None:
+            count = self.read(f"SELECT {USER_COLUMNS} FROM users")
+        else:
+            count = self.read(f"SELECT {USER_COLUMNS} FROM users WHERE updated_at >= %s", (self.last_update,))
+        with self.lock:
+            self.missing.clear()
+            self.refreshes += 1
+        return count
+
+    def run(self):
+        while not self.loaded.is_set():
+            try:
+                self.load()
+            except Exception as e:
+                print(f"An error occurred loading the user directory: {e}")
+                time.sleep(self.refresh_interval)
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"An error occurred refreshing the user directory: {e}")
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def fetch_where(self, condition, args):
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                record_round_trip('mysql')
+                cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE {condition}", args)
+                return [self.add(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+                end_transaction(connection)
+
+    def user_id(self, screen_name):
+        """user_id (as a string) for a screen name, or None when MySQL doesn't know it either."""
+        key = screen_name.casefold()
+        record = self.by_screen_name.get(key)
+        if record is not None:
+            self.hits += 1
+            return record.user_id
+        self.misses += 1
+        if key in self.missing:
+            return None
+        records = self.fetch_where("screen_name = %s", (screen_name,))
+        if not records:
+            with self.lock:
+                self.missing.add(key)
+            return None
+        return records[0].user_id
+
+    def users(self, user_ids):
+        """Records keyed by user_id as a string, users unknown to the directory fetched in one query."""
+        found, pending = {}, []
+        for user_id in {str(user_id) for user_id in user_ids}:
+            record = self.by_id.get(user_id)
+            if record is not None:
+                found[user_id] = record
+            else:
+                pending.append(user_id)
+        self.hits += len(found)
+        self.misses += len(pending)
+        if pending:
+            placeholders = ', '.join(['%s'] * len(pending))
+            for record in self.fetch_where(f"user_id IN ({placeholders})", pending):
+                found[record.user_id] = record
+        return found
+
+    def get(self, user_id):
+        return self.users([user_id]).get(str(user_id))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'users': len(self.by_id), 'loaded': self.loaded.is_set(), 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'refreshes': self.refreshes}